@@ -0,0 +1,182 @@
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import re
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import syntheticQlog
+
+# Throughput benchmark of the qlog/sqlog evaluation paths
+#
+# Generates a synthetic picoquic qlog and quiche sqlog file (see syntheticQlog.py), links them under
+# the file names the evaluation functions parse their parameters from, and times every function in
+# a fresh process: MB/s, events/s and peak RSS. Results can be saved as a JSON baseline and compared
+# against one, the exit status is 1 if a function got slower than the tolerance.
+#
+# python3 qlogBenchmark.py --sizeMB 50 --saveBaseline baseline.json
+# python3 qlogBenchmark.py --sizeMB 50 --baseline baseline.json
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+# label: (script relative to the repository, function, input format, file name, extra arguments)
+TARGETS = {
+    "evalPicoquicSingleFile": ("varyingObjectsize_RTT_cwnd/varyingObjectsize.py", "evalPicoquicSingleFile", "qlog",
+                               "picoquic_NetEm_cubic_objsize1000000_iter0.qlog", ()),
+    "readPicoquicSingleFileWide": ("varyingObjectsize_RTT_cwnd/varyingObjectsize.py", "readPicoquicSingleFileWide",
+                                   "qlog", "picoquic_NetEm_cubic_objsize1000000_iter0.qlog", ()),
+    "evalQuicheSingleFile": ("varyingObjectsize_RTT_cwnd/varyingObjectsize.py", "evalQuicheSingleFile", "sqlog",
+                             "quiche_NetEm_cubic_objsize1000000_iter0.sqlog", ()),
+    "readQuicheSingleFileWide": ("varyingObjectsize_RTT_cwnd/varyingObjectsize.py", "readQuicheSingleFileWide",
+                                 "sqlog", "quiche_NetEm_cubic_objsize1000000_iter0.sqlog", ()),
+    "evalSingleFile": ("cr_trace_phases/cr_trace_phases_qlog2csv.py", "evalSingleFile", "qlog",
+                       "cr_phases.qlog", ()),
+    "evalSingleFileStreaming": ("cr_trace_phases/cr_trace_phases_qlog2csv.py", "evalSingleFileStreaming", "qlog",
+                                "cr_phases.qlog", ()),
+    "process_qlog": ("varyingObjectsize_transmissionDuration/vostd_eval.py", "process_qlog", "qlog",
+                     "picoquic_picoquic_cubic.1000KB.itr0.server.qlog", (False,)),
+    "process_qlog-fast": ("varyingObjectsize_transmissionDuration/vostd_eval.py", "process_qlog", "qlog",
+                          "picoquic_picoquic_cubic.1000KB.itr0.server.qlog", (True,)),
+    "process_sqlog": ("varyingObjectsize_transmissionDuration/vostd_eval.py", "process_sqlog", "sqlog",
+                      "quiche_quiche_cubic.1000KB.itr0.server.sqlog", (False,)),
+    "process_sqlog-fast": ("varyingObjectsize_transmissionDuration/vostd_eval.py", "process_sqlog", "sqlog",
+                           "quiche_quiche_cubic.1000KB.itr0.server.sqlog", (True,)),
+}
+
+
+def maxRssMB():
+    # peak resident set size of this process (ru_maxrss is in kB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _loadFunction(script, function):
+    path = os.path.join(REPO_DIR, script)
+    spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(script))[0], path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return getattr(module, function)
+
+
+def _runTarget(label, filename, repeat, results):
+    # runs in a fresh process, the output of the evaluated scripts is discarded
+    script, function, _, _, args = TARGETS[label]
+    function = _loadFunction(script, function)
+    rssBefore = maxRssMB()
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                function(filename, *args)
+                times.append(time.perf_counter() - start)
+        finally:
+            sys.stdout = stdout
+    results.put({"times": times, "peakRssMB": maxRssMB(), "rssBeforeMB": rssBefore})
+
+
+def benchmark(labels, sizeMB, repeat=3, mix=syntheticQlog.DEFAULT_MIX, workDir=None):
+    # returns {label: {seconds, MBps, eventsPerSecond, peakRssMB, rssIncreaseMB}} and the input description
+    if workDir is None:
+        workDir = tempfile.mkdtemp(prefix="qlogBenchmark")
+        try:
+            return benchmark(labels, sizeMB, repeat, mix, workDir)
+        finally:
+            shutil.rmtree(workDir)
+    os.makedirs(workDir, exist_ok=True)
+    inputs = {}
+    for kind, write in [("qlog", syntheticQlog.writePicoquicQlog), ("sqlog", syntheticQlog.writeQuicheSqlog)]:
+        filename = os.path.join(workDir, f"synthetic.{kind}")
+        events = write(filename, int(sizeMB * 1e6), mix)
+        inputs[kind] = {"file": filename, "events": events, "bytes": os.path.getsize(filename)}
+        print(f"Generated {filename}: {inputs[kind]['bytes'] / 1e6:.1f} MB, {events} events")
+
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for label in labels:
+        _, _, kind, name, _ = TARGETS[label]
+        linkName = os.path.join(workDir, name)
+        if not os.path.exists(linkName):
+            os.symlink(inputs[kind]["file"], linkName)
+        queue = context.Queue()
+        process = context.Process(target=_runTarget, args=(label, linkName, repeat, queue))
+        process.start()
+        result = queue.get()
+        process.join()
+        seconds = min(result["times"])
+        results[label] = {"seconds": seconds,
+                          "medianSeconds": statistics.median(result["times"]),
+                          "MBps": inputs[kind]["bytes"] / 1e6 / seconds,
+                          "eventsPerSecond": inputs[kind]["events"] / seconds,
+                          "peakRssMB": result["peakRssMB"],
+                          "rssIncreaseMB": result["peakRssMB"] - result["rssBeforeMB"]}
+        print(formatRow(label, results[label]))
+    return results, {kind: {"bytes": value["bytes"], "events": value["events"]} for kind, value in inputs.items()}
+
+
+def formatRow(label, result, baseline=None):
+    row = (f"{label:28s} {result['seconds'] * 1000:9.1f} ms {result['MBps']:8.1f} MB/s {result['eventsPerSecond']:11.0f} ev/s "
+           f"peak RSS {result['peakRssMB']:7.1f} MB (+{result['rssIncreaseMB']:.1f})")
+    if baseline is not None:
+        row += f"  {result['MBps'] / baseline['MBps']:5.2f}x baseline"
+    return row
+
+
+def machineInfo():
+    return {"node": platform.node(), "machine": platform.machine(), "processor": platform.processor(),
+            "python": platform.python_version(), "cpus": os.cpu_count()}
+
+
+def compareToBaseline(results, baseline, tolerance):
+    # returns the labels whose throughput dropped by more than tolerance (fraction)
+    regressions = []
+    print(f"\nCompared to baseline of {baseline['machine'].get('node')} ({baseline.get('date', '?')}):")
+    for label, result in results.items():
+        reference = baseline["results"].get(label)
+        if reference is None:
+            print(formatRow(label, result) + "  (not in baseline)")
+            continue
+        print(formatRow(label, result, reference))
+        if result["MBps"] < (1 - tolerance) * reference["MBps"]:
+            regressions.append(label)
+    if regressions:
+        print(f"Slower than baseline by more than {tolerance:.0%}: {', '.join(regressions)}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark qlog/sqlog evaluation functions on synthetic files")
+    parser.add_argument("--sizeMB", type=float, default=20, help="Size of the synthetic qlog and sqlog file")
+    parser.add_argument("--mix", type=syntheticQlog.parseMix, default=syntheticQlog.DEFAULT_MIX,
+                        help="Event weights, e.g. metrics_updated=0.3,packet_sent=0.65,cr_phase=0.05")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per function, the fastest is reported")
+    parser.add_argument("--only", type=str, default=None, help="Regular expression selecting functions")
+    parser.add_argument("--workDir", type=str, default=None, help="Directory for the synthetic files")
+    parser.add_argument("--saveBaseline", type=str, default=None, help="Write the results to this JSON file")
+    parser.add_argument("--baseline", type=str, default=None, help="Compare to the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Throughput drop (fraction) compared to the baseline that counts as regression")
+    args = parser.parse_args()
+
+    labels = [label for label in TARGETS if args.only is None or re.search(args.only, label)]
+    results, inputs = benchmark(labels, args.sizeMB, args.repeat, args.mix, args.workDir)
+
+    report = {"date": time.strftime("%Y-%m-%dT%H:%M:%S"), "machine": machineInfo(),
+              "sizeMB": args.sizeMB, "mix": args.mix, "inputs": inputs, "results": results}
+    if args.saveBaseline:
+        with open(args.saveBaseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved {args.saveBaseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compareToBaseline(results, baseline, args.tolerance):
+            sys.exit(1)
@@ -0,0 +1,170 @@
+import argparse
+import json
+import random
+
+# Synthetic picoquic qlog and quiche sqlog files for benchmarking the evaluation scripts
+#
+# Files have the layout of the real ones (see common/qlogReader.py): picoquic writes one event per
+# line in the events array of a JSON document, quiche one JSON-SEQ record per event. Events are
+# drawn from a configurable mix of recovery:metrics_updated, recovery:cr_phase and
+# transport:packet_sent (STREAM frames) until the file has the requested size. The last event is a
+# packet with a CONNECTION_CLOSE frame.
+
+DEFAULT_MIX = {"metrics_updated": 0.3, "packet_sent": 0.65, "cr_phase": 0.05}
+MSS = 1252
+
+
+def parseMix(text):
+    # "metrics_updated=0.3,packet_sent=0.65,cr_phase=0.05" -> dict of weights
+    mix = {}
+    for item in text.split(","):
+        name, weight = item.split("=")
+        if name not in DEFAULT_MIX:
+            raise ValueError(f"unknown event {name}, expected one of {', '.join(DEFAULT_MIX)}")
+        mix[name] = float(weight)
+    return mix
+
+
+class TransferState:
+    # plausible, slowly changing metrics of a transfer, times in us
+    def __init__(self, seed):
+        self.random = random.Random(seed)
+        self.time = 0
+        self.packetNumber = 0
+        self.offset = 0
+        self.cwnd = 15360
+        self.minRtt = 600000
+        self.crPhase = 0
+
+    def advance(self):
+        self.time += self.random.randint(5, 400)
+
+    def rtt(self):
+        return self.minRtt + self.random.randint(0, 50000)
+
+    def metrics(self):
+        self.cwnd = max(2 * MSS, self.cwnd + self.random.randint(-MSS, 2 * MSS))
+        return {"cwnd": self.cwnd, "bytes_in_flight": self.random.randint(0, self.cwnd),
+                "smoothed_rtt": self.rtt(), "min_rtt": self.minRtt, "latest_rtt": self.rtt()}
+
+    def streamFrame(self):
+        length = self.random.randint(MSS // 2, MSS)
+        frame = {"frame_type": "stream", "id": 0, "offset": self.offset, "length": length, "fin": False}
+        self.offset += length
+        self.packetNumber += 1
+        return frame
+
+    def crPhaseChange(self):
+        old = self.crPhase
+        self.crPhase = self.random.choice([0, 1, 2, 3, 4, 100])
+        return {"old": old, "new": self.crPhase, "trigger": self.random.randint(0, 5)}
+
+
+def _events(mix, seed):
+    # endless (name, state) sequence following the mix
+    state = TransferState(seed)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    while True:
+        state.advance()
+        yield state.random.choices(names, weights)[0], state
+
+
+def writePicoquicQlog(filename, sizeBytes, mix=DEFAULT_MIX, seed=1, pathId=True):
+    # returns the number of events written
+    pathField = '"path_id", ' if pathId else ''
+    head = (f'{{ "qlog_version": "draft-00", "title": "picoquic", "traces": [\n'
+            f'{{ "vantage_point": {{ "name": "backend-67", "type": "server" }},\n'
+            f'"title": "picoquic", "description": "{seed:016x}",'
+            f'"event_fields": ["relative_time", {pathField}"category", "event", "data"],\n'
+            f'"configuration": {{"time_units": "us"}},\n'
+            f'"common_fields": {{ "protocol_type": "QUIC_HTTP3", "reference_time": "1700000000000000"}},\n'
+            f'"events": [')
+    path = "0, " if pathId else ""
+    written = 0
+    count = 0
+    with open(filename, 'w') as f:
+        f.write(head)
+        first = True
+        for name, state in _events(mix, seed):
+            if name == "metrics_updated":
+                line = f'[{state.time}, {path}"recovery", "metrics_updated", {json.dumps(state.metrics())}]'
+            elif name == "cr_phase":
+                line = f'[{state.time}, {path}"recovery", "cr_phase", {json.dumps(state.crPhaseChange())}]'
+            else:
+                frame = state.streamFrame()
+                line = (f'[{state.time}, {path}"transport", "packet_sent", {{ "packet_type": "1RTT", '
+                        f'"header": {{ "packet_size": {frame["length"] + 40}, "packet_number": {state.packetNumber}, '
+                        f'"dcid": "0102030405060708" }}, "frames": [{json.dumps(frame)}]}}]')
+            line = ("\n" if first else ",\n") + line
+            first = False
+            f.write(line)
+            written += len(line)
+            count += 1
+            if written >= sizeBytes:
+                break
+        state.advance()
+        close = {"packet_type": "1RTT", "header": {"packet_size": 40, "packet_number": state.packetNumber + 1},
+                 "frames": [{"frame_type": "connection_close", "error_space": "application", "error_code": 0}]}
+        f.write(f',\n[{state.time}, {path}"transport", "packet_sent", {json.dumps(close)}]')
+        state.advance()
+        f.write(f',\n[{state.time}, {path}"transport", "spin_bit_updated", {{ "state": false }}]]}}]}}\n')
+    return count + 2
+
+
+def writeQuicheSqlog(filename, sizeBytes, mix=DEFAULT_MIX, seed=1):
+    # returns the number of events written, times in ms (float) as written by quiche
+    header = {"qlog_version": "0.3", "qlog_format": "JSON-SEQ", "title": "quiche-server qlog",
+              "trace": {"vantage_point": {"type": "server"}, "title": "quiche-server qlog",
+                        "common_fields": {"reference_time": 1700000000000.0, "time_format": "relative"}}}
+    written = 0
+    count = 0
+    with open(filename, 'w') as f:
+        f.write(f"\x1e{json.dumps(header)}\n")
+        for name, state in _events(mix, seed):
+            time = state.time / 1000
+            if name == "metrics_updated":
+                metrics = state.metrics()
+                data = {"min_rtt": metrics["min_rtt"] / 1000, "smoothed_rtt": metrics["smoothed_rtt"] / 1000,
+                        "latest_rtt": metrics["latest_rtt"] / 1000, "rtt_variance": 2.5,
+                        "congestion_window": metrics["cwnd"], "bytes_in_flight": metrics["bytes_in_flight"]}
+                record = {"time": time, "name": "recovery:metrics_updated", "data": data}
+            elif name == "cr_phase":
+                record = {"time": time, "name": "recovery:cr_phase", "data": state.crPhaseChange()}
+            else:
+                frame = state.streamFrame()
+                frame = {"frame_type": "stream", "stream_id": frame["id"], "offset": frame["offset"],
+                         "length": frame["length"], "fin": False}
+                record = {"time": time, "name": "transport:packet_sent",
+                          "data": {"header": {"packet_type": "1RTT", "packet_number": state.packetNumber},
+                                   "raw": {"length": frame["length"] + 40}, "frames": [frame]}}
+            line = f"\x1e{json.dumps(record)}\n"
+            f.write(line)
+            written += len(line)
+            count += 1
+            if written >= sizeBytes:
+                break
+        state.advance()
+        close = {"time": state.time / 1000, "name": "transport:packet_received",
+                 "data": {"header": {"packet_type": "1RTT", "packet_number": 1},
+                          "frames": [{"frame_type": "connection_close", "error_space": "application",
+                                      "error_code": 0}]}}
+        f.write(f"\x1e{json.dumps(close)}\n")
+    return count + 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic picoquic qlog or quiche sqlog files")
+    parser.add_argument("filename", type=str, help="Output file, .qlog: picoquic, .sqlog: quiche")
+    parser.add_argument("--sizeMB", type=float, default=10, help="Approximate file size")
+    parser.add_argument("--mix", type=parseMix, default=DEFAULT_MIX,
+                        help="Event weights, e.g. metrics_updated=0.3,packet_sent=0.65,cr_phase=0.05")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--noPathId", action='store_true', help="qlog: old picoquic events without path_id")
+    args = parser.parse_args()
+
+    if args.filename.endswith(".sqlog"):
+        events = writeQuicheSqlog(args.filename, int(args.sizeMB * 1e6), args.mix, args.seed)
+    else:
+        events = writePicoquicQlog(args.filename, int(args.sizeMB * 1e6), args.mix, args.seed, not args.noPathId)
+    print(f"Wrote {events} events to {args.filename}")
@@ -0,0 +1,119 @@
+import hashlib
+import os
+import pickle
+
+# Persistent cache of per-file evaluation results
+#
+# Entries are keyed on the evaluation function (namespace) and path + size + mtime of the input
+# file(s), or optionally on a content hash (blake2b) instead of the mtime, e.g. if files are
+# copied around. Results (typically dicts of NumPy arrays) are stored as one pickle file per entry.
+# The cache directory is bounded to maxBytes, least recently used entries are evicted first.
+
+FORMAT_VERSION = 1
+MISSING = object()
+
+
+def _contentHash(filename, chunkSize=1 << 20):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunkSize), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class EvalCache:
+    def __init__(self, cacheDir, maxBytes=2 * 1024**3, useHash=False):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.useHash = useHash
+        self.hits = 0
+        self.misses = 0
+        self.hashes = {}
+        os.makedirs(cacheDir, exist_ok=True)
+        self.totalBytes = sum(entry.stat().st_size for entry in os.scandir(cacheDir) if entry.name.endswith(".pkl"))
+
+    def _entryPath(self, filenames, namespace):
+        if isinstance(filenames, (str, os.PathLike)):
+            filenames = [filenames]
+        key = [str(FORMAT_VERSION), namespace]
+        for filename in filenames:
+            stat = os.stat(filename)
+            key += [os.path.abspath(filename), str(stat.st_size)]
+            if self.useHash:
+                fileId = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+                if fileId not in self.hashes:
+                    self.hashes[fileId] = _contentHash(filename)
+                key.append(self.hashes[fileId])
+            else:
+                key.append(str(stat.st_mtime_ns))
+        digest = hashlib.sha1("\0".join(key).encode()).hexdigest()
+        return os.path.join(self.cacheDir, f"{digest}.pkl")
+
+    def contains(self, filenames, namespace):
+        return os.path.isfile(self._entryPath(filenames, namespace))
+
+    def get(self, filenames, namespace, default=None):
+        # returns the cached result or default
+        path = self._entryPath(filenames, namespace)
+        try:
+            with open(path, 'rb') as f:
+                (result,) = pickle.load(f)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            self.misses += 1
+            return default
+        os.utime(path)  # mtime of entry is used as last access time for eviction
+        self.hits += 1
+        return result
+
+    def put(self, filenames, namespace, result):
+        path = self._entryPath(filenames, namespace)
+        # write to temporary file first, a crashed run must not leave a truncated entry
+        tempPath = f"{path}.{os.getpid()}.tmp"
+        with open(tempPath, 'wb') as f:
+            pickle.dump((result,), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tempPath, path)
+        self.totalBytes += os.path.getsize(path)
+        if self.totalBytes > self.maxBytes:
+            self.evict()
+
+    def evict(self):
+        # remove least recently used entries until the cache is below 90% of maxBytes
+        entries = sorted((entry for entry in os.scandir(self.cacheDir) if entry.name.endswith(".pkl")),
+                         key=lambda entry: entry.stat().st_mtime)
+        self.totalBytes = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self.totalBytes <= 0.9 * self.maxBytes:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+            self.totalBytes -= size
+
+    def cached(self, function, filenames, *args, namespace=None):
+        # returns function(*args) from the cache or calls it and stores its result
+        namespace = namespace or function.__name__
+        result = self.get(filenames, namespace, default=MISSING)
+        if result is MISSING:
+            result = function(*args)
+            self.put(filenames, namespace, result)
+        return result
+
+    def __str__(self):
+        return (f"EvalCache {self.cacheDir}: {self.hits} hits, {self.misses} misses, "
+                f"{self.totalBytes / 1e6:.1f}/{self.maxBytes / 1e6:.0f} MB")
+
+
+def addCacheArguments(parser):
+    parser.add_argument("--cacheDir", type=str, default=None,
+                        help="Cache per-file evaluation results in this directory (re-runs only parse new/changed files)")
+    parser.add_argument("--cacheMaxMB", type=int, default=2048, help="Maximum size of the cache directory")
+    parser.add_argument("--cacheHash", action='store_true',
+                        help="Identify files by content hash instead of modification time")
+
+
+def cacheFromArguments(args):
+    if not args.cacheDir:
+        return None
+    return EvalCache(args.cacheDir, maxBytes=args.cacheMaxMB * 1024**2, useHash=args.cacheHash)
@@ -0,0 +1,142 @@
+import contextlib
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+import traceback
+
+import pandas as pd
+
+import evalCache
+
+# Evaluation of result files overlapping with the measurement campaign
+#
+# Measurement scripts submit every result file as soon as it is complete. Worker processes evaluate
+# the files while the next transfers run, the results are appended to a csv file which can be read
+# (and plotted) at any time. Rows are in the order in which evaluations finish.
+#
+# Measurements have priority: workers run with scheduling policy SCHED_IDLE (or nice 19 where not
+# available), i.e., they only get CPU time the measurement does not use. With pauseDuringTransfers,
+# workers do not start a new file while a transfer is running (see transfer()).
+# With a cache (evalCache.EvalCache), results are stored there as well, so the final batch evaluation
+# after the campaign only reads the cache.
+
+NICENESS = 19
+
+_idle = None
+
+
+def _initWorker(idle):
+    global _idle
+    _idle = idle
+    try:
+        os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+    except (AttributeError, OSError):
+        os.nice(NICENESS)
+
+
+def _evaluate(function, args):
+    _idle.wait()
+    return function(*args)
+
+
+class EvalPipeline:
+    def __init__(self, function, csvFilename, toFrame=pd.DataFrame, jobs=1, cache=None, namespace=None,
+                 pauseDuringTransfers=False):
+        # function: module-level function (picklable), called as function(*args) of submit()
+        # toFrame: converts a result to a DataFrame of rows for the csv file, called in this process
+        self.function = function
+        self.csvFilename = csvFilename
+        self.toFrame = toFrame
+        self.cache = cache
+        self.namespace = namespace or getattr(function, "__name__", None)
+        self.pauseDuringTransfers = pauseDuringTransfers
+        self.idle = multiprocessing.Event()
+        self.idle.set()
+        self.transfers = 0
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.done = 0
+        self.failed = 0
+        self.rows = 0
+        self.futures = []
+        if os.path.exists(csvFilename):
+            os.remove(csvFilename)
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_initWorker,
+                                                               initargs=(self.idle,))
+
+    def submit(self, filenames, *args):
+        # evaluates function(*args), or function(filenames) without args, filenames are the cache key
+        args = args or (filenames,)
+        with self.lock:
+            self.submitted += 1
+        if self.cache is not None:
+            with self.lock:
+                result = self.cache.get(filenames, self.namespace, default=evalCache.MISSING)
+            if result is not evalCache.MISSING:
+                self._write(result)
+                return
+        future = self.executor.submit(_evaluate, self.function, args)
+        future.add_done_callback(lambda future: self._finished(future, filenames))
+        self.futures.append(future)
+
+    def _finished(self, future, filenames):
+        try:
+            result = future.result()
+        except Exception:
+            with self.lock:
+                self.failed += 1
+            print(f"EvalPipeline: evaluating {filenames} failed\n{traceback.format_exc()}")
+            return
+        if self.cache is not None:
+            with self.lock:
+                self.cache.put(filenames, self.namespace, result)
+        self._write(result)
+
+    def _write(self, result):
+        df = self.toFrame(result) if result is not None else None
+        with self.lock:
+            if df is not None and not df.empty:
+                # header only once, the file is a valid csv file after every write
+                df.to_csv(self.csvFilename, mode='a', header=(self.rows == 0), index=False)
+                self.rows += len(df)
+            self.done += 1
+
+    @contextlib.contextmanager
+    def transfer(self):
+        # marks a running transfer, with pauseDuringTransfers no evaluation starts until all
+        # concurrent transfers have finished (evaluations already running continue at idle priority)
+        with self.lock:
+            self.transfers += 1
+            if self.pauseDuringTransfers:
+                self.idle.clear()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.transfers -= 1
+                if self.transfers == 0:
+                    self.idle.set()
+
+    def status(self):
+        with self.lock:
+            return (f"EvalPipeline {self.csvFilename}: {self.done} of {self.submitted} files evaluated, "
+                    f"{self.failed} failed, {self.rows} rows")
+
+    def close(self):
+        # waits for all evaluations, returns the csv filename
+        self.idle.set()
+        concurrent.futures.wait(self.futures)
+        self.executor.shutdown()
+        self.futures = []
+        print(self.status())
+        return self.csvFilename
+
+
+def addPipelineArguments(parser):
+    parser.add_argument("--pipeline", action='store_true',
+                        help="Evaluate result files in background worker processes during the measurements")
+    parser.add_argument("--pipelineJobs", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="Number of evaluation worker processes of --pipeline")
+    parser.add_argument("--pipelinePause", action='store_true',
+                        help="Do not start evaluations while a transfer is running")
@@ -0,0 +1,163 @@
+import math
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# Cost-aware scheduling of iterations in parameter sweeps
+#
+# Cells (e.g. (operator, cc, objsize)) are measured in rounds, each cell at most once per round. Every
+# cell gets minIterations, further iterations only go to cells whose 95% confidence interval of the
+# metric (half width relative to the mean) is still wider than ciTarget, at most maxIterations per
+# cell. Within a round, cells are prioritized by how far they are from the target per second of cost.
+# The cost of an iteration (wall-clock seconds) is estimated from the iterations observed so far:
+# mean of the cell, else of cells of the same size, else a linear fit over the size, else defaultCost.
+# With a budget (seconds), only iterations expected to finish within the budget are scheduled, extra
+# iterations only once the minIterations of all cells fit.
+
+Z95 = 1.96
+
+
+class IterationScheduler:
+    def __init__(self, cells, minIterations=3, maxIterations=10, ciTarget=0.05, budget=None, defaultCost=10.0,
+                 size=None):
+        # size: function cell -> size (e.g. object size in bytes), to extrapolate the cost of cells
+        # not measured yet
+        self.cells = list(cells)
+        self.minIterations = min(minIterations, maxIterations)
+        self.maxIterations = maxIterations
+        self.ciTarget = ciTarget
+        self.budget = budget
+        self.defaultCost = defaultCost
+        self.size = size
+        self.costs = {cell: [] for cell in self.cells}
+        self.values = {cell: [] for cell in self.cells}
+        self.start = time.monotonic()
+
+    def iterations(self, cell):
+        return len(self.costs[cell])
+
+    def record(self, cell, cost, value=None):
+        # cost: wall-clock seconds of the iteration, value: metric the confidence interval refers to
+        self.costs[cell].append(cost)
+        if value is not None:
+            self.values[cell].append(value)
+
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    def relativeCi(self, cell):
+        # half width of the 95% confidence interval of the mean (normal approximation) relative to the mean
+        values = self.values[cell]
+        if len(values) < 2:
+            return math.inf
+        mean = np.mean(values)
+        halfWidth = Z95 * np.std(values, ddof=1) / math.sqrt(len(values))
+        if mean == 0:
+            return 0.0 if halfWidth == 0 else math.inf
+        return float(halfWidth / abs(mean))
+
+    def estimatedCost(self, cell):
+        if self.costs[cell]:
+            return float(np.mean(self.costs[cell]))
+        measured = [c for c in self.cells if self.costs[c]]
+        if not measured:
+            return self.defaultCost
+        if self.size is not None:
+            sameSize = [cost for c in measured if self.size(c) == self.size(cell) for cost in self.costs[c]]
+            if sameSize:
+                return float(np.mean(sameSize))
+            sizes = np.array([self.size(c) for c in measured], dtype=float)
+            if len(np.unique(sizes)) >= 2:
+                slope, intercept = np.polyfit(sizes, [np.mean(self.costs[c]) for c in measured], 1)
+                minCost = min(min(self.costs[c]) for c in measured)
+                return float(max(minCost, intercept + slope * self.size(cell)))
+        return float(np.mean([cost for c in measured for cost in self.costs[c]]))
+
+    def neededIterations(self, cell):
+        # further iterations expected until the cell is done (the half width shrinks with 1/sqrt(n))
+        n = self.iterations(cell)
+        if n < self.minIterations:
+            return self.minIterations - n
+        if n >= self.maxIterations:
+            return 0
+        ci = self.relativeCi(cell)
+        if ci <= self.ciTarget:
+            return 0
+        if math.isinf(ci):
+            return self.maxIterations - n
+        return max(1, min(self.maxIterations, math.ceil(n * (ci / self.ciTarget) ** 2)) - n)
+
+    def nextRound(self):
+        # cells to measure in the next round (in the order of cells), empty list once the campaign is done
+        mandatory = [cell for cell in self.cells if self.iterations(cell) < self.minIterations]
+        extra = [cell for cell in self.cells if cell not in mandatory and self.neededIterations(cell) > 0]
+        extra.sort(key=lambda cell: min(self.relativeCi(cell), 1e9) / self.ciTarget / self.estimatedCost(cell),
+                   reverse=True)
+        selected = set()
+        planned = 0.0
+        dropped = []
+
+        def fits(cell):
+            return self.budget is None or self.elapsed() + planned + self.estimatedCost(cell) <= self.budget
+
+        # the budget goes to the minIterations of every cell first, extra iterations only if all fit
+        for cell in mandatory:
+            if fits(cell):
+                selected.add(cell)
+                planned += self.estimatedCost(cell)
+            else:
+                dropped.append(cell)
+        if not dropped:
+            for cell in extra:
+                if fits(cell):
+                    selected.add(cell)
+                    planned += self.estimatedCost(cell)
+        if dropped or (not selected and extra):
+            print(f"IterationScheduler: budget of {self.budget:.0f} s exhausted, {len(dropped)} cells below "
+                  f"minIterations, {sum(map(self.neededIterations, self.cells))} iterations not run")
+        return [cell for cell in self.cells if cell in selected]
+
+    def remainingTime(self):
+        remaining = sum(self.neededIterations(cell) * self.estimatedCost(cell) for cell in self.cells)
+        if self.budget is not None:
+            remaining = min(remaining, max(0.0, self.budget - self.elapsed()))
+        return remaining
+
+    def projectedFinish(self):
+        return datetime.now() + timedelta(seconds=self.remainingTime())
+
+    def report(self):
+        done = sum(self.iterations(cell) for cell in self.cells)
+        notDone = sum(1 for cell in self.cells if self.neededIterations(cell) > 0)
+        return (f"IterationScheduler: {done} iterations in {self.elapsed():.0f} s, {notDone} of {len(self.cells)} cells "
+                f"not done, ~{self.remainingTime():.0f} s remaining, projected finish "
+                f"{self.projectedFinish().strftime('%Y-%m-%d %H:%M:%S')}")
+
+    def summary(self):
+        # one line per cell: iterations, mean and relative confidence interval of the metric, mean cost
+        lines = []
+        for cell in self.cells:
+            values = self.values[cell]
+            mean = f"{np.mean(values):.4g}" if values else "-"
+            lines.append(f"{cell}: {self.iterations(cell)} iterations, mean {mean}, "
+                         f"ci {self.relativeCi(cell):.3f}, cost {self.estimatedCost(cell):.1f} s")
+        return lines
+
+
+def addSchedulerArguments(parser, maxIterations=10):
+    # maxIterations None: the script has its own argument for the maximum number of iterations
+    parser.add_argument("--minIterations", type=int, default=3, help="Iterations of every cell")
+    if maxIterations is not None:
+        parser.add_argument("--maxIterations", type=int, default=maxIterations, help="Maximum iterations per cell")
+    parser.add_argument("--ciTarget", type=float, default=0.05,
+                        help="Stop iterating a cell once the 95%% confidence interval of its metric is narrower "
+                             "than this (half width relative to the mean)")
+    parser.add_argument("--budgetHours", type=float, default=None,
+                        help="Wall-clock budget of the measurement campaign")
+
+
+def schedulerFromArguments(args, cells, size=None, maxIterations=None):
+    budget = args.budgetHours * 3600 if args.budgetHours is not None else None
+    return IterationScheduler(cells, minIterations=args.minIterations, maxIterations=maxIterations or args.maxIterations,
+                              ciTarget=args.ciTarget, budget=budget, size=size)
@@ -0,0 +1,269 @@
+import mmap
+import struct
+import numpy as np
+
+# Reader for pcap and pcapng captures (e.g. tcpdump -s 100 -w file.pcap)
+#
+# The file is memory-mapped and only the record headers are walked in Python, the link, IP and
+# TCP/UDP headers of a batch of packets are then decoded at once with NumPy into a structured
+# array (one row per packet, see packetDtype). Filtering on ports/protocol is done on these
+# arrays, e.g.
+#   packets = pcapReader.readPcap("x_sender.pcap", proto=pcapReader.TCP, srcPorts=[5001])
+#
+# Supported link types: Ethernet (incl. 802.1Q/802.1ad tags), Linux cooked (SLL, SLL2), raw IP
+# and BSD loopback. IPv6 extension headers are not followed.
+
+TCP = 6
+UDP = 17
+
+packetDtype = np.dtype([('time', 'f8'),         # seconds since the epoch
+                        ('caplen', 'u4'),       # captured bytes
+                        ('length', 'u4'),       # bytes on the wire
+                        ('ipVersion', 'u1'),    # 0 for non-IP packets
+                        ('proto', 'u1'),        # IP protocol / IPv6 next header
+                        ('src', 'S16'),         # packed IPv4/IPv6 address
+                        ('dst', 'S16'),
+                        ('ipLen', 'u4'),        # IP packet length incl. IP header
+                        ('srcPort', 'u2'),
+                        ('dstPort', 'u2'),
+                        ('tcpSeq', 'u4'),
+                        ('tcpAck', 'u4'),
+                        ('tcpFlags', 'u1'),
+                        ('payloadLen', 'u4')])  # TCP/UDP payload bytes (from the IP header, not caplen)
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = {101, 12, 14, 228, 229}
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+
+PCAP_MAGIC = {b'\xd4\xc3\xb2\xa1': ('<', 1e-6), b'\xa1\xb2\xc3\xd4': ('>', 1e-6),
+              b'\x4d\x3c\xb2\xa1': ('<', 1e-9), b'\xa1\xb2\x3c\x4d': ('>', 1e-9)}
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+def _pcapRecords(mm, batchSize):
+    # yields (offsets, caplen, length, time, linktype) arrays for batches of records
+    endian, resolution = PCAP_MAGIC[mm[:4]]
+    linktype = struct.unpack_from(endian + 'I', mm, 20)[0] & 0x0FFFFFFF
+    unpackCaplen = struct.Struct(endian + 'I').unpack_from
+    buffer = np.frombuffer(mm, dtype=np.uint8)
+    headerDtype = np.dtype(endian + 'u4')
+    pos = 24
+    size = len(mm)
+    while pos + 16 <= size:
+        # only the caplen is needed to find the next record, the other header fields are read
+        # for the whole batch at once
+        starts = []
+        while pos + 16 <= size and len(starts) < batchSize:
+            starts.append(pos)
+            pos += 16 + unpackCaplen(mm, pos + 8)[0]
+        if pos > size:
+            print("capture is truncated, dropping the last packet")
+            starts.pop()
+        if not starts:
+            return
+        starts = np.array(starts, dtype=np.int64)
+        headers = buffer[starts[:, None] + np.arange(16)].view(headerDtype)
+        yield (starts + 16, headers[:, 2].astype(np.int64), headers[:, 3].astype(np.int64),
+               headers[:, 0] + headers[:, 1] * resolution, np.full(len(starts), linktype))
+
+
+def _pcapngOptions(mm, pos, end, endian):
+    while pos + 4 <= end:
+        code, length = struct.unpack_from(endian + 'HH', mm, pos)
+        if code == 0:
+            return
+        yield code, mm[pos + 4:pos + 4 + length]
+        pos += 4 + (length + 3) // 4 * 4
+
+
+def _pcapngRecords(mm, batchSize):
+    endian = '<'
+    interfaces = []  # (linktype, resolution) per interface of the current section
+    pos = 0
+    size = len(mm)
+    batch = []
+    while pos + 12 <= size:
+        blockType, blockLen = struct.unpack_from(endian + 'II', mm, pos)
+        if blockType == PCAPNG_SHB:
+            # byte order of the whole section is given by the section header
+            endian = '<' if struct.unpack_from('<I', mm, pos + 8)[0] == PCAPNG_BYTE_ORDER_MAGIC else '>'
+            blockLen = struct.unpack_from(endian + 'I', mm, pos + 4)[0]
+            interfaces = []
+        if blockLen < 12 or pos + blockLen > size:
+            print(f"capture is truncated at offset {pos}")
+            break
+
+        if blockType == 1:  # interface description block
+            linktype = struct.unpack_from(endian + 'H', mm, pos + 8)[0]
+            resolution = 1e-6
+            for code, value in _pcapngOptions(mm, pos + 16, pos + blockLen - 4, endian):
+                if code == 9:  # if_tsresol
+                    resolution = 2.0 ** -(value[0] & 0x7F) if value[0] & 0x80 else 10.0 ** -value[0]
+            interfaces.append((linktype, resolution))
+        elif blockType == 6:  # enhanced packet block
+            interface, tsHigh, tsLow, caplen, length = struct.unpack_from(endian + 'IIIII', mm, pos + 8)
+            linktype, resolution = interfaces[interface]
+            batch.append((pos + 28, caplen, length, ((tsHigh << 32) | tsLow) * resolution, linktype))
+        elif blockType == 3:  # simple packet block, no timestamp
+            length = struct.unpack_from(endian + 'I', mm, pos + 8)[0]
+            linktype, _ = interfaces[0]
+            batch.append((pos + 12, min(length, blockLen - 16), length, np.nan, linktype))
+        pos += blockLen
+
+        if len(batch) >= batchSize:
+            yield _recordArrays(batch)
+            batch = []
+    if batch:
+        yield _recordArrays(batch)
+
+
+def _recordArrays(batch):
+    offsets, caplen, length, time, linktype = zip(*batch)
+    return (np.array(offsets, dtype=np.int64), np.array(caplen, dtype=np.int64),
+            np.array(length, dtype=np.int64), np.array(time, dtype=np.float64),
+            np.array(linktype, dtype=np.int64))
+
+
+def _decodeHeaders(buffer, offsets, caplen, length, time, linktype):
+    n = len(offsets)
+    packets = np.zeros(n, dtype=packetDtype)
+    packets['time'] = time
+    packets['caplen'] = caplen
+    packets['length'] = length
+
+    last = len(buffer) - 1
+
+    def u8(idx):
+        # byte idx of every packet, 0 beyond the captured bytes
+        return np.where(idx < caplen, buffer[np.minimum(offsets + idx, last)], 0).astype(np.uint32)
+
+    def be16(idx):
+        return (u8(idx) << 8) | u8(idx + 1)
+
+    def be32(idx):
+        return (be16(idx) << 16) | be16(idx + 2)
+
+    # link layer: offset of the IP header and ethertype (0 where the IP version decides)
+    l3 = np.zeros(n, dtype=np.int64)
+    etherType = np.zeros(n, dtype=np.uint32)
+    ethernet = linktype == LINKTYPE_ETHERNET
+    vlan = ethernet & np.isin(be16(np.full(n, 12)), [0x8100, 0x88A8])
+    etherType[ethernet] = be16(np.where(vlan, 16, 12))[ethernet]
+    l3[ethernet] = np.where(vlan, 18, 14)[ethernet]
+    sll = linktype == LINKTYPE_LINUX_SLL
+    etherType[sll] = be16(np.full(n, 14))[sll]
+    l3[sll] = 16
+    sll2 = linktype == LINKTYPE_LINUX_SLL2
+    etherType[sll2] = be16(np.zeros(n, dtype=np.int64))[sll2]
+    l3[sll2] = 20
+    l3[linktype == LINKTYPE_NULL] = 4
+    linkKnown = ethernet | sll | sll2 | (linktype == LINKTYPE_NULL) | np.isin(linktype, list(LINKTYPE_RAW))
+
+    version = u8(l3) >> 4
+    ipv4 = linkKnown & (l3 + 20 <= caplen) & (version == 4) & np.isin(etherType, [0, 0x0800])
+    ipv6 = linkKnown & (l3 + 40 <= caplen) & (version == 6) & np.isin(etherType, [0, 0x86DD])
+    packets['ipVersion'] = np.where(ipv4, 4, np.where(ipv6, 6, 0))
+
+    proto = np.where(ipv4, u8(l3 + 9), u8(l3 + 6))
+    ipHeaderLen = np.where(ipv4, (u8(l3) & 0x0F) * 4, 40)
+    ipLen = np.where(ipv4, be16(l3 + 2), be16(l3 + 4) + 40)
+    fragment = ipv4 & ((be16(l3 + 6) & 0x1FFF) != 0)
+    ip = ipv4 | ipv6
+    packets['proto'] = np.where(ip, proto, 0)
+    packets['ipLen'] = np.where(ip, ipLen, 0)
+
+    for field, start in (('src', np.where(ipv4, l3 + 12, l3 + 8)), ('dst', np.where(ipv4, l3 + 16, l3 + 24))):
+        address = buffer[np.minimum(offsets[:, None] + start[:, None] + np.arange(16), last)]
+        address[ipv4, 4:] = 0
+        address[~ip] = 0
+        packets[field] = np.ascontiguousarray(address).view('S16').ravel()
+
+    # transport layer, only where the headers were captured
+    l4 = l3 + ipHeaderLen
+    tcp = ip & ~fragment & (proto == TCP) & (l4 + 20 <= caplen)
+    udp = ip & ~fragment & (proto == UDP) & (l4 + 8 <= caplen)
+    transport = tcp | udp
+    packets['srcPort'] = np.where(transport, be16(l4), 0)
+    packets['dstPort'] = np.where(transport, be16(l4 + 2), 0)
+    packets['tcpSeq'] = np.where(tcp, be32(l4 + 4), 0)
+    packets['tcpAck'] = np.where(tcp, be32(l4 + 8), 0)
+    packets['tcpFlags'] = np.where(tcp, u8(l4 + 13), 0)
+    tcpHeaderLen = (u8(l4 + 12) >> 4) * 4
+    payload = np.where(tcp, ipLen.astype(np.int64) - ipHeaderLen - tcpHeaderLen,
+                       be16(l4 + 4).astype(np.int64) - 8)
+    packets['payloadLen'] = np.where(transport, np.maximum(payload, 0), 0)
+    return packets
+
+
+def packetMask(packets, proto=None, ports=None, srcPorts=None, dstPorts=None):
+    # ports matches source or destination port, like tcpdump "port 5001"
+    mask = np.ones(len(packets), dtype=bool)
+    if proto is not None:
+        mask &= packets['proto'] == proto
+    if ports is not None:
+        mask &= np.isin(packets['srcPort'], ports) | np.isin(packets['dstPort'], ports)
+    if srcPorts is not None:
+        mask &= np.isin(packets['srcPort'], srcPorts)
+    if dstPorts is not None:
+        mask &= np.isin(packets['dstPort'], dstPorts)
+    return mask
+
+
+def iterPcap(filename, batchSize=1 << 16, **filters):
+    # yields structured arrays (packetDtype) of up to batchSize packets, see packetMask for filters
+    with open(filename, 'rb') as f:
+        if f.seek(0, 2) == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:4] in PCAP_MAGIC:
+                records = _pcapRecords(mm, batchSize)
+            elif struct.unpack_from('<I', mm, 0)[0] == PCAPNG_SHB:
+                records = _pcapngRecords(mm, batchSize)
+            else:
+                raise ValueError(f"{filename} is neither a pcap nor a pcapng file")
+            buffer = np.frombuffer(mm, dtype=np.uint8)
+            try:
+                for batch in records:
+                    packets = _decodeHeaders(buffer, *batch)
+                    if filters:
+                        packets = packets[packetMask(packets, **filters)]
+                    yield packets
+            finally:
+                # release the exports of mm before it is closed
+                records.close()
+                del buffer
+
+
+def readPcap(filename, batchSize=1 << 16, **filters):
+    batches = list(iterPcap(filename, batchSize, **filters))
+    if not batches:
+        return np.zeros(0, dtype=packetDtype)
+    return np.concatenate(batches)
+
+
+def tcpStreams(packets):
+    # connection index in order of first appearance, same numbering as tshark's tcp.stream
+    # (as long as 4-tuples are not reused)
+    forward = (packets['src'] < packets['dst']) | ((packets['src'] == packets['dst']) & (packets['srcPort'] <= packets['dstPort']))
+    key = np.zeros(len(packets), dtype=[('a', 'S16'), ('b', 'S16'), ('aPort', 'u2'), ('bPort', 'u2')])
+    key['a'] = np.where(forward, packets['src'], packets['dst'])
+    key['b'] = np.where(forward, packets['dst'], packets['src'])
+    key['aPort'] = np.where(forward, packets['srcPort'], packets['dstPort'])
+    key['bPort'] = np.where(forward, packets['dstPort'], packets['srcPort'])
+    _, first, inverse = np.unique(key, return_index=True, return_inverse=True)
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[np.argsort(first)] = np.arange(len(first))
+    return rank[inverse.ravel()]
+
+
+def relativeTcpSeq(packets):
+    # sequence numbers relative to the first packet of each connection and direction, like tshark's
+    # tcp.seq (the SYN has relative sequence number 0)
+    direction = np.zeros(len(packets), dtype=[('src', 'S16'), ('srcPort', 'u2'), ('dst', 'S16'), ('dstPort', 'u2')])
+    for field in direction.dtype.names:
+        direction[field] = packets[field]
+    _, first, inverse = np.unique(direction, return_index=True, return_inverse=True)
+    base = packets['tcpSeq'][first][inverse.ravel()]
+    return (packets['tcpSeq'] - base).astype(np.uint32)
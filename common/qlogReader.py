@@ -0,0 +1,393 @@
+import codecs
+import json
+import mmap
+import os
+import re
+import numpy as np
+
+# Shared reader for picoquic qlog (JSON) and quiche sqlog (JSON-SEQ) files
+#
+# Callers pass the event names (e.g. 'recovery:metrics_updated') and data fields they need.
+# Records are filtered on the raw bytes before any json.loads, so non-matching events are
+# never decoded, and the results are returned as NumPy columns.
+#
+# picoquic qlog: {..., "traces": [{..., "events": [
+#                [time, "category", "event", {data}],        (one event per line)
+#                [time, path_id, "category", "event", {data}] (newer picoquic versions)
+# quiche sqlog:  \u001E{"time": t, "name": "category:event", "data": {data}}\n
+
+RECORD_SEPARATOR = b'\x1e'
+
+eventsStart = re.compile(rb'"events"\s*:\s*\[')
+qlogEventHeader = re.compile(rb'\[\s*(-?[0-9.eE+-]+)\s*,\s*(?:-?\d+\s*,\s*)?"([^"]*)"\s*,\s*"([^"]*)"')
+qlogEnd = re.compile(rb'\]\s*\}\s*\]\s*\}\s*$')
+
+
+def isSqlog(filename):
+    return str(filename).endswith(".sqlog")
+
+
+def _needles(events, sqlog):
+    # byte patterns of which at least one must be in a record before it is decoded,
+    # qlog: "event" (category is a separate array element), sqlog: "category:event"
+    if events is None:
+        return None
+    if sqlog:
+        return [f'"{event}"'.encode() for event in events]
+    return [f'"{event.split(":")[-1]}"'.encode() for event in events]
+
+
+def _matchesBytes(record, needles, require):
+    if needles is not None and not any(needle in record for needle in needles):
+        return False
+    if require is not None and require not in record:
+        return False
+    return True
+
+
+def _headerTime(header):
+    time = header.group(1)
+    return float(time) if b'.' in time or b'e' in time.lower() else int(time)
+
+
+def _splitQlogEvent(event):
+    # [time, category, event, data] or [time, path_id, category, event, data]
+    if len(event) == 5:
+        return event[0], f"{event[2]}:{event[3]}", event[4]
+    return event[0], f"{event[1]}:{event[2]}", event[3] if len(event) > 3 else {}
+
+
+def _iterJsonArray(f, head, chunkSize=1 << 20):
+    # Fallback for qlog files not written with one event per line: decodes the remaining
+    # elements of the events array chunk by chunk, only the current chunk is held in memory
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    separator = re.compile(r'[\s,]*')
+    buffer = utf8.decode(head)
+    pos = 0
+    eof = False
+    while True:
+        pos = separator.match(buffer, pos).end()
+        if pos < len(buffer) and buffer[pos] == ']':
+            return
+        try:
+            if pos == len(buffer):
+                raise ValueError("buffer exhausted")
+            event, end = decoder.raw_decode(buffer, pos)
+        except ValueError:
+            # event is incomplete, continue with the next chunk
+            if eof:
+                if buffer[pos:].strip():
+                    print(f"{f.name} is truncated, stopping at offset {f.tell() - len(buffer) + pos}")
+                return
+            chunk = f.read(chunkSize)
+            eof = not chunk
+            buffer = buffer[pos:] + utf8.decode(chunk, final=eof)
+            pos = 0
+            continue
+        yield event
+        pos = end
+
+
+def _iterQlogRecords(filename, events, decodeData, require):
+    needles = _needles(events, sqlog=False)
+    with open(filename, 'rb') as f:
+        for line in f:
+            match = eventsStart.search(line)
+            if match:
+                line = line[match.end():]
+                break
+        else:
+            return
+
+        while True:
+            record = line.strip().strip(b',').strip()
+            if record:
+                if record[:1] == b']':
+                    return
+                if record[:1] != b'[' or record[-1:] != b']':
+                    # not one event per line, continue with the (slower) generic decoder
+                    for event in _iterJsonArray(f, line):
+                        time, name, data = _splitQlogEvent(event)
+                        if events is None or name in events:
+                            yield time, name, data
+                    return
+
+                if _matchesBytes(record, needles, require):
+                    # event name is checked on the header, only matching events are decoded
+                    header = qlogEventHeader.match(record)
+                    name = f"{header.group(2).decode()}:{header.group(3).decode()}" if header else None
+                    if header is None or events is None or name in events:
+                        if header is not None and not decodeData:
+                            yield _headerTime(header), name, None
+                        else:
+                            try:
+                                time, name, data = _splitQlogEvent(json.loads(record))
+                            except json.JSONDecodeError:
+                                print(f'Skipping malformed JSON event: {record[:100]}...')
+                            else:
+                                if events is None or name in events:
+                                    yield time, name, data
+            line = f.readline()
+            if not line:
+                return
+
+
+def _sqlogRecordBounds(mm, idx):
+    # start and end of the record containing offset idx, records are delimited by RS
+    start = mm.rfind(RECORD_SEPARATOR, 0, idx) + 1
+    end = mm.find(RECORD_SEPARATOR, idx)
+    return start, len(mm) if end < 0 else end
+
+
+def _iterSqlogRecords(filename, events, decodeData, require):
+    # The file is memory-mapped and searched for the event names in place (bytes.find/regex on
+    # the mapping), only the records containing a match are copied and decoded
+    needles = _needles(events, sqlog=True)
+    if needles is not None and not needles:
+        return
+    # search for the required pattern if given (usually rarer than the event name), all records otherwise
+    if require is not None:
+        searchFor = [require]
+    elif needles is not None:
+        searchFor = needles
+    else:
+        searchFor = [RECORD_SEPARATOR]
+    anyPattern = re.compile(b'|'.join(re.escape(pattern) for pattern in searchFor)) if len(searchFor) > 1 else None
+
+    with open(filename, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            return
+        with mm:
+            if hasattr(mm, 'madvise'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            pos = 0
+            while pos < len(mm):
+                if anyPattern is None:
+                    idx = mm.find(searchFor[0], pos)
+                else:
+                    match = anyPattern.search(mm, pos)
+                    idx = match.start() if match else -1
+                if idx < 0:
+                    return
+                if searchFor[0] == RECORD_SEPARATOR:
+                    # all records: record starts after the separator
+                    idx += 1
+                start, end = _sqlogRecordBounds(mm, idx)
+                pos = max(end, idx + 1)
+                record = mm[start:end]
+                if not _matchesBytes(record, needles, require):
+                    continue
+                record = record.strip()
+                if not record:
+                    continue
+                try:
+                    json_seq = json.loads(record)
+                except json.JSONDecodeError:
+                    print(f'Skipping malformed JSON object: {record[:100]}...')
+                    continue
+                name = json_seq.get('name')
+                if name is None or (events is not None and name not in events):
+                    continue
+                yield json_seq.get('time'), name, json_seq.get('data', {})
+
+
+def iterRecords(filename, events=None, decodeData=True, require=None):
+    # Yields (time, name, data) of all events in events (None: all events).
+    # require: additional byte string which must be in the raw record, e.g. b'connection_close'
+    # decodeData=False allows skipping json.loads for qlog files (data is None then)
+    if isSqlog(filename):
+        return _iterSqlogRecords(filename, events, decodeData, require)
+    return _iterQlogRecords(filename, events, decodeData, require)
+
+
+qlogReferenceTime = re.compile(rb'"reference_time"\s*:\s*"?(-?[0-9.]+)')
+qlogTimeUnits = re.compile(rb'"time_units"\s*:\s*"(\w+)"')
+
+
+def readQlogTimeBase(filename, maxHeadBytes=1 << 16):
+    # Returns (reference_time in seconds since the epoch or None, seconds per event time unit)
+    # from the qlog header before the events array. picoquic logs times in microseconds
+    # ("time_units": "us"), the qlog default is milliseconds
+    with open(filename, 'rb') as f:
+        head = f.read(maxHeadBytes)
+    match = eventsStart.search(head)
+    if match is not None:
+        head = head[:match.start()]
+    units = qlogTimeUnits.search(head)
+    unit = 1e-6 if units is not None and units.group(1) == b'us' else 1e-3
+    reference = qlogReferenceTime.search(head)
+    return (float(reference.group(1)) * unit if reference is not None else None), unit
+
+
+def readQlogHeadTail(filename, lastEvents=2, maxTailBytes=1 << 22):
+    # Returns (time of first event, [times of the last lastEvents events]) of a qlog file with one
+    # event per line by reading the head and seeking backwards from the end, the events in between
+    # are not read. Returns None for truncated files or other layouts, use iterRecords then.
+    with open(filename, 'rb') as f:
+        firstTime = None
+        for line in f:
+            match = eventsStart.search(line)
+            if match:
+                line = line[match.end():]
+                while not line.strip():
+                    line = f.readline()
+                    if not line:
+                        return None
+                header = qlogEventHeader.match(line.strip())
+                if header is None:
+                    return None
+                firstTime = _headerTime(header)
+                break
+        if firstTime is None:
+            return None
+
+        size = f.seek(0, os.SEEK_END)
+        tailBytes = 1 << 12
+        while True:
+            start = max(0, size - tailBytes)
+            f.seek(start)
+            tail = f.read(size - start)
+            end = qlogEnd.search(tail)
+            if end is None:
+                # file was not closed properly
+                return None
+            lines = tail[:end.start()].splitlines()
+            if start > 0:
+                # first line is most likely incomplete
+                lines = lines[1:]
+            times = []
+            for line in reversed(lines):
+                record = line.strip().strip(b',').strip()
+                if not record:
+                    continue
+                header = qlogEventHeader.match(record)
+                if header is None or record[-1:] != b']':
+                    break
+                times.append(_headerTime(header))
+                if len(times) == lastEvents:
+                    return firstTime, times[::-1]
+            if start == 0 or tailBytes >= maxTailBytes:
+                return None
+            tailBytes *= 4
+
+
+def findLastSqlogRecord(filename, events, require=None, accept=None, maxTailBytes=1 << 22):
+    # Searches the memory-mapped sqlog file backwards from the end for the last record of events
+    # (which also contains require and for which accept(data) is true), only the last
+    # maxTailBytes are searched.
+    # Returns (time, name, data) or None if there is no such record in the tail
+    needles = _needles(events, sqlog=True)
+    searchFor = require if require is not None else needles[0]
+    with open(filename, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return None
+        with mm:
+            lowerBound = max(0, len(mm) - maxTailBytes)
+            pos = len(mm)
+            while pos > lowerBound:
+                idx = mm.rfind(searchFor, lowerBound, pos)
+                if idx < 0:
+                    return None
+                start, end = _sqlogRecordBounds(mm, idx)
+                pos = start
+                record = mm[start:end]
+                if not _matchesBytes(record, needles, require):
+                    continue
+                try:
+                    json_seq = json.loads(record)
+                except json.JSONDecodeError:
+                    continue
+                if json_seq.get('name') in events and (accept is None or accept(json_seq.get('data', {}))):
+                    return json_seq.get('time'), json_seq.get('name'), json_seq.get('data', {})
+    return None
+
+
+class ColumnBuffer:
+    # Preallocated column which grows by doubling. Starts as int64 and switches
+    # to float64 on the first float or to object dtype on any other value
+    def __init__(self, capacity=1024):
+        self.values = np.zeros(capacity, dtype=np.int64)
+        self.present = np.zeros(capacity, dtype=bool)
+
+    def set(self, row, value):
+        if row >= len(self.values):
+            capacity = max(2 * len(self.values), row + 1)
+            self.values = np.concatenate([self.values, np.zeros(capacity - len(self.values), dtype=self.values.dtype)])
+            self.present = np.concatenate([self.present, np.zeros(capacity - len(self.present), dtype=bool)])
+        if self.values.dtype != object:
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                self.values = self.values.astype(object)
+            elif isinstance(value, float) and self.values.dtype == np.int64:
+                self.values = self.values.astype(np.float64)
+        self.values[row] = value
+        self.present[row] = True
+
+    def toArray(self, rows):
+        values = self.values[:rows]
+        present = self.present[:rows]
+        if present.all():
+            return values
+        if values.dtype == object:
+            values = values.copy()
+            values[~present] = np.nan
+            return values
+        # missing values are NaN, as for pd.concat of rows with missing keys
+        return np.where(present, values, np.nan)
+
+
+def readColumns(filename, events, fields=None, dtypes=None, require=None):
+    # Returns dict of NumPy arrays: 'time', one column per data field (fields=None: all fields
+    # found in the matching events, in order of appearance) and 'event' (index into events)
+    # if more than one event is requested. dtypes optionally maps column -> NumPy dtype
+    times = ColumnBuffer()
+    eventIdx = ColumnBuffer()
+    columns = {} if fields is None else {field: ColumnBuffer() for field in fields}
+    rows = 0
+    for time, name, data in iterRecords(filename, events, decodeData=fields is None or len(fields) > 0,
+                                        require=require):
+        times.set(rows, time)
+        if events is not None and len(events) > 1:
+            eventIdx.set(rows, events.index(name))
+        if data:
+            for key, value in data.items():
+                if key not in columns:
+                    if fields is not None:
+                        continue
+                    columns[key] = ColumnBuffer()
+                columns[key].set(rows, value)
+        rows += 1
+
+    result = {'time': times.toArray(rows)}
+    if events is not None and len(events) > 1:
+        result['event'] = eventIdx.toArray(rows).astype(np.int16)
+    for key, column in columns.items():
+        result[key] = column.toArray(rows)
+    if dtypes:
+        for key, dtype in dtypes.items():
+            if key in result:
+                result[key] = result[key].astype(dtype)
+    return result
+
+
+def readKeyValues(filename, events, fields=None, valueDtype=np.float64, require=None):
+    # Long format: returns dict with 'time', 'key' (object array of field names) and 'value',
+    # one row per (event, field), fields=None: all fields of the matching events
+    times = []
+    keys = []
+    values = []
+    for time, name, data in iterRecords(filename, events, require=require):
+        for key, value in data.items():
+            if fields is not None and key not in fields:
+                continue
+            times.append(time)
+            keys.append(key)
+            values.append(value)
+    return {'time': np.array(times) if times else np.zeros(0, dtype=np.int64),
+            'key': np.array(keys, dtype=object),
+            'value': np.array(values, dtype=valueDtype)}
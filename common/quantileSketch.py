@@ -0,0 +1,151 @@
+import json
+import math
+
+import numpy as np
+
+# Mergeable quantile sketches of metric distributions (DDSketch, Masson et al., VLDB 2019)
+#
+# A sketch counts samples in logarithmic buckets: bucket i holds the positive values in
+# (gamma^(i-1), gamma^i] with gamma = (1 + alpha) / (1 - alpha), negative values are kept the same
+# way by magnitude, zeros separately. Every bucket is represented by 2 * gamma^i / (gamma + 1).
+#
+# Error bound: for alpha = relativeAccuracy, quantile(q) returns a value within alpha * |x| of x,
+# the sample of rank floor(q * (count - 1)) (0-based) of all samples added, i.e. 1% relative error by
+# default, independent of the number of samples and of the order in which they were added. Merging
+# sketches of the same relativeAccuracy is exact (bucket counts are added), so the bound also holds
+# for sketches merged across files and worker processes. count, sum, min and max are exact.
+# Memory is one counter per non-empty bucket: about log(max/min) / log(gamma), e.g. ~1000 buckets
+# for RTTs from 1 us to 1000 s at 1%.
+
+DEFAULT_RELATIVE_ACCURACY = 0.01
+
+
+class QuantileSketch:
+    def __init__(self, relativeAccuracy=DEFAULT_RELATIVE_ACCURACY):
+        self.relativeAccuracy = relativeAccuracy
+        self.gamma = (1 + relativeAccuracy) / (1 - relativeAccuracy)
+        self.logGamma = math.log(self.gamma)
+        self.positive = {}  # bucket index -> count
+        self.negative = {}
+        self.zeros = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _addToBuckets(self, buckets, magnitudes):
+        if len(magnitudes) == 0:
+            return
+        indices, counts = np.unique(np.ceil(np.log(magnitudes) / self.logGamma).astype(np.int64), return_counts=True)
+        for index, count in zip(indices.tolist(), counts.tolist()):
+            buckets[index] = buckets.get(index, 0) + count
+
+    def update(self, values):
+        # adds an array of samples, NaN values are ignored
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return self
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self._addToBuckets(self.positive, values[values > 0])
+        self._addToBuckets(self.negative, -values[values < 0])
+        self.zeros += int(np.count_nonzero(values == 0))
+        return self
+
+    def merge(self, other):
+        if other.relativeAccuracy != self.relativeAccuracy:
+            raise ValueError(f"cannot merge sketches of relative accuracy {self.relativeAccuracy} "
+                             f"and {other.relativeAccuracy}")
+        for buckets, otherBuckets in [(self.positive, other.positive), (self.negative, other.negative)]:
+            for index, count in otherBuckets.items():
+                buckets[index] = buckets.get(index, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def buckets(self):
+        # (representative values, counts) of the non-empty buckets in ascending order of the values,
+        # the values are clipped to [min, max]
+        negative = sorted(self.negative, reverse=True)
+        positive = sorted(self.positive)
+        values = np.concatenate([-self._bucketValues(negative), np.zeros(1 if self.zeros else 0),
+                                 self._bucketValues(positive)])
+        counts = np.array([self.negative[index] for index in negative] + ([self.zeros] if self.zeros else [])
+                          + [self.positive[index] for index in positive], dtype=np.int64)
+        return np.clip(values, self.min, self.max), counts
+
+    def _bucketValues(self, indices):
+        return 2 * np.power(self.gamma, np.array(indices, dtype=np.float64)) / (self.gamma + 1)
+
+    def quantiles(self, qs):
+        # value of the sample of rank floor(q * (count - 1)) for every q, within relativeAccuracy (see above)
+        qs = np.asarray(qs, dtype=np.float64)
+        if self.count == 0:
+            return np.full(qs.shape, np.nan)
+        values, counts = self.buckets()
+        ranks = np.floor(qs * (self.count - 1))
+        return values[np.minimum(np.searchsorted(np.cumsum(counts), ranks, side='right'), len(values) - 1)]
+
+    def quantile(self, q):
+        return float(self.quantiles([q])[0])
+
+    def mean(self):
+        return self.sum / self.count if self.count else math.nan
+
+    def toDict(self):
+        return {"relativeAccuracy": self.relativeAccuracy, "count": self.count, "sum": self.sum,
+                "min": self.min if self.count else None, "max": self.max if self.count else None,
+                "zeros": self.zeros,
+                "positive": [list(self.positive), list(self.positive.values())],
+                "negative": [list(self.negative), list(self.negative.values())]}
+
+    @classmethod
+    def fromDict(cls, data):
+        sketch = cls(data["relativeAccuracy"])
+        sketch.count = data["count"]
+        sketch.sum = data["sum"]
+        if sketch.count:
+            sketch.min, sketch.max = data["min"], data["max"]
+        sketch.zeros = data["zeros"]
+        sketch.positive = dict(zip(*data["positive"]))
+        sketch.negative = dict(zip(*data["negative"]))
+        return sketch
+
+    def __repr__(self):
+        if not self.count:
+            return "QuantileSketch(empty)"
+        return (f"QuantileSketch({self.count} samples, min {self.min:g}, median {self.quantile(0.5):g}, "
+                f"max {self.max:g}, {len(self.positive) + len(self.negative)} buckets)")
+
+
+def mergeSketches(target, sketches):
+    # target, sketches: {group: QuantileSketch}, merges sketches into target (in place)
+    for group, sketch in sketches.items():
+        if group in target:
+            target[group].merge(sketch)
+        else:
+            target[group] = QuantileSketch(sketch.relativeAccuracy).merge(sketch)
+    return target
+
+
+def saveSketches(filename, sketches, groupColumns):
+    # {group tuple: QuantileSketch} as JSON, groups are stored as {column: value}
+    with open(filename, 'w') as f:
+        json.dump({"groupColumns": list(groupColumns),
+                   "sketches": [{**dict(zip(groupColumns, group)), "sketch": sketch.toDict()}
+                                for group, sketch in sketches.items()]}, f)
+
+
+def loadSketches(filename):
+    # returns ({group tuple: QuantileSketch}, groupColumns)
+    with open(filename) as f:
+        data = json.load(f)
+    groupColumns = data["groupColumns"]
+    return ({tuple(entry[column] for column in groupColumns): QuantileSketch.fromDict(entry["sketch"])
+             for entry in data["sketches"]}, groupColumns)
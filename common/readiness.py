@@ -0,0 +1,284 @@
+import collections
+import ctypes
+import glob
+import os
+import re
+import select
+import struct
+import subprocess
+import threading
+import time
+
+import qlogReader
+
+# Readiness checks replacing fixed sleeps in the measurement runners
+#
+# Every wait polls a cheap signal and returns as soon as it is observed: a UDP/TCP port bound
+# (/proc/net/udp, /proc/net/tcp, also inside a network namespace or as text fetched via ssh),
+# a matching line in the output of a process, or result files closed by the writing process
+# (inotify IN_CLOSE_WRITE, polling where inotify is not available).
+# All waits have a timeout, the observed wait times are recorded per label, see printWaitTimes.
+
+waitTimes = collections.defaultdict(list)  # label -> seconds waited
+timeouts = collections.Counter()           # label -> number of timeouts
+
+SOCKET_TABLE_CMD = "cat /proc/net/{proto} /proc/net/{proto}6 2>/dev/null"
+TCP_LISTEN = "0A"
+
+
+def waitFor(check, timeout=30, interval=0.05, label="wait", sleep=time.sleep):
+    # calls check() until it returns a true value, returns that value or the last (false) value
+    # after timeout seconds. sleep(seconds) may return early, e.g. when an event arrives
+    start = time.monotonic()
+    while True:
+        result = check()
+        elapsed = time.monotonic() - start
+        if result or elapsed >= timeout:
+            waitTimes[label].append(elapsed)
+            if not result:
+                timeouts[label] += 1
+                print(f"{label}: not ready after {timeout} s, continuing")
+            return result
+        sleep(min(interval, timeout - elapsed))
+
+
+def waitTimeSummary():
+    return [f"{label}: {len(times)} waits, mean {sum(times) / len(times):.3f} s, max {max(times):.3f} s, "
+            f"total {sum(times):.1f} s, {timeouts[label]} timeouts" for label, times in waitTimes.items()]
+
+
+def printWaitTimes():
+    for line in waitTimeSummary():
+        print(line)
+
+
+def boundPorts(table, listenOnly=False):
+    # local ports in the text of /proc/net/{udp,udp6,tcp,tcp6}, listenOnly: TCP sockets in LISTEN state
+    ports = set()
+    for line in table.splitlines():
+        fields = line.split()
+        if len(fields) < 4 or ':' not in fields[1]:
+            continue  # header
+        if listenOnly and fields[3] != TCP_LISTEN:
+            continue
+        ports.add(int(fields[1].rsplit(':', 1)[1], 16))
+    return ports
+
+
+def readSocketTable(proto="udp", netns=None):
+    # netns: read the table inside this network namespace (ip netns exec needs sudo)
+    if netns is not None:
+        cmd = ["sudo", "ip", "netns", "exec", netns, "sh", "-c", SOCKET_TABLE_CMD.format(proto=proto)]
+        return subprocess.run(cmd, capture_output=True, text=True).stdout
+    table = ""
+    for filename in [f"/proc/net/{proto}", f"/proc/net/{proto}6"]:
+        try:
+            with open(filename) as f:
+                table += f.read()
+        except OSError:
+            pass
+    return table
+
+
+def portBound(port, proto="udp", netns=None):
+    return port in boundPorts(readSocketTable(proto, netns), listenOnly=proto == "tcp")
+
+
+def waitForPort(port, proto="udp", netns=None, timeout=10, label=None):
+    # server is ready as soon as its socket is bound (UDP) or listening (TCP)
+    return waitFor(lambda: portBound(port, proto, netns), timeout=timeout,
+                   label=label or f"{proto} port {port} bound")
+
+
+def waitForPortReleased(port, proto="udp", netns=None, timeout=10, label=None):
+    return waitFor(lambda: not portBound(port, proto, netns), timeout=timeout,
+                   label=label or f"{proto} port {port} released")
+
+
+class LineWatcher:
+    # Reads the lines of a process pipe in a background thread, passes them on to echo (e.g.
+    # sys.stdout or a log file) and lets callers wait for a line matching a regular expression.
+    # The last maxLines lines are kept, so lines printed before wait() are found as well
+    def __init__(self, stream, echo=None, maxLines=10000):
+        self.stream = stream
+        self.echo = echo
+        self.lines = collections.deque(maxlen=maxLines)
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def _read(self):
+        for line in self.stream:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8', errors='replace')
+            if self.echo is not None:
+                self.echo.write(line)
+                self.echo.flush()
+            with self.condition:
+                self.lines.append(line)
+                self.condition.notify_all()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def wait(self, pattern, timeout=10, label=None):
+        # returns the first matching line or None on timeout/end of stream
+        regex = re.compile(pattern)
+        label = label or f"line '{pattern}'"
+        start = time.monotonic()
+        with self.condition:
+            checked = 0
+            while True:
+                lines = list(self.lines)
+                for line in lines[checked:]:
+                    if regex.search(line):
+                        waitTimes[label].append(time.monotonic() - start)
+                        return line
+                checked = len(lines)
+                remaining = timeout - (time.monotonic() - start)
+                if self.closed or remaining <= 0:
+                    waitTimes[label].append(time.monotonic() - start)
+                    timeouts[label] += 1
+                    print(f"{label}: not found after {time.monotonic() - start:.1f} s, continuing")
+                    return None
+                self.condition.wait(remaining)
+
+
+def filesOpenForWriting(directory):
+    # paths in directory which are open for writing by any process we are allowed to inspect
+    # (processes of other users, e.g. started with sudo, are not visible)
+    directory = os.path.abspath(directory) + os.sep
+    paths = set()
+    for fd in glob.glob("/proc/[0-9]*/fd/*"):
+        try:
+            target = os.readlink(fd)
+        except OSError:
+            continue
+        if not target.startswith(directory):
+            continue
+        try:
+            with open(fd.replace("/fd/", "/fdinfo/")) as f:
+                flags = int(re.search(r'flags:\s*([0-7]+)', f.read()).group(1), 8)
+        except (OSError, AttributeError):
+            paths.add(target)
+            continue
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            paths.add(target)
+    return paths
+
+
+def qlogComplete(path):
+    # picoquic qlog files are complete once the JSON document is closed
+    try:
+        with open(path, 'rb') as f:
+            f.seek(max(0, os.path.getsize(path) - 64))
+            return qlogReader.qlogEnd.search(f.read()) is not None
+    except OSError:
+        return False
+
+
+class InotifyWatcher:
+    # Minimal inotify binding (Linux, via ctypes): names of the files in a directory which were
+    # closed after writing or moved into it. create() returns None where inotify is not available
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    eventHeader = struct.Struct("iIII")  # wd, mask, cookie, len (of the name)
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.closeWritten = set()
+
+    @classmethod
+    def create(cls, directory, mask=IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE):
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(cls.IN_NONBLOCK | cls.IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+            os.close(fd)
+            return None
+        return cls(fd)
+
+    def wait(self, timeout):
+        # blocks until events arrive or timeout seconds have passed, returns the names of files
+        # closed after writing or moved into the directory (also collected in closeWritten)
+        names = []
+        if not select.select([self.fd], [], [], max(0, timeout))[0]:
+            return names
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset + self.eventHeader.size <= len(data):
+            wd, mask, cookie, length = self.eventHeader.unpack_from(data, offset)
+            offset += self.eventHeader.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                names.append(name)
+        self.closeWritten.update(names)
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def waitForFilesClosed(pattern, timeout=60, settle=0.5, interval=0.2, label=None, useInotify=True):
+    # Waits until files matching pattern exist and are closed: not open for writing by any visible
+    # process and either closed after writing (inotify IN_CLOSE_WRITE, seen for all writers), a
+    # complete qlog or unchanged for settle seconds (for files closed before the wait started, or
+    # without inotify: writers we cannot see and sqlog files, which have no end marker).
+    # With inotify, the wait blocks until the next event instead of polling every interval seconds.
+    # Returns the sorted paths or [] on timeout
+    directory = os.path.dirname(pattern) or "."
+    watcher = None
+    if useInotify and not glob.has_magic(directory) and os.path.isdir(directory):
+        # watch before the first check, a file closed in between is not missed
+        watcher = InotifyWatcher.create(directory)
+    if watcher is None:
+        return _waitForFilesClosed(pattern, timeout, settle, interval, label, closeWritten=set())
+    with watcher:
+        # woken up by events, otherwise only to check the settle time of files without event
+        return _waitForFilesClosed(pattern, timeout, settle, settle, label, closeWritten=watcher.closeWritten,
+                                   sleep=watcher.wait)
+
+
+def _waitForFilesClosed(pattern, timeout, settle, interval, label, closeWritten, sleep=time.sleep):
+    lastChange = {}
+
+    def closed():
+        paths = sorted(glob.glob(pattern))
+        if not paths:
+            return []
+        writers = filesOpenForWriting(os.path.dirname(os.path.abspath(paths[0])))
+        now = time.monotonic()
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return []
+            if lastChange.get(path, (None,))[0] != (stat.st_size, stat.st_mtime_ns):
+                lastChange[path] = ((stat.st_size, stat.st_mtime_ns), now)
+            if os.path.abspath(path) in writers:
+                return []
+            if os.path.basename(path) in closeWritten:
+                continue
+            if not (path.endswith(".qlog") and qlogComplete(path)) and now - lastChange[path][1] < settle:
+                return []
+        return paths
+
+    return waitFor(closed, timeout=timeout, interval=interval, label=label or f"{pattern} closed", sleep=sleep)
@@ -0,0 +1,232 @@
+import atexit
+import collections
+import contextlib
+import cProfile
+import json
+import os
+import platform
+import re
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+import readiness
+
+# Opt-in timing and profiling of the stages of the measurement and evaluation scripts
+#
+# Scripts wrap their stages (measurements, evaluation, plotting, ...) in stage(name). Per stage, the
+# wall-clock time, the CPU time of this process (all threads) and of its terminated child processes
+# and the peak RSS are recorded. Optionally, every stage is profiled with cProfile (--cprofile, one
+# .prof file per stage, main thread only, nested stages are part of the outer profile) and the
+# Python allocations are traced (--tracemalloc, peak per stage and a snapshot dump, slows down
+# Python code considerably).
+# Runners additionally account where the measurement time goes with overhead(category): sleeps,
+# SSH round trips, server start-up and stop, transfers, artefact transfer, packet capture start-up
+# and netem (tc) setup, see the constants below. Categories nested within a thread count
+# exclusively (a sleep within a server start counts as sleep only), times of concurrent threads
+# add up. The wait times of readiness are reported as well.
+# One JSON report per invocation (profile_<script>_<date>.json in --profileDir), written at exit.
+# Without --profile, stage() and overhead() do nothing.
+
+SLEEP = "sleep"
+SSH = "ssh"
+SERVER_START = "serverStart"
+SERVER_STOP = "serverStop"
+TRANSFER = "transfer"
+ARTEFACT_TRANSFER = "artefactTransfer"
+CAPTURE_START = "captureStart"  # starting tcpdump until it captures
+NETEM_SETUP = "netemSetup"  # configuring netem/tc qdiscs between runs
+
+
+def _childCpuSeconds():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _maxRssMB(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+class StageProfiler:
+    def __init__(self, script, reportDir=".", cprofile=False, tracemallocTop=0, enabled=True):
+        # tracemallocTop: trace Python allocations, the largest allocation sites per stage are reported
+        self.script = script
+        self.reportDir = reportDir
+        self.cprofile = cprofile
+        self.tracemallocTop = tracemallocTop
+        self.enabled = enabled
+        self.date = datetime.now()
+        self.start = time.perf_counter()
+        self.stages = []
+        self.stack = []
+        self.activeProfile = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.overheads = collections.defaultdict(lambda: {"count": 0, "seconds": 0.0, "maxSeconds": 0.0})
+        self.closed = False
+        if enabled:
+            os.makedirs(reportDir, exist_ok=True)
+        if enabled and tracemallocTop and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _filename(self, suffix):
+        name = f"profile_{self.script}_{self.date.strftime('%Y%m%d-%H%M%S')}{suffix}"
+        return os.path.join(self.reportDir, name)
+
+    def _overheadTotals(self):
+        with self.lock:
+            return {category: value["seconds"] for category, value in self.overheads.items()}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        path = "/".join(self.stack + [name])
+        self.stack.append(name)
+        record = {"name": path, "startSeconds": time.perf_counter() - self.start}
+        overheadsBefore = self._overheadTotals()
+        profile = None
+        if self.cprofile and self.activeProfile is None:
+            profile = self.activeProfile = cProfile.Profile()
+        if self.tracemallocTop:
+            tracemalloc.reset_peak()
+            tracedBefore = tracemalloc.get_traced_memory()[0]
+        wallStart, cpuStart, childCpuStart = time.perf_counter(), time.process_time(), _childCpuSeconds()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        except BaseException as e:
+            record["error"] = type(e).__name__
+            raise
+        finally:
+            if profile is not None:
+                profile.disable()
+                self.activeProfile = None
+            record["wallSeconds"] = time.perf_counter() - wallStart
+            record["cpuSeconds"] = time.process_time() - cpuStart
+            record["childCpuSeconds"] = _childCpuSeconds() - childCpuStart
+            record["peakRssMB"] = _maxRssMB()
+            record["childPeakRssMB"] = _maxRssMB(resource.RUSAGE_CHILDREN)
+            overheads = self._overheadTotals()
+            record["overheads"] = {category: seconds - overheadsBefore.get(category, 0.0)
+                                   for category, seconds in overheads.items()
+                                   if seconds > overheadsBefore.get(category, 0.0)}
+            suffix = "." + re.sub(r'[^A-Za-z0-9_.-]+', '_', path)
+            if profile is not None:
+                record["cprofile"] = self._filename(suffix + ".prof")
+                profile.dump_stats(record["cprofile"])
+            if self.tracemallocTop:
+                current, peak = tracemalloc.get_traced_memory()
+                record["tracemallocPeakMB"] = (peak - tracedBefore) / 1e6
+                record["tracemallocRetainedMB"] = (current - tracedBefore) / 1e6
+                # largest allocation sites alive at the end of the stage, without those of the profilers
+                snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, cProfile.__file__),
+                                                                      tracemalloc.Filter(False, tracemalloc.__file__)])
+                record["tracemalloc"] = self._filename(suffix + ".tracemalloc")
+                snapshot.dump(record["tracemalloc"])
+                record["topAllocations"] = [f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}: "
+                                            f"{stat.size / 1e6:.1f} MB in {stat.count} blocks"
+                                            for stat in snapshot.statistics("lineno")[:self.tracemallocTop]]
+            self.stack.pop()
+            self.stages.append(record)
+            print(f"StageProfiler: {self.formatStage(record)}")
+
+    @contextlib.contextmanager
+    def overhead(self, category):
+        if not self.enabled:
+            yield
+            return
+        # per thread stack of [category, seconds of nested categories]
+        stack = self.local.__dict__.setdefault("stack", [])
+        entry = [category, 0.0]
+        stack.append(entry)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            if stack:
+                stack[-1][1] += elapsed
+            with self.lock:
+                value = self.overheads[category]
+                value["count"] += 1
+                value["seconds"] += elapsed - entry[1]
+                value["maxSeconds"] = max(value["maxSeconds"], elapsed)
+
+    def sleep(self, seconds):
+        with self.overhead(SLEEP):
+            time.sleep(seconds)
+
+    @staticmethod
+    def formatStage(record):
+        line = (f"{record['name']}: {record['wallSeconds']:.3f} s wall, {record['cpuSeconds']:.3f} s CPU, "
+                f"{record['childCpuSeconds']:.3f} s CPU of child processes, peak RSS {record['peakRssMB']:.1f} MB")
+        if record["overheads"]:
+            line += ", " + ", ".join(f"{category} {seconds:.1f} s" for category, seconds in record["overheads"].items())
+        return line
+
+    def report(self):
+        waits = {label: {"count": len(times), "seconds": sum(times), "maxSeconds": max(times),
+                         "timeouts": readiness.timeouts[label]}
+                 for label, times in readiness.waitTimes.items()}
+        with self.lock:
+            overheads = {category: dict(value) for category, value in self.overheads.items()}
+        return {"script": self.script, "argv": sys.argv, "start": self.date.isoformat(timespec="seconds"),
+                "end": datetime.now().isoformat(timespec="seconds"),
+                "machine": {"node": platform.node(), "python": platform.python_version(), "cpus": os.cpu_count()},
+                "wallSeconds": time.perf_counter() - self.start, "cpuSeconds": time.process_time(),
+                "childCpuSeconds": _childCpuSeconds(), "peakRssMB": _maxRssMB(),
+                "childPeakRssMB": _maxRssMB(resource.RUSAGE_CHILDREN),
+                "stages": self.stages, "overheads": overheads, "waits": waits}
+
+    def close(self):
+        # writes the report, returns its filename (None if disabled or already written)
+        if not self.enabled or self.closed:
+            return None
+        self.closed = True
+        filename = self._filename(".json")
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        print(f"StageProfiler: report written to {filename}")
+        return filename
+
+
+# profiler of this invocation, used by the module-level functions below
+current = StageProfiler("disabled", enabled=False)
+
+
+def stage(name):
+    return current.stage(name)
+
+
+def overhead(category):
+    return current.overhead(category)
+
+
+def sleep(seconds):
+    current.sleep(seconds)
+
+
+def addProfilerArguments(parser):
+    parser.add_argument("--profile", action='store_true',
+                        help="Record wall-clock time, CPU time and peak memory per stage in a JSON report")
+    parser.add_argument("--profileDir", type=str, default=".", help="Directory of the --profile reports")
+    parser.add_argument("--cprofile", action='store_true', help="--profile: cProfile dump per stage")
+    parser.add_argument("--tracemalloc", type=int, nargs='?', const=10, default=0, metavar="TOP",
+                        help="--profile: trace Python allocations, report the TOP allocation sites per stage")
+
+
+def profilerFromArguments(args, script=None):
+    # sets the profiler of this invocation, the report is written at exit
+    global current
+    script = script or os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    current = StageProfiler(script, args.profileDir, args.cprofile, args.tracemalloc, enabled=args.profile)
+    atexit.register(current.close)
+    return current
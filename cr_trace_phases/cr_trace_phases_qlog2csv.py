@@ -1,8 +1,18 @@
 import argparse
 import json
+import os
+import sys
 import numpy as np
 import pandas as pd
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+import qlogReader
+
+
+# from picoquic/cc_common.h
+crPhases = {0: "Observe", 1: "Recon", 2: "Unval", 3: "Validate", 4: "Retreat", 100: "Normal"}
+crTriggers = {0: "packet_loss", 1: "cwnd_limited", 2: "cr_mark_ack", 3: "rtt_not_val", 4: "ECN_CE", 5: "exit_recovery"}
+
 
 def evalSingleFile(filename):
     with open(filename, 'r') as json_file_read:
@@ -40,24 +50,44 @@ def evalSingleFile(filename):
 
     df.insert(0,'filename', filename)
 
-    # from picoquic/cc_common.h
     for dfOldNew in ['old', 'new']:
-        df[dfOldNew].replace(0, "Observe", inplace=True)
-        df[dfOldNew].replace(1, "Recon", inplace=True)
-        df[dfOldNew].replace(2, "Unval", inplace=True)
-        df[dfOldNew].replace(3, "Validate", inplace=True)
-        df[dfOldNew].replace(4, "Retreat", inplace=True)
-        df[dfOldNew].replace(100, "Normal", inplace=True)
+        df[dfOldNew] = df[dfOldNew].replace(crPhases)
     if 'trigger' in df.columns:
-        df['trigger'].replace(0, "packet_loss", inplace=True)
-        df['trigger'].replace(1, "cwnd_limited", inplace=True)
-        df['trigger'].replace(2, "cr_mark_ack", inplace=True)
-        df['trigger'].replace(3, "rtt_not_val", inplace=True)
-        df['trigger'].replace(4, "ECN_CE", inplace=True)
-        df['trigger'].replace(5, "exit_recovery", inplace=True)
+        df['trigger'] = df['trigger'].replace(crTriggers)
     return df
 
 
+def decodeEnum(values, mapping):
+    # Vectorized replacement of known codes by their names, unknown values are kept as they are
+    if values.dtype == object:
+        return np.array([mapping.get(v, v) for v in values], dtype=object)
+    codes = np.array(sorted(mapping), dtype=values.dtype)
+    names = np.array([mapping[code] for code in codes], dtype=object)
+    idx = np.clip(np.searchsorted(codes, values), 0, len(codes) - 1)
+    known = codes[idx] == values
+    decoded = values.astype(object)
+    decoded[known] = names[idx[known]]
+    return decoded
+
+
+def evalSingleFileStreaming(filename):
+    # Same output as evalSingleFile, but qlog is parsed incrementally and
+    # cr_phase rows are collected column-wise, DataFrame is created once
+    data = qlogReader.readColumns(filename, ['recovery:cr_phase'])
+    rows = len(data.pop('time'))
+    if rows == 0:
+        return pd.DataFrame()
+
+    data = {'filename': np.full(rows, filename, dtype=object), **data}
+
+    for dfOldNew in ['old', 'new']:
+        if dfOldNew in data:
+            data[dfOldNew] = decodeEnum(data[dfOldNew], crPhases)
+    if 'trigger' in data:
+        data['trigger'] = decodeEnum(data['trigger'], crTriggers)
+    return pd.DataFrame(data)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Extract CR data from qlog files.')
     parser.add_argument(
@@ -65,16 +95,24 @@ if __name__ == "__main__":
         nargs='+',
         type=str,
         help='List of qlog files to process')
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help='Parse qlog files incrementally (for large files)')
     args = parser.parse_args()
 
-    df = pd.DataFrame()
+    dfs = []
     for file in args.files:
-        df_temp = evalSingleFile(file)
+        if args.stream:
+            df_temp = evalSingleFileStreaming(file)
+        else:
+            df_temp = evalSingleFile(file)
         if df_temp.empty:
             print(f"file {file} does not have cr_phase")
         else:
-            df = pd.concat([df, df_temp])
+            dfs.append(df_temp)
 
+    df = pd.concat(dfs) if dfs else pd.DataFrame()
     print(df)
     df.to_csv("cr.csv")
 
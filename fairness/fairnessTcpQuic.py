@@ -1,7 +1,9 @@
 import argparse
+import os
 import subprocess
-import time
+import sys
 import socket
+import numpy as np
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
@@ -12,6 +14,12 @@ matplotlib.rcParams['ps.fonttype'] = 42
 
 sns.set_theme()
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+import pcapReader
+import qlogReader
+import readiness
+import stageProfiler
+
 
 ### Run fairness / competing traffic tests
 #
@@ -51,53 +59,78 @@ def runMeas(scenario):
         setupName = f"fairnessTcpQuic_{opKey}_{scenario}"
         print(f"Starting {setupName}")
 
-        #start tcpdump
-        subprocess.Popen(f"sudo tcpdump -i {localEth} -s 100 -w {setupName}_sender.pcap tcp port 5001 or udp port 4443".split())
-        subprocess.Popen(ssh.split() + [f"sudo tcpdump -i {remoteEth} -s 100 -w {setupName}_receiver.pcap tcp port 5001 or udp port 4443"])
-        time.sleep(1)
+        #start tcpdump, capturing has started once it prints "listening on ..." to stderr
+        with stageProfiler.overhead(stageProfiler.CAPTURE_START):
+            localTcpdump = subprocess.Popen(f"sudo tcpdump -i {localEth} -s 100 -w {setupName}_sender.pcap tcp port 5001 or udp port 4443".split(),
+                                            stderr=subprocess.PIPE, text=True)
+            remoteTcpdump = subprocess.Popen(ssh.split() + [f"sudo tcpdump -i {remoteEth} -s 100 -w {setupName}_receiver.pcap tcp port 5001 or udp port 4443"],
+                                             stderr=subprocess.PIPE, text=True)
+            readiness.LineWatcher(localTcpdump.stderr, echo=sys.stderr).wait(r"listening on", timeout=10, label="local tcpdump ready")
+            readiness.LineWatcher(remoteTcpdump.stderr, echo=sys.stderr).wait(r"listening on", timeout=10, label="remote tcpdump ready")
 
         #start servers
-        subprocess.Popen(f"iperf -s -i 0.5 --enhanced --reportstyle C --output {setupName}_iperf-sender.csv", shell=True)
-
-        subprocess.run("rm -rf picoquic/temp_qlog && mkdir picoquic/temp_qlog", shell=True)
-        subprocess.Popen(f"cd picoquic && ./picoquicdemo -q temp_qlog -G cubic -1", shell=True)
-        time.sleep(1)
-
-        #run clients
-        if scenario == "tcpThenQuic":
-            subprocess.Popen(ssh.split() + [f"iperf -c {serverIp} -i 0.5 --enhanced --reportstyle C --reverse --time 100 --output {setupName}_iperf-receiver.csv"])
-            time.sleep(50)
-            subprocess.run(ssh.split() + [f"picoquic/picoquicdemo -n xyz -G cubic {serverIp} 4443 /450000000"])
-        elif scenario == "quicThenTcp":
-            subprocess.Popen(ssh.split() + [f"picoquic/picoquicdemo -n xyz -G cubic {serverIp} 4443 /450000000"])
-            time.sleep(50)
-            subprocess.run(ssh.split() + [f"iperf -c {serverIp} -i 0.5 --enhanced --reportstyle C --reverse --time 100 --output {setupName}_iperf-receiver.csv"])
-        else:
-            assert False, "wrong setup"
+        with stageProfiler.overhead(stageProfiler.SERVER_START):
+            subprocess.Popen(f"iperf -s -i 0.5 --enhanced --reportstyle C --output {setupName}_iperf-sender.csv", shell=True)
+
+            subprocess.run("rm -rf picoquic/temp_qlog && mkdir picoquic/temp_qlog", shell=True)
+            subprocess.Popen(f"cd picoquic && ./picoquicdemo -q temp_qlog -G cubic -1", shell=True)
+            readiness.waitForPort(5001, proto="tcp", timeout=10, label="iperf server ready")
+            readiness.waitForPort(4443, proto="udp", timeout=10, label="picoquic server ready")
+
+        #run clients, the first flow runs alone during the sleep
+        with stageProfiler.overhead(stageProfiler.TRANSFER):
+            if scenario == "tcpThenQuic":
+                subprocess.Popen(ssh.split() + [f"iperf -c {serverIp} -i 0.5 --enhanced --reportstyle C --reverse --time 100 --output {setupName}_iperf-receiver.csv"])
+                stageProfiler.sleep(50)
+                subprocess.run(ssh.split() + [f"picoquic/picoquicdemo -n xyz -G cubic {serverIp} 4443 /450000000"])
+            elif scenario == "quicThenTcp":
+                subprocess.Popen(ssh.split() + [f"picoquic/picoquicdemo -n xyz -G cubic {serverIp} 4443 /450000000"])
+                stageProfiler.sleep(50)
+                subprocess.run(ssh.split() + [f"iperf -c {serverIp} -i 0.5 --enhanced --reportstyle C --reverse --time 100 --output {setupName}_iperf-receiver.csv"])
+            else:
+                assert False, "wrong setup"
 
         #kill tcpdump
-        time.sleep(30)
-        subprocess.run("sudo pkill iperf".split())
-        subprocess.run("sudo pkill tcpdump".split())
-        subprocess.run(ssh.split() + ["sudo pkill tcpdump"])
-        time.sleep(1)
-
-        subprocess.run(f"mv picoquic/temp_qlog/*.qlog {setupName}.qlog", shell=True)
-        subprocess.run(f"scp {operators[opKey]['sshLogin']}:~/fairnessTcpQuic_* .", shell=True)
-        subprocess.run(ssh.split() + ["rm -f fairnessTcpQuic_*"])
+        stageProfiler.sleep(30)
+        with stageProfiler.overhead(stageProfiler.SERVER_STOP):
+            subprocess.run("sudo pkill iperf".split())
+            subprocess.run("sudo pkill tcpdump".split())
+        with stageProfiler.overhead(stageProfiler.SSH):
+            subprocess.run(ssh.split() + ["sudo pkill tcpdump"])
+        for name, tcpdump in [("local", localTcpdump), ("remote", remoteTcpdump)]:
+            try:
+                tcpdump.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                # like the readiness waits, report and continue with the next scenario
+                print(f"{name} tcpdump not exited after 10 s, killing it")
+                tcpdump.kill()
+                tcpdump.wait()
+
+        readiness.waitForFilesClosed("picoquic/temp_qlog/*.qlog", timeout=30, label="server qlog closed")
+        with stageProfiler.overhead(stageProfiler.ARTEFACT_TRANSFER):
+            subprocess.run(f"mv picoquic/temp_qlog/*.qlog {setupName}.qlog", shell=True)
+            subprocess.run(f"scp {operators[opKey]['sshLogin']}:~/fairnessTcpQuic_* .", shell=True)
+        with stageProfiler.overhead(stageProfiler.SSH):
+            subprocess.run(ssh.split() + ["rm -f fairnessTcpQuic_*"])
 
         print(f"Finished {setupName}\n\n\n\n\n")
+    readiness.printWaitTimes()
 
 
 def eval(setupName):
     print(f"\n\n\nRunning {setupName}\n\n\n")
 
-    if True:
-        subprocess.run(f"echo \"time,conv,seq\" > {setupName}_sender_tcptrace.csv", shell=True)
-        subprocess.run(f"tshark -r {setupName}_sender.pcap -Y \"tcp.srcport == 5001\" -T fields -e frame.time_relative -e tcp.stream -e tcp.seq -E separator=, >> {setupName}_sender_tcptrace.csv", shell=True)
-
-    dfSeq = pd.read_csv(f"{setupName}_sender_tcptrace.csv")
-    dfSeq["seq"] /= 1000000 # seq number in Mbyte
+    # time, stream and relative seq number of the iperf data packets, as tshark's
+    # frame.time_relative, tcp.stream and tcp.seq (time relative to the first packet in the capture)
+    packets = pcapReader.readPcap(f"{setupName}_sender.pcap", ports=[5001, 4443])
+    startTime = packets['time'][0] if len(packets) else 0
+    tcpPackets = packets[pcapReader.packetMask(packets, proto=pcapReader.TCP, ports=[5001])]
+    streams = pcapReader.tcpStreams(tcpPackets)
+    seq = pcapReader.relativeTcpSeq(tcpPackets)
+    sender = tcpPackets['srcPort'] == 5001
+    dfSeq = pd.DataFrame({"time": tcpPackets['time'][sender] - startTime,
+                          "conv": streams[sender],
+                          "seq": seq[sender] / 1000000})  # seq number in Mbyte
 
     # https://sourceforge.net/p/iperf2/code/ci/master/tree/src/ReportOutputs.c
     csvRxHeader = ["date", "destIp", "destPort", "srcIp", "srcPort", "transferID",
@@ -152,23 +185,175 @@ def eval(setupName):
 
 
 
+def newBytes(times, streams, ends):
+    # bytes beyond the highest offset sent so far on each stream, i.e. without retransmissions
+    order = np.lexsort((times, streams))
+    sortedStreams = streams[order]
+    sortedEnds = ends[order].astype(np.int64)
+    newEnds = np.empty_like(sortedEnds)
+    starts = np.flatnonzero(np.r_[True, sortedStreams[1:] != sortedStreams[:-1]])
+    for start, end in zip(starts, np.r_[starts[1:], len(sortedEnds)]):
+        highest = np.maximum.accumulate(sortedEnds[start:end])
+        newEnds[start:end] = np.diff(highest, prepend=0)
+    result = np.empty_like(newEnds)
+    result[order] = newEnds
+    return result
+
+
+def readTcpGoodput(packets):
+    # (time, new payload bytes) of the iperf data packets (server port 5001)
+    tcpPackets = packets[pcapReader.packetMask(packets, proto=pcapReader.TCP, srcPorts=[5001])]
+    streams = pcapReader.tcpStreams(tcpPackets)
+    ends = pcapReader.relativeTcpSeq(tcpPackets).astype(np.int64) + tcpPackets['payloadLen']
+    return tcpPackets['time'], newBytes(tcpPackets['time'], streams, ends)
+
+
+def readQuicGoodput(qlogFile, packets):
+    # (time, new stream bytes) of the STREAM frames in picoquic packet_sent events. Times are
+    # aligned with the capture via the qlog reference_time (same host clock), or via the first
+    # QUIC packet in the capture if the qlog has no reference time
+    times = []
+    streams = []
+    ends = []
+    for time, name, data in qlogReader.iterRecords(qlogFile, ['transport:packet_sent'], require=b'"stream"'):
+        for frame in data.get('frames', []):
+            if frame.get('frame_type') == 'stream':
+                times.append(time)
+                streams.append(frame.get('id', 0))
+                ends.append(frame.get('offset', 0) + frame.get('length', 0))
+    times = np.array(times, dtype=np.float64)
+    referenceTime, unit = qlogReader.readQlogTimeBase(qlogFile)
+    times *= unit
+    if referenceTime is not None:
+        times += referenceTime
+    else:
+        udpPackets = packets[pcapReader.packetMask(packets, proto=pcapReader.UDP, srcPorts=[4443])]
+        if len(times) and len(udpPackets):
+            times += udpPackets['time'][0] - times[0]
+    return times, newBytes(times, np.array(streams, dtype=np.int64), np.array(ends, dtype=np.int64))
+
+
+def jainIndex(throughput):
+    # Jain's fairness index per row of throughput (windows x flows), NaN where nothing was sent
+    total = throughput.sum(axis=1)
+    squares = (throughput ** 2).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(squares > 0, total ** 2 / (throughput.shape[1] * squares), np.nan)
+
+
+def convergenceTime(windowStart, jain, secondStart, threshold=0.9, holdWindows=10):
+    # time from the start of the second flow until the first window from which the Jain index
+    # stays >= threshold for holdWindows windows, NaN if it never converges
+    after = windowStart >= secondStart
+    fair = np.where(after, np.nan_to_num(jain) >= threshold, False)
+    if len(fair) < holdWindows:
+        return np.nan
+    held = np.lib.stride_tricks.sliding_window_view(fair, holdWindows).all(axis=1)
+    idx = np.flatnonzero(held)
+    return windowStart[idx[0]] - secondStart if len(idx) else np.nan
+
+
+def evalFairness(setupName, binWidth=0.5, threshold=0.9, holdTime=5):
+    # goodput of the TCP (pcap) and QUIC (qlog) flow in common time windows, throughput share,
+    # Jain's fairness index and convergence time after the second flow started
+    if not os.path.exists(f"{setupName}_sender.pcap") or not os.path.exists(f"{setupName}.qlog"):
+        print(f"Missing capture or qlog of {setupName}")
+        return None
+    packets = pcapReader.readPcap(f"{setupName}_sender.pcap", ports=[5001, 4443])
+    if len(packets) == 0:
+        print(f"No packets in {setupName}_sender.pcap")
+        return None
+    startTime = packets['time'][0]
+
+    flows = {"TCP": readTcpGoodput(packets), "QUIC": readQuicGoodput(f"{setupName}.qlog", packets)}
+    end = max((times.max() for times, _ in flows.values() if len(times)), default=startTime) - startTime
+    edges = np.arange(0, end + binWidth, binWidth)
+    throughput = np.stack([np.histogram(times - startTime, bins=edges, weights=sizes)[0] * 8 / binWidth / 1e6
+                           for times, sizes in flows.values()], axis=1)  # Mbit/s
+
+    df = pd.DataFrame(throughput, columns=[f"goodput{flow}" for flow in flows])
+    df.insert(0, "time", edges[:-1])
+    total = throughput.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df["shareTCP"] = np.where(total > 0, throughput[:, 0] / total, np.nan)
+    df["jain"] = jainIndex(throughput)
+    df.to_csv(f"{setupName}_fairness.csv", index=False)
+
+    firstByte = [times.min() - startTime if len(times) else np.nan for times, _ in flows.values()]
+    lastByte = [times.max() - startTime if len(times) else np.nan for times, _ in flows.values()]
+    secondStart = max(firstByte)
+    overlap = (df["time"] >= secondStart) & (df["time"] + binWidth <= min(lastByte))
+    summary = {"setup": setupName,
+               "startTCP": float(firstByte[0]),
+               "startQUIC": float(firstByte[1]),
+               "convergenceTime": float(convergenceTime(edges[:-1], df["jain"].to_numpy(), secondStart,
+                                                        threshold, int(round(holdTime / binWidth)))),
+               "meanJain": float(df.loc[overlap, "jain"].mean()),
+               "meanShareTCP": float(df.loc[overlap, "shareTCP"].mean())}
+    print(summary)
+
+    font_size = 10
+    fig, axes = plt.subplots(3, 1, figsize=(4, 7), sharex=True)
+    for flow in flows:
+        axes[0].plot(df["time"], df[f"goodput{flow}"], label=flow)
+    axes[0].set_ylabel('Goodput [Mbit/s]', fontsize=font_size)
+    axes[0].legend()
+    axes[1].plot(df["time"], df["shareTCP"])
+    axes[1].set_ylabel('TCP share', fontsize=font_size)
+    axes[1].set_ylim(0, 1)
+    axes[2].plot(df["time"], df["jain"])
+    axes[2].axhline(threshold, color='gray', linestyle='--')
+    if not np.isnan(summary["convergenceTime"]):
+        axes[2].axvline(secondStart + summary["convergenceTime"], color='gray')
+    axes[2].set_ylabel("Jain's fairness index", fontsize=font_size)
+    axes[2].set_ylim(0.4, 1.05)
+    axes[2].set_xlabel("Time [s]", fontsize=font_size)
+    for axis in axes:
+        axis.set_xlim(0, 150)
+    fig.suptitle(f"{setupName}", fontsize=font_size)
+    fig.tight_layout()
+    plt.savefig(f"{setupName}_fairness", dpi=600)
+    plt.close(fig)
+
+    return summary
+
+
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--runMeas', action='store_true', default=False, help='runMeas')
     parser.add_argument('--eval', action='store_true', default=False, help='runMeas')
+    parser.add_argument('--evalFairness', action='store_true', default=False,
+                        help='Goodput share and Jain fairness index of the TCP and QUIC flow')
+    parser.add_argument('--binWidth', type=float, default=0.5, help='evalFairness: time window [s]')
+    stageProfiler.addProfilerArguments(parser)
     args = parser.parse_args()
+    stageProfiler.profilerFromArguments(args)
 
-    assert (args.runMeas and not args.eval) or (not args.runMeas and args.eval)
+    assert (args.runMeas and not (args.eval or args.evalFairness)) or (not args.runMeas and (args.eval or args.evalFairness))
 
     if args.runMeas:
-        runMeas(scenario = "tcpThenQuic")
-        time.sleep(10)
-        runMeas(scenario = "quicThenTcp")
+        with stageProfiler.stage("runMeas_tcpThenQuic"):
+            runMeas(scenario = "tcpThenQuic")
+        stageProfiler.sleep(10)
+        with stageProfiler.stage("runMeas_quicThenTcp"):
+            runMeas(scenario = "quicThenTcp")
 
     if args.eval:
-        eval("fairnessTcpQuic_NetEm_tcpThenQuic")
-        eval("fairnessTcpQuic_NetEm_quicThenTcp")
-        eval("fairnessTcpQuic_SkyDSL_tcpThenQuic")
-        eval("fairnessTcpQuic_SkyDSL_quicThenTcp")
+        with stageProfiler.stage("eval"):
+            eval("fairnessTcpQuic_NetEm_tcpThenQuic")
+            eval("fairnessTcpQuic_NetEm_quicThenTcp")
+            eval("fairnessTcpQuic_SkyDSL_tcpThenQuic")
+            eval("fairnessTcpQuic_SkyDSL_quicThenTcp")
+
+    if args.evalFairness:
+        with stageProfiler.stage("evalFairness"):
+            summaries = []
+            for opKey in operators:
+                for scenario in ["tcpThenQuic", "quicThenTcp"]:
+                    summary = evalFairness(f"fairnessTcpQuic_{opKey}_{scenario}", binWidth=args.binWidth)
+                    if summary is not None:
+                        summaries.append(dict(summary, operator=opKey, scenario=scenario))
+            pd.DataFrame(summaries).to_csv("fairnessTcpQuic_summary.csv", index=False)
 
@@ -1,14 +1,24 @@
 import argparse
+import concurrent.futures
+import contextlib
+import queue
 import subprocess
-import multiprocessing
-import time
+import threading
 from datetime import datetime
 import os
 import glob
 import re
+import numpy as np
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+import evalCache
+import evalPipeline
+import readiness
+import stageProfiler
 
 # This script requires netem-monkey.sh, a NetEm topology with a quad-port Ethernet card and cabling like mad monkeys would do it
 #
@@ -18,9 +28,86 @@ import matplotlib.pyplot as plt
 # iperf3 -c                                 iperf3 -s
 
 netemBridgeInterfaces = ["enp3s0f1", "enp4s0f0"]
-picoquicDir = "./picoquic_cr"
+picoquicDir = os.path.abspath("./picoquic_cr")
 mtuSize = 1300
-resultDir = f"results_{datetime.now().strftime('%Y%m%d-%H%M')}/" # raw data will be in subdir "logs"
+
+# measurement grid
+#datarates = [10, 25, 50, 75, 100, 150, 200, 250, 300, 350, 400, 450, 500] # Mbit/s
+#owds = [10, 25, 50, 75, 100, 150, 200, 250, 300] # ms
+datarates = [10, 25, 50, 100, 200, 250, 500, 1000] # Mbit/s
+owds = [5, 10, 15, 30, 60, 75, 150, 300] # ms
+resultDir = os.path.abspath(f"results_{datetime.now().strftime('%Y%m%d-%H%M')}/") # raw data will be in subdir "logs/<cell>"
+
+# namespaces, NetEm interfaces and addresses of the topology built by netem-monkey.sh
+hardwareTestbed = {"name": "hw", "nsClient": "nsClient", "nsBridge": "nsBridge", "nsServer": "nsServer",
+                   "bridgeInterfaces": netemBridgeInterfaces, "clientIp": "10.3.0.2", "serverIp": "10.4.0.2"}
+
+
+# Virtual testbeds: N independent copies of the topology above on one host, built from veth pairs
+#
+# nsClient<i>           nsBridge<i>             nsServer<i>
+# veth<i>c ---- veth<i>cb         veth<i>sb ---- veth<i>s
+# 10.3.<i>.2    10.3.<i>.1        10.4.<i>.1     10.4.<i>.2
+def vethTestbed(index):
+    return {"name": f"veth{index}", "nsClient": f"nsClient{index}", "nsBridge": f"nsBridge{index}",
+            "nsServer": f"nsServer{index}", "bridgeInterfaces": [f"veth{index}cb", f"veth{index}sb"],
+            "clientIp": f"10.3.{index}.2", "serverIp": f"10.4.{index}.2"}
+
+
+def runSudo(cmd):
+    # cmd is split on whitespace unless it is given as list
+    print(f"Running {cmd}")
+    subprocess.run(["sudo"] + (cmd.split() if isinstance(cmd, str) else cmd), check=True)
+
+
+def createVethTestbed(index):
+    testbed = vethTestbed(index)
+    existing = subprocess.run("ip netns list".split(), capture_output=True, text=True).stdout.split()
+    if testbed["nsBridge"] in existing:
+        print(f"Testbed {testbed['name']} exists, not creating it")
+        return testbed
+
+    nsClient, nsBridge, nsServer = testbed["nsClient"], testbed["nsBridge"], testbed["nsServer"]
+    ethBridge1, ethBridge2 = testbed["bridgeInterfaces"]
+    ethClient, ethServer = f"veth{index}c", f"veth{index}s"
+    for ns in [nsClient, nsBridge, nsServer]:
+        runSudo(f"ip netns add {ns}")
+        runSudo(f"ip netns exec {ns} ip link set dev lo up")
+    runSudo(f"ip link add {ethClient} netns {nsClient} type veth peer name {ethBridge1} netns {nsBridge}")
+    runSudo(f"ip link add {ethServer} netns {nsServer} type veth peer name {ethBridge2} netns {nsBridge}")
+
+    for ns, dev, addr in [(nsClient, ethClient, f"10.3.{index}.2/24"), (nsBridge, ethBridge1, f"10.3.{index}.1/24"),
+                          (nsBridge, ethBridge2, f"10.4.{index}.1/24"), (nsServer, ethServer, f"10.4.{index}.2/24")]:
+        # disabling offloading, as in netem-monkey.sh
+        runSudo(f"ip netns exec {ns} ethtool -K {dev} gro off tso off gso off")
+        runSudo(f"ip netns exec {ns} ip addr add {addr} dev {dev}")
+        runSudo(f"ip netns exec {ns} ip link set dev {dev} up")
+    runSudo(f"ip netns exec {nsBridge} sysctl -w net.ipv4.ip_forward=1")
+    runSudo(f"ip netns exec {nsClient} ip route add 10.4.{index}.0/24 via 10.3.{index}.1")
+    runSudo(f"ip netns exec {nsServer} ip route add 10.3.{index}.0/24 via 10.4.{index}.1")
+
+    # initial NetEm config, changed by setNetem for every cell
+    for dev in testbed["bridgeInterfaces"]:
+        runSudo(f"ip netns exec {nsBridge} tc qdisc add dev {dev} root handle 1:0 netem delay 300ms rate 50Mbit limit 5000")
+    for ns in [nsClient, nsServer]:
+        for sysctl in ["net.ipv4.tcp_wmem", "net.ipv4.tcp_rmem"]:
+            runSudo(["ip", "netns", "exec", ns, "sysctl", "-w", f"{sysctl}=4096 131072 50000000"])
+    return testbed
+
+
+def createVethTestbeds(count):
+    # needed for UDP to send large CR jumps, see netem-monkey.sh
+    runSudo("sysctl -w net.core.rmem_max=200000000")
+    runSudo("sysctl -w net.core.rmem_default=200000000")
+    return [createVethTestbed(index) for index in range(count)]
+
+
+def deleteVethTestbeds(count):
+    # deleting the namespaces also deletes the veth pairs
+    for index in range(count):
+        testbed = vethTestbed(index)
+        for ns in [testbed["nsClient"], testbed["nsBridge"], testbed["nsServer"]]:
+            subprocess.run(f"sudo ip netns delete {ns}".split())
 
 
 # returns BDP in bytes
@@ -28,137 +115,276 @@ def calculateBdp(datarate_Mbps, delay_ms):
     return int(datarate_Mbps*1e6/8 * delay_ms/1e3)
 
 
-def setNetem(datarate_Mbps, owd_ms):
+def setNetem(datarate_Mbps, owd_ms, testbed=hardwareTestbed):
     netemBdp = calculateBdp(datarate_Mbps, 2*owd_ms)
     netemBdp = int(netemBdp * 2 / mtuSize) # path+buffer in packets
     
-    for dev in netemBridgeInterfaces:
-        cmd = f"sudo ip netns exec nsBridge tc qdisc change dev {dev} root handle 1:0 netem delay {owd_ms}ms rate {datarate_Mbps}Mbit limit {netemBdp}"
-        print(f"Running {cmd}")
-        subprocess.run(cmd.split())
-    time.sleep(1)
+    with stageProfiler.overhead(stageProfiler.NETEM_SETUP):
+        for dev in testbed["bridgeInterfaces"]:
+            cmd = f"sudo ip netns exec {testbed['nsBridge']} tc qdisc change dev {dev} root handle 1:0 netem delay {owd_ms}ms rate {datarate_Mbps}Mbit limit {netemBdp}"
+            print(f"Running {cmd}")
+            subprocess.run(cmd.split())
+        stageProfiler.sleep(1)
 
-    subprocess.run("sudo ip netns exec nsClient ping 10.4.0.2 -c3".split())
-    subprocess.run("sudo ip netns exec nsServer ping 10.3.0.2 -c3".split())
+        subprocess.run(f"sudo ip netns exec {testbed['nsClient']} ping {testbed['serverIp']} -c3".split())
+        subprocess.run(f"sudo ip netns exec {testbed['nsServer']} ping {testbed['clientIp']} -c3".split())
 
 
-def runPicoquicServer(datarate, owd, cr):
-    stdout = open(f"{resultDir}/logs/rate{datarate}_delay{owd}_server.stdout", "w")
-    stderr = open(f"{resultDir}/logs/rate{datarate}_delay{owd}_server.stderr", "w")
+def runPicoquicServer(datarate, owd, cr, testbed, cellDir):
+    stdout = open(f"{cellDir}/rate{datarate}_delay{owd}_server.stdout", "w")
+    stderr = open(f"{cellDir}/rate{datarate}_delay{owd}_server.stderr", "w")
 
     crEnv = ""
     if cr:
         crEnv = f"env PREVIOUS_RTT={int(owd*2*1000)} PREVIOUS_CWND_BYTES={int(calculateBdp(datarate, owd*2))}"
-    cmd = f"sudo ip netns exec nsServer {crEnv} {picoquicDir}/picoquicdemo -c {picoquicDir}/certs/cert.pem -k {picoquicDir}/certs/key.pem -q {resultDir} -G cubic -1"
+    cmd = f"sudo ip netns exec {testbed['nsServer']} {crEnv} {picoquicDir}/picoquicdemo -c {picoquicDir}/certs/cert.pem -k {picoquicDir}/certs/key.pem -q {cellDir} -G cubic -1"
     print(f"Starting picoquic server: {cmd}")
-    subprocess.run(cmd.split(), stdout=stdout, stderr=stderr)
+    subprocess.run(cmd.split(), stdout=stdout, stderr=stderr, cwd=cellDir)
     print("Picoquic server finished")
 
     stdout.close()
     stderr.close()
 
 
-def runPicoquicClient(datarate, owd, size_bytes):
-    stdout = open(f"{resultDir}/logs/rate{datarate}_delay{owd}_client.stdout", "w")
-    stderr = open(f"{resultDir}/logs/rate{datarate}_delay{owd}_client.stderr", "w")
+def runPicoquicClient(datarate, owd, size_bytes, testbed, cellDir):
+    stdout = open(f"{cellDir}/rate{datarate}_delay{owd}_client.stdout", "w")
+    stderr = open(f"{cellDir}/rate{datarate}_delay{owd}_client.stderr", "w")
 
-    time.sleep(5)  # wait a second until server is ready
-    cmd = f"sudo ip netns exec nsClient {picoquicDir}/picoquicdemo -n h3 -q {resultDir} -G cubic 10.4.0.2 4443 /{size_bytes}"
+    # wait until the server socket is bound
+    with stageProfiler.overhead(stageProfiler.SERVER_START):
+        readiness.waitForPort(4443, netns=testbed['nsServer'], timeout=10, label="picoquic server ready")
+    cmd = f"sudo ip netns exec {testbed['nsClient']} {picoquicDir}/picoquicdemo -n h3 -q {cellDir} -G cubic {testbed['serverIp']} 4443 /{size_bytes}"
     print(f"Starting picoquic client: {cmd}")
-    subprocess.run(cmd, shell=True, stdout=stdout, stderr=stderr)
+    with stageProfiler.overhead(stageProfiler.TRANSFER):
+        subprocess.run(cmd, shell=True, stdout=stdout, stderr=stderr, cwd=cellDir)
     print("Picoquic client finished")
 
     stdout.close()
     stderr.close()
 
 
-def removeDemoTicketToken():
+def removeDemoTicketToken(cellDir="."):
     for file in ['demo_ticket_store.bin', 'demo_token_store.bin']:
         try:
-            os.remove(file)
+            os.remove(os.path.join(cellDir, file))
         except FileNotFoundError:
             pass
 
 
-def runMeasurements(iterations, cr):
-    os.makedirs(f"{resultDir}/logs")
-
-    #for datarate in [10, 25, 50, 75, 100, 150, 200, 250, 300, 350, 400, 450, 500]: # Mbit/s
-    #    for owd in [10, 25, 50, 75, 100, 150, 200, 250, 300]: # ms
-    for datarate in [10, 25, 50, 100, 200, 250, 500, 1000]:
-        for owd in [5, 10, 15, 30, 60, 75, 150, 300]:
-            setNetem(datarate, owd)
-
-            #FIXME size of object
-            #size = int(datarate * 1e6 / 8 * 1)     # 1-second sized object
-            size = 1*calculateBdp(datarate, 2*owd) # 1*BDP-sized object
-
-            for iteration in range(0, iterations):
-                p1 = multiprocessing.Process(target=runPicoquicServer, args=[datarate, owd, cr])
-                p2 = multiprocessing.Process(target=runPicoquicClient, args=[datarate, owd, size])
-
-                # Start processes and wait for both to finish
-                p1.start()
-                p2.start()
-                p1.join()
-                p2.join()
-
-                removeDemoTicketToken()
+def runCell(datarate, owd, iterations, cr, testbed, pipeline=None):
+    # picoquicdemo runs in the cell directory, so parallel cells do not share qlog directory,
+    # ticket and token store. pipeline: evalPipeline.EvalPipeline evaluating every transfer right away
+    cellDir = f"{resultDir}/logs/rate{datarate}_delay{owd}"
+    os.makedirs(cellDir, exist_ok=True)
+    print(f"Running cell rate{datarate}_delay{owd} on testbed {testbed['name']}")
+
+    setNetem(datarate, owd, testbed)
+
+    #FIXME size of object
+    #size = int(datarate * 1e6 / 8 * 1)     # 1-second sized object
+    size = 1*calculateBdp(datarate, 2*owd) # 1*BDP-sized object
+
+    for iteration in range(0, iterations):
+        p1 = threading.Thread(target=runPicoquicServer, args=[datarate, owd, cr, testbed, cellDir])
+        p2 = threading.Thread(target=runPicoquicClient, args=[datarate, owd, size, testbed, cellDir])
+
+        # Start server and client and wait for both to finish
+        with pipeline.transfer() if pipeline else contextlib.nullcontext():
+            p1.start()
+            p2.start()
+            p1.join()
+            p2.join()
+
+        removeDemoTicketToken(cellDir)
+
+        # rename files (qlog only contains connection ID)
+        for clientServer in ["server", "client"]:
+            for filePathName in glob.glob(f"{cellDir}/*.{clientServer}.qlog"):
+                if not os.path.basename(filePathName).startswith("rate"):
+                    newFilename = f"rate{datarate}_delay{owd}_" + os.path.basename(filePathName)
+                    os.rename(filePathName, f"{cellDir}/{newFilename}")
+                    if pipeline and clientServer == "client":
+                        args = evalClientQlogFileArguments(f"{cellDir}/{newFilename}", cr)
+                        pipeline.submit(args[:2], *args)
+
+
+def runCells(cells, cr, testbeds=None, concurrency=1, pipeline=None):
+    # cells: list of (datarate, owd, iterations), sharded across the testbeds,
+    # at most concurrency cells run at the same time
+    testbeds = testbeds or [hardwareTestbed]
+    freeTestbeds = queue.Queue()
+    for testbed in testbeds:
+        freeTestbeds.put(testbed)
+
+    def runOnFreeTestbed(datarate, owd, iterations):
+        testbed = freeTestbeds.get()
+        try:
+            runCell(datarate, owd, iterations, cr, testbed, pipeline)
+        finally:
+            freeTestbeds.put(testbed)
 
-                # rename files (qlog only contains connection ID) and move qlog files from resultDir to resultDirLogs
-                for clientServer in ["server", "client"]:
-                    for filePathName in glob.glob(f"{resultDir}/*.{clientServer}.qlog"):
-                        newFilename = f"rate{datarate}_delay{owd}_" + os.path.basename(filePathName)
-                        os.rename(filePathName, f"{resultDir}/logs/{newFilename}")
+    workers = max(1, min(concurrency, len(testbeds)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(runOnFreeTestbed, *cell) for cell in cells]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
 
 
-def runEval(dirEval, cr):
-    df = pd.DataFrame()
+def runMeasurements(iterations, cr, testbeds=None, concurrency=1, pipeline=None):
+    os.makedirs(f"{resultDir}/logs")
+    runCells([(datarate, owd, iterations) for datarate in datarates for owd in owds], cr, testbeds, concurrency,
+             pipeline)
+
+
+def ciHalfWidth(values):
+    # 95% confidence interval half width of the mean (normal approximation)
+    if len(values) < 2:
+        return np.inf
+    return 1.96 * np.std(values, ddof=1) / np.sqrt(len(values))
+
+
+def refinementCells(goodputs, runs, minIterations, maxIterations, steepness, ciTarget):
+    # New grid points between neighbouring measured cells whose normalized goodput differs by more
+    # than steepness, and more iterations for cells whose confidence interval is wider than ciTarget.
+    # Returns (datarate, owd, iterations), most important first
+    means = {cell: np.mean(values) for cell, values in goodputs.items() if len(values)}
+    newPoints = {}
+    for axis in [0, 1]:
+        levels = [datarates, owds][axis]
+        lines = {}
+        for cell in means:
+            lines.setdefault(cell[1 - axis], []).append(levels.index(cell[axis]))
+        for other, indices in lines.items():
+            indices.sort()
+            for low, high in zip(indices, indices[1:]):
+                if high - low < 2:
+                    continue
+                cells = [(levels[idx], other) if axis == 0 else (other, levels[idx]) for idx in [low, (low + high) // 2, high]]
+                difference = abs(means[cells[2]] - means[cells[0]])
+                if difference > steepness and cells[1] not in runs:
+                    newPoints[cells[1]] = max(difference, newPoints.get(cells[1], 0))
+
+    moreIterations = {}
+    for cell, count in runs.items():
+        width = ciHalfWidth(goodputs.get(cell, []))
+        if count < maxIterations and width > ciTarget:
+            moreIterations[cell] = width
+
+    cells = [(*cell, minIterations) for cell in sorted(newPoints, key=newPoints.get, reverse=True)]
+    # doubling the iterations of a cell roughly shrinks its confidence interval by sqrt(2)
+    cells += [(*cell, min(runs[cell], maxIterations - runs[cell])) for cell in sorted(moreIterations, key=moreIterations.get, reverse=True)]
+    return cells
+
+
+def runAdaptiveMeasurements(cr, testbeds=None, concurrency=1, budget=128, minIterations=2, maxIterations=10,
+                            steepness=0.05, ciTarget=0.02, cache=None, pipeline=None):
+    # Measures every other cell of the grid first, then refines where normalized goodput changes
+    # steeply or varies between iterations, until no cell needs refinement (confidence target met)
+    # or budget transfers were made
+    os.makedirs(f"{resultDir}/logs")
 
-    # get duration from client qlog files
-    for clientQlogFile in glob.glob(f"{dirEval}/logs/*.client.qlog"):
+    coarse = lambda levels: levels[::2] + ([levels[-1]] if len(levels) % 2 == 0 else [])
+    cells = [(datarate, owd, minIterations) for datarate in coarse(datarates) for owd in coarse(owds)]
+    runs = {}
+    goodputs = {}
+    used = 0
+    while cells:
+        batch = []
+        for datarate, owd, iterations in cells:
+            iterations = min(iterations, budget - used)
+            if iterations <= 0:
+                break
+            batch.append((datarate, owd, iterations))
+            used += iterations
+        if not batch:
+            print(f"Measurement budget of {budget} transfers exhausted")
+            break
+        print(f"Adaptive sweep: measuring {len(batch)} cells, {used}/{budget} transfers")
+        runCells(batch, cr, testbeds, concurrency, pipeline)
+
+        for datarate, owd, iterations in batch:
+            runs[(datarate, owd)] = runs.get((datarate, owd), 0) + iterations
+            clientQlogFiles = glob.glob(f"{resultDir}/logs/rate{datarate}_delay{owd}/*.client.qlog")
+            rows = evalClientQlogFiles(clientQlogFiles, cr, cache)
+            # same selection as in runPlot
+            goodputs[(datarate, owd)] = [row["Normalized Goodput"] for row in rows
+                                         if row["Careful Resume"] == ("enabled" if cr else "disabled")]
+        cells = refinementCells(goodputs, runs, minIterations, maxIterations, steepness, ciTarget)
+    else:
+        print("Adaptive sweep: confidence target met")
+    print(f"Adaptive sweep: measured {len(runs)} of {len(datarates) * len(owds)} cells with {used} transfers")
+
+
+def evalClientQlogFile(clientQlogFile, serverQlogFile, datarate, owd, connectionid, cr):
+    # need to check server file for CR status, doing it this way seems stupid
+    with open(serverQlogFile, "r") as file:
+        if "safe_retreat" in file.read():
+            crText = "safe_retreat"
+        elif cr:
+            crText = "enabled"
+        else:
+            crText = "disabled"
+
+    rows = []
+    with open(clientQlogFile, "r") as file:
+        for line in file:
+            pattern = r"Received (\d+) bytes in ([\d.]+) seconds, ([\d.]+) Mbps."
+            match = re.search(pattern, line)
+            if match:
+                rows.append({"Datarate": datarate,
+                             "One-way delay": owd,
+                             "RTT": 2*owd,
+                             "BDP": calculateBdp(datarate, 2 * owd),
+                             "ReportedBytes": match.group(1),
+                             "Connection ID": connectionid,
+                             "Careful Resume": crText,
+                             "Duration": match.group(2),
+                             "Goodput": match.group(3),
+                             "Normalized Goodput": float(match.group(3)) / datarate,
+                             })
+    return rows
+
+
+def evalClientQlogFileArguments(clientQlogFile, cr):
+    # arguments of evalClientQlogFile, the first two are the client and the server qlog file
+    pattern = r"rate(\d+)_delay(\d+)_([a-f0-9]+).client.qlog"  # rate200_delay50_obj2s_cr0_52345abd...
+    match = re.search(pattern, clientQlogFile)
+    datarate = int(match.group(1))
+    owd = int(match.group(2))
+    connectionid = match.group(3)
+
+    serverQlogFile = glob.glob(f"{os.path.dirname(clientQlogFile)}/rate{datarate}_delay{owd}_{connectionid}.*.server.qlog")
+    assert len(serverQlogFile) == 1, f"Expected exactly one server .qlog file but found: {serverQlogFile}"
+
+    return [clientQlogFile, serverQlogFile[0], datarate, owd, connectionid, cr]
+
+
+def evalClientQlogFiles(clientQlogFiles, cr, cache=None):
+    rows = []
+    for clientQlogFile in clientQlogFiles:
         print(clientQlogFile)
-        pattern = r"rate(\d+)_delay(\d+)_([a-f0-9]+).client.qlog"  # rate200_delay50_obj2s_cr0_52345abd...
-        match = re.search(pattern, clientQlogFile)
-        datarate = int(match.group(1))
-        owd = int(match.group(2))
-        connectionid = match.group(3)
-
-        # need to check server file for CR status, doing it this way seems stupid
-        serverQlogFile = glob.glob(f"{dirEval}/logs/rate{datarate}_delay{owd}_{connectionid}.*.server.qlog")
-        assert len(serverQlogFile) == 1, f"Expected exactly one server .qlog file but found: {serverQlogFile}"
-        with open(serverQlogFile[0], "r") as file:
-            if "safe_retreat" in file.read():
-                crText = "safe_retreat"
-            elif cr:
-                crText = "enabled"
-            else:
-                crText = "disabled"
-
-        with open(clientQlogFile, "r") as file:
-            for line in file:
-                pattern = r"Received (\d+) bytes in ([\d.]+) seconds, ([\d.]+) Mbps."
-                match = re.search(pattern, line)
-                if match:
-                    df_temp = pd.DataFrame([{"Datarate": datarate,
-                                             "One-way delay": owd,
-                                             "RTT": 2*owd,
-                                             "BDP": calculateBdp(datarate, 2 * owd),
-                                             "ReportedBytes": match.group(1),
-                                             "Connection ID": connectionid,
-                                             "Careful Resume": crText,
-                                             "Duration": match.group(2),
-                                             "Goodput": match.group(3),
-                                             "Normalized Goodput": float(match.group(3)) / datarate,
-                                             }])
-                    df = pd.concat([df, df_temp], ignore_index=True)
-
+        args = evalClientQlogFileArguments(clientQlogFile, cr)
+        if cache is not None:
+            # result also depends on the server qlog file and the cr flag
+            rows += cache.cached(evalClientQlogFile, args[:2], *args, namespace=f"evalClientQlogFile-cr{cr}")
+        else:
+            rows += evalClientQlogFile(*args)
+    return rows
+
+
+def runEval(dirEval, cr, cache=None):
+    # get duration from client qlog files (in logs/ or in per-cell subdirectories logs/<cell>/)
+    rows = evalClientQlogFiles(glob.glob(f"{dirEval}/logs/**/*.client.qlog", recursive=True), cr, cache)
+    if cache is not None:
+        print(cache)
+
+    df = pd.DataFrame(rows)
     df = df.sort_values(by=["Datarate", "One-way delay"])
     print(df)
     df.to_csv(f'{dirEval}/results.csv', index=False)
 
 
-def runPlot(filename, cr):
+def runPlot(filename, cr, interpolate=False):
     df = pd.read_csv(filename)
 
     if cr:
@@ -176,11 +402,27 @@ def runPlot(filename, cr):
         values='Normalized Goodput',
         aggfunc='mean'
     )
+    interpolated = None
+    if interpolate:
+        # cells of the grid that were not measured (adaptive sweep) are interpolated linearly along
+        # datarate and RTT (mean of both where possible) and marked with "~"
+        measured = pivot_table.reindex(index=sorted(set(pivot_table.index) | {2*owd for owd in owds}),
+                                       columns=sorted(set(pivot_table.columns) | set(datarates)))
+        alongRate = measured.interpolate(method='index', axis=1, limit_direction='both')
+        alongRtt = measured.interpolate(method='index', axis=0, limit_direction='both')
+        pivot_table = measured.fillna((alongRate + alongRtt) / 2).fillna(alongRate).fillna(alongRtt)
+        interpolated = measured.isna().sort_index(ascending=False)
     pivot_table = pivot_table.sort_index(ascending=False)
     print(pivot_table)
 
+    annot = True
+    fmt = ".2f"
+    if interpolated is not None:
+        annot = np.where(interpolated, "~", "") + pivot_table.map(lambda x: f"{x:.2f}").to_numpy()
+        fmt = ""
+
     plt.figure(figsize=(10, 8))
-    sns.heatmap(pivot_table, annot=True, fmt=".2f", cmap="viridis", vmin=0, vmax=0.25)
+    sns.heatmap(pivot_table, annot=annot, fmt=fmt, cmap="viridis", vmin=0, vmax=0.25)
     plt.title(f'Goodput / Link Rate ratio when transferring a BDP-sized object (NetEm with 1 BDP buffer), CR is {"enabled" if cr else "disabled"}.') #FIXME change title when changing object size
     plt.xlabel('Datarate [Mbit/s]')
     plt.ylabel('RTT [ms]')
@@ -193,13 +435,59 @@ def runPlot(filename, cr):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Heatmap fun")
     parser.add_argument('--enableCr', action='store_true', help='Enable Careful Resume')
+    parser.add_argument('--testbeds', type=int, default=0,
+                        help='Number of virtual veth testbeds to create and use (0: hardware testbed of netem-monkey.sh)')
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help='Maximum number of grid cells measured at the same time (default: number of testbeds)')
+    parser.add_argument('--deleteTestbeds', action='store_true', help='Delete the virtual testbeds afterwards')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Measure a coarse grid first and refine only where goodput changes steeply or varies')
+    parser.add_argument('--budget', type=int, default=128, help='--adaptive: maximum number of transfers')
+    parser.add_argument('--minIterations', type=int, default=2, help='--adaptive: iterations of a new cell')
+    parser.add_argument('--maxIterations', type=int, default=10, help='--adaptive: maximum iterations per cell')
+    parser.add_argument('--steepness', type=float, default=0.05,
+                        help='--adaptive: refine between cells whose normalized goodput differs by more than this')
+    parser.add_argument('--ciTarget', type=float, default=0.02,
+                        help='--adaptive: target 95%% confidence interval half width of the normalized goodput')
+    evalCache.addCacheArguments(parser)
+    evalPipeline.addPipelineArguments(parser)
+    stageProfiler.addProfilerArguments(parser)
     args = parser.parse_args()
     print(f"enableCr is {args.enableCr}")
+    stageProfiler.profilerFromArguments(args)
+    cache = evalCache.cacheFromArguments(args)
+    pipeline = None
+    if args.pipeline:
+        # partial results, plot at any time with runPlot(f"{resultDir}/results_pipeline.csv", ...)
+        os.makedirs(resultDir, exist_ok=True)
+        pipeline = evalPipeline.EvalPipeline(evalClientQlogFile, f"{resultDir}/results_pipeline.csv",
+                                             jobs=args.pipelineJobs, cache=cache,
+                                             namespace=f"evalClientQlogFile-cr{args.enableCr}",
+                                             pauseDuringTransfers=args.pipelinePause)
 
     # Running measurements, evaluation, and plotting: Separate functions to allow
     # separate execution in case one of the steps needs to be re-run afterwards
-    runMeasurements(iterations=1, cr=args.enableCr) # results will be in {resultDir}/logs
-
-    runEval(dirEval=resultDir, cr=args.enableCr)
-
-    runPlot(f"{resultDir}/results.csv", cr=args.enableCr)
+    with stageProfiler.stage("createTestbeds"):
+        testbeds = createVethTestbeds(args.testbeds) if args.testbeds > 0 else [hardwareTestbed]
+    concurrency = args.concurrency or len(testbeds)
+    if args.adaptive:
+        with stageProfiler.stage("runAdaptiveMeasurements"):
+            runAdaptiveMeasurements(cr=args.enableCr, testbeds=testbeds, concurrency=concurrency, budget=args.budget,
+                                    minIterations=args.minIterations, maxIterations=args.maxIterations,
+                                    steepness=args.steepness, ciTarget=args.ciTarget, cache=cache, pipeline=pipeline)
+    else:
+        with stageProfiler.stage("runMeasurements"):
+            runMeasurements(iterations=1, cr=args.enableCr, testbeds=testbeds, concurrency=concurrency,
+                            pipeline=pipeline) # results will be in {resultDir}/logs
+    readiness.printWaitTimes()
+    if pipeline:
+        with stageProfiler.stage("pipelineClose"):
+            pipeline.close()
+    if args.deleteTestbeds and args.testbeds > 0:
+        deleteVethTestbeds(args.testbeds)
+
+    with stageProfiler.stage("runEval"):
+        runEval(dirEval=resultDir, cr=args.enableCr, cache=cache)
+
+    with stageProfiler.stage("runPlot"):
+        runPlot(f"{resultDir}/results.csv", cr=args.enableCr, interpolate=args.adaptive)
@@ -1,75 +1,116 @@
 #!/usr/bin/env python3
 
 import argparse
+import calendar
+import contextlib
+import mmap
+import multiprocessing
+import os
+import sys
+import time
 import numpy as np
 import glob
 import re
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
-import dateutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+import stageProfiler
 
 sns.set_theme()
 
 customSort = {'Konnect': 1, 'Skydsl': 2, 'Astra': 3, 'Tooway': 4, 'NetEm': 5, "Starlink": 6}
 
 
-def evalQuiche():
-    inputFiles = glob.glob("data/*.rustlog")
-    print(f"Found {len(inputFiles)} files: {inputFiles}")
-
-    res = []
-    for file in inputFiles:
-        print(file)
-        inputFileName = file.replace("data/", "").replace(".rustlog", "").split(sep='_')
-        operator = inputFileName[-3],
-        operator = operator[0]
-        iteration = inputFileName[-1].replace("iter", "")
-
-        textRaw = open(file, 'r')
-
-        tsNewConn = None
-        tsCss = None
-        cwndCss = None
-        tsFin = None
-
-        # New connection
-        for line in textRaw:
-            if re.search(r'New connection.*', line):
-                #print(line)
-                tsNewConn = re.search(r'\d\d\d\d-\d\d-\d\dT(.*?)Z', line).group(1)
-                tsNewConn = dateutil.parser.parse(tsNewConn).timestamp()
+# markers in quiche RUST_LOG=trace output, in the order they are expected
+rustlogMarkers = [b'New connection', b'css_start_time=Some', b'STREAM id=0 ']
+rustlogStreamFin = re.compile(rb'STREAM id=0 (.*?) fin=true')
+rustlogCwnd = re.compile(rb'cwnd=(\d+)')
+rustlogTimestamp = re.compile(rb'(\d\d\d\d)-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(\.\d+)?Z')
+
+
+def parseRustlogTimestamp(line):
+    # fixed-format ISO-8601 (UTC) timestamp of env_logger, e.g. 2023-03-01T12:34:56.123456789Z
+    match = rustlogTimestamp.search(line)
+    if match is None:
+        return None
+    seconds = calendar.timegm(tuple(int(x) for x in match.groups()[:6]))
+    return seconds + (float(match.group(7)) if match.group(7) else 0.0)
+
+
+def scanRustlog(file):
+    # Single pass over the memory-mapped log, stops as soon as New connection,
+    # then css_start_time=Some, then STREAM id=0 ... fin=true have been found
+    print(file)
+    inputFileName = os.path.basename(file).replace(".rustlog", "").split(sep='_')
+    operator = inputFileName[-3]
+    iteration = inputFileName[-1].replace("iter", "")
+
+    tsNewConn = None
+    tsCss = None
+    cwndCss = None
+    tsFin = None
+
+    with open(file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            print(f"Warning - empty file {file}")
+            return None
+        textRaw = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with textRaw:
+        # each marker is searched from the line after the previous one, i.e., the file is read at
+        # most once and only up to the STREAM id=0 fin=true line
+        pos = 0
+        for stage, marker in enumerate(rustlogMarkers):
+            line = None
+            while line is None:
+                idx = textRaw.find(marker, pos)
+                if idx < 0:
+                    break
+                lineStart = textRaw.rfind(b'\n', 0, idx) + 1
+                lineEnd = textRaw.find(b'\n', idx)
+                lineEnd = len(textRaw) if lineEnd < 0 else lineEnd
+                pos = lineEnd + 1
+                line = textRaw[lineStart:lineEnd]
+                if stage == 2 and not rustlogStreamFin.search(line):
+                    line = None
+            if line is None:
                 break
 
-        # css_start_time
-        for line in textRaw:
-            if re.search(r'css_start_time=Some.*', line):
-                #print(line)
-                tsCss = re.search(r'\d\d\d\d-\d\d-\d\dT(.*?)Z', line).group(1)
-                tsCss = dateutil.parser.parse(tsCss).timestamp()
-                #print(tsCss)
-                cwndCss = re.search(r'cwnd=(.*?)\s', line).group(1)
-                break
-
-        # STREAM id=0 fin=true
-        for line in textRaw:
-            if re.search(r'STREAM id=0 (.*?) fin=true', line):
-                tsFin = re.search(r'\d\d\d\d-\d\d-\d\dT(.*?)Z', line).group(1)
-                tsFin = dateutil.parser.parse(tsFin).timestamp()
-                break
+            if stage == 0:
+                # New connection
+                tsNewConn = parseRustlogTimestamp(line)
+            elif stage == 1:
+                # css_start_time
+                tsCss = parseRustlogTimestamp(line)
+                # the line slice has no trailing newline, a missing cwnd is reported as missing data below
+                match = rustlogCwnd.search(line)
+                cwndCss = match.group(1).decode() if match else None
+            else:
+                # STREAM id=0 fin=true
+                tsFin = parseRustlogTimestamp(line)
+
+    if tsNewConn and tsCss and cwndCss and tsFin:
+        return {"Operator": operator,
+                "iteration": iteration,
+                'tsNewConn': tsNewConn,
+                'tsExit': tsCss,
+                'cwndExit': int(cwndCss),
+                'tsFin': tsFin,
+                'time2exit': tsCss - tsNewConn,
+                'time2fin': tsFin - tsNewConn}
+    print(f"Warning - missing data in {file}: "
+          f"tsNewConn {tsNewConn}, tsCss {tsCss}, cwndCss {cwndCss}, tsFin {tsFin}")
+    return None
+
+
+def evalQuiche(jobs=1):
+    inputFiles = sorted(glob.glob("data/*.rustlog"))
+    print(f"Found {len(inputFiles)} files: {inputFiles}")
 
-        if tsNewConn and tsCss and cwndCss and tsFin:
-            res.append({"Operator": operator,
-                        "iteration": iteration,
-                        'tsNewConn': tsNewConn,
-                        'tsExit': tsCss,
-                        'cwndExit': int(cwndCss),
-                        'tsFin': tsFin,
-                        'time2exit': tsCss - tsNewConn,
-                        'time2fin': tsFin - tsNewConn})
-        else:
-            print(f"Warning - missing data in {file}: "
-                  f"tsNewConn {tsNewConn}, tsCss {tsCss}, cwndCss {cwndCss}, tsFin {tsFin}")
+    with (multiprocessing.Pool(jobs) if jobs > 1 else contextlib.nullcontext()) as pool:
+        results = pool.imap(scanRustlog, inputFiles) if pool else map(scanRustlog, inputFiles)
+        res = [result for result in results if result is not None]
 
     df = pd.DataFrame(res)
     # https://stackoverflow.com/questions/13838405/custom-sorting-in-pandas-dataframe
@@ -210,17 +251,161 @@ def evalLinuxHystart():
 
 
 
+# Live-tail mode for dmesg logs, e.g. dmesg --follow | hystartEval.py --exp linuxHystart --follow - --operator Starlink
+hystartDelay = re.compile(r'(\d+\.\d+)\] HYSTART_DELAY cwnd (\d+)')
+hystartInitTransfer = re.compile(r'(\d+\.\d+)\] HYSTART tcp_init_transfer')
+
+
+class EcdfSketch:
+    # fixed-bin histogram on [0, upper) plus under-/overflow bin, memory does not grow with the
+    # number of values, the ECDF is exact at the bin edges (resolution upper/bins)
+    def __init__(self, upper, bins=1000):
+        self.edges = np.linspace(0, upper, bins + 1)
+        self.counts = np.zeros(bins + 2, dtype=np.int64)
+
+    def add(self, value):
+        self.counts[np.searchsorted(self.edges, value, side='right')] += 1
+
+    def __len__(self):
+        return int(self.counts.sum())
+
+    def ecdf(self):
+        # fraction of values < edges[i]
+        return self.edges, np.cumsum(self.counts)[:len(self.edges)] / max(len(self), 1)
+
+    def quantile(self, q):
+        # lower edge of the bin containing the q-quantile
+        edges, cdf = self.ecdf()
+        return edges[min(max(np.searchsorted(cdf, q) - 1, 0), len(edges) - 1)]
+
+
+class HystartDmesgMatcher:
+    # incremental version of the matching in evalLinuxHystart: HYSTART_DELAY followed by the
+    # tcp_init_transfer line of the same connection
+    def __init__(self):
+        self.pending = None
+        self.partial = ""
+
+    def feed(self, line):
+        # returns (tsStart, tsExit, cwndExit) once a pair is complete
+        if not line.endswith("\n"):
+            # incomplete last line of a file that is still being written
+            self.partial += line
+            return None
+        line, self.partial = self.partial + line, ""
+        pending, self.pending = self.pending, None
+        if pending is not None:
+            match = hystartInitTransfer.search(line)
+            if match is not None:
+                return float(match.group(1)), pending[0], pending[1]
+        match = hystartDelay.search(line)
+        if match is not None:
+            self.pending = (float(match.group(1)), int(match.group(2)))
+        elif "HYSTART_LOSS" in line:
+            print(f"HYSTART_LOSS not supported, ignoring: {line.strip()}")
+        return None
+
+
+def printLinuxHystartSketches(sketches):
+    for operator in sorted(sketches, key=lambda x: customSort.get(x, len(customSort) + 1)):
+        time2exit, cwndExit = sketches[operator]
+        print(f"{operator}: n={len(time2exit)} "
+              f"time2exit p10/p50/p90 {time2exit.quantile(0.1):.3f}/{time2exit.quantile(0.5):.3f}/{time2exit.quantile(0.9):.3f} s, "
+              f"cwndExit p10/p50/p90 {cwndExit.quantile(0.1):.0f}/{cwndExit.quantile(0.5):.0f}/{cwndExit.quantile(0.9):.0f} packets")
+
+
+def plotLinuxHystartSketches(sketches, filename="cdf_linux_hystart_live.pdf"):
+    labelTime = "Time [s] between tcp_init_transfer and\nHYSTART_DELAY"
+    labelCwnd = "cwnd [packets] at HYSTART_DELAY"
+
+    fig, axes = plt.subplots(1, 2, figsize=(10, 5))
+    for operator in sorted(sketches, key=lambda x: customSort.get(x, len(customSort) + 1)):
+        for ax, sketch in zip(axes, sketches[operator]):
+            ax.step(*sketch.ecdf(), where='post', label=f"{operator} (n={len(sketch)})")
+    axes[0].set(xlabel=labelTime, ylabel="Proportion", xlim=(0, 5))
+    axes[1].set(xlabel=labelCwnd, ylabel="Proportion", xlim=(0, 150))
+    axes[1].tick_params('x', labelrotation=45)
+    axes[0].legend()
+    fig.tight_layout()
+    plt.savefig(filename)
+    plt.close(fig)
+
+
+def followLinuxHystart(files, operator=None, interval=10, pollInterval=0.5):
+    # files are read from the beginning and then followed as they grow, "-" reads stdin until EOF
+    # the operator is taken from dmesg_<operator>.dmesg_log unless given explicitly
+    streams = []
+    for file in files:
+        if file == "-":
+            streams.append((sys.stdin, operator or "stdin", HystartDmesgMatcher()))
+        else:
+            name = operator or os.path.basename(file).replace("dmesg_", "").split(".")[0]
+            streams.append((open(file, 'r'), name, HystartDmesgMatcher()))
+
+    sketches = {}
+    updated = False
+    lastOutput = time.monotonic()
+    try:
+        while streams:
+            progress = False
+            for stream in list(streams):
+                textRaw, name, matcher = stream
+                for line in iter(textRaw.readline, ""):
+                    progress = True
+                    pair = matcher.feed(line)
+                    if pair is None:
+                        continue
+                    tsStart, tsExit, cwndExit = pair
+                    print(f"{name}: HYSTART_DELAY {tsExit}-{tsStart}={tsExit-tsStart} and {cwndExit}")
+                    if name not in sketches:
+                        sketches[name] = (EcdfSketch(upper=5), EcdfSketch(upper=150, bins=150))
+                    sketches[name][0].add(tsExit - tsStart)
+                    sketches[name][1].add(cwndExit)
+                    updated = True
+                    if textRaw is sys.stdin:
+                        break  # stdin blocks in readline, give the output below a chance
+                if textRaw is sys.stdin and not progress:
+                    streams.remove(stream)  # EOF on stdin
+
+            if updated and time.monotonic() - lastOutput >= interval:
+                printLinuxHystartSketches(sketches)
+                plotLinuxHystartSketches(sketches)
+                updated = False
+                lastOutput = time.monotonic()
+            if not progress and streams:
+                time.sleep(pollInterval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for textRaw, _, _ in streams:
+            if textRaw is not sys.stdin:
+                textRaw.close()
+
+    if sketches:
+        printLinuxHystartSketches(sketches)
+        plotLinuxHystartSketches(sketches)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--exp", type=str, required=True)
+    parser.add_argument("--jobs", type=int, default=1, help="Number of worker processes for evaluating log files")
+    parser.add_argument("--follow", type=str, nargs='+', default=None,
+                        help="linuxHystart: follow growing dmesg log file(s) or stdin (-) and update ECDFs live")
+    parser.add_argument("--operator", type=str, default=None, help="linuxHystart --follow: operator name for the log")
+    parser.add_argument("--interval", type=float, default=10, help="linuxHystart --follow: seconds between updates")
+    stageProfiler.addProfilerArguments(parser)
     args = parser.parse_args()
-
-    if args.exp == "quiche":
-        evalQuiche()
-    elif args.exp == "picoquic":
-        evalPicoquic()
-    elif args.exp == "linuxHystart":
-        evalLinuxHystart()
+    stageProfiler.profilerFromArguments(args)
+
+    with stageProfiler.stage(args.exp):
+        if args.exp == "quiche":
+            evalQuiche(args.jobs)
+        elif args.exp == "picoquic":
+            evalPicoquic()
+        elif args.exp == "linuxHystart" and args.follow:
+            followLinuxHystart(args.follow, args.operator, args.interval)
+        elif args.exp == "linuxHystart":
+            evalLinuxHystart()
 
 
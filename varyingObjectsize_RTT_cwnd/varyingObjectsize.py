@@ -1,4 +1,8 @@
 import argparse
+import collections
+import contextlib
+import itertools
+import multiprocessing
 import struct
 import subprocess
 import re
@@ -10,8 +14,20 @@ import numpy as np
 import pandas as pd
 from datetime import datetime
 import matplotlib.pyplot as plt
+import matplotlib.patches as mpatches
 import seaborn as sns
 import os
+import shutil
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+import qlogReader
+import evalCache
+import evalPipeline
+import iterationScheduler
+import quantileSketch
+import readiness
+import stageProfiler
 
 # Measure, eval, and plot RTTs (min_rtt, latest_rtt) and congestion_window, bytes_in_flight
 #
@@ -40,6 +56,12 @@ operators = {   "NetEm": {"sshRemoteLogin": "user@netem",    "destIp": "10.37.1.
             }
 
 objsizeList = [int(x) for x in [10e3, 30e3, 100e3, 300e3, 1e6, 3e6, 10e6, 30e6, 100e6, 300e6]]
+ccAlgorithms = ["cubic", "bbr"]
+
+
+def measurementCells():
+    # (operator, cc, objsize) in the order of the measurements
+    return [(operator, cc, objsize) for cc in ccAlgorithms for objsize in objsizeList for operator in operators]
 
 
 def runPicoquicClient(sshRemoteLogin, ccAlgorithm, destIp, destPort, objsize):
@@ -47,45 +69,54 @@ def runPicoquicClient(sshRemoteLogin, ccAlgorithm, destIp, destPort, objsize):
     # -D                     #no disk: do not save received files on disk
     cmd = f"ssh {sshRemoteLogin} picoquic/picoquicdemo -n xyz -G {ccAlgorithm} {destIp} {destPort} /{objsize}"
     print(cmd)
-    subprocess.run(cmd.split())
-    time.sleep(2)
+    with stageProfiler.overhead(stageProfiler.TRANSFER):
+        subprocess.run(cmd.split())
 
 def runQuicheClient(sshRemoteLogin, ccAlgorithm, destIp, destPort, objsize):
     cmd = f"ssh {sshRemoteLogin} quiche/target/release/quiche-client --no-verify --cc-algorithm {ccAlgorithm} https://{destIp}:{destPort}/{objsize} > /dev/null"
     print(cmd)
-    subprocess.run(cmd.split())
-    time.sleep(2)
+    with stageProfiler.overhead(stageProfiler.TRANSFER):
+        subprocess.run(cmd.split())
+
+def waitForQlogFile(path2qlogDir, extension="qlog"):
+    # returns as soon as the server has closed the qlog file
+    return readiness.waitForFilesClosed(f'{path2qlogDir}/*.{extension}', timeout=60, label=f"server {extension} closed")
 
-def waitForQlogFile(path2qlogDir):
-    while not glob.glob(f'{path2qlogDir}/*.qlog'):
-        print("server *.qlog file not found, waiting...")
-        time.sleep(1)
+serverPorts = {Implementation.PICOQUIC: 4431, Implementation.QUICHE: 4432}
 
-def runImplementation(implementation: Implementation, iterations: int):
+def runImplementation(implementation: Implementation, scheduler, pipeline=None):
+    # scheduler: iterationScheduler.IterationScheduler of the cells (operator, cc, objsize), the metric is
+    # the duration of the transfer (client run time)
+    # pipeline: evalPipeline.EvalPipeline, every result file is evaluated as soon as it is moved to results
     results_dir = "results" #f"results_{datetime.today().strftime('%Y%m%d_%H%M')}"
     temp_qlog_dir = "temp_qlog"
     subprocess.run(f"mkdir -p results", shell=True)
     subprocess.run(f"rm -rf {temp_qlog_dir} && mkdir {temp_qlog_dir}", shell=True)
 
-    for iteration in range(0,iterations):
-        for ccAlgorithm in ["cubic", "bbr"]:
-            if implementation == Implementation.PICOQUIC:
-                print("Starting picoquic server...")
-                cmd = f"./picoquic/picoquicdemo -c picoquic/certs/cert.pem -k picoquic/certs/key.pem -p 4431 -q {temp_qlog_dir} -G {ccAlgorithm}"
-                print(cmd)
-                subprocess.Popen(cmd, shell=True)
-                time.sleep(1)
-
-            if implementation == Implementation.QUICHE:
-                print("Starting quiche server...")
-                cmd = (f"QLOGDIR={temp_qlog_dir} ./quiche/target/release/quiche-server "
-                       f"--cert quiche/apps/src/bin/cert.crt "
-                       f"--key quiche/apps/src/bin/cert.key "
-                       f"--root www --listen 0.0.0.0:4432 "
-                       f"--cc-algorithm {ccAlgorithm}")
-                print(cmd)
-                subprocess.Popen(cmd, shell=True)
-                time.sleep(1)
+    while cells := scheduler.nextRound():
+        for ccAlgorithm in ccAlgorithms:
+            ccCells = [cell for cell in cells if cell[1] == ccAlgorithm]
+            if not ccCells:
+                continue
+
+            with stageProfiler.overhead(stageProfiler.SERVER_START):
+                if implementation == Implementation.PICOQUIC:
+                    print("Starting picoquic server...")
+                    cmd = f"./picoquic/picoquicdemo -c picoquic/certs/cert.pem -k picoquic/certs/key.pem -p 4431 -q {temp_qlog_dir} -G {ccAlgorithm}"
+                    print(cmd)
+                    subprocess.Popen(cmd, shell=True)
+
+                if implementation == Implementation.QUICHE:
+                    print("Starting quiche server...")
+                    cmd = (f"QLOGDIR={temp_qlog_dir} ./quiche/target/release/quiche-server "
+                           f"--cert quiche/apps/src/bin/cert.crt "
+                           f"--key quiche/apps/src/bin/cert.key "
+                           f"--root www --listen 0.0.0.0:4432 "
+                           f"--cc-algorithm {ccAlgorithm}")
+                    print(cmd)
+                    subprocess.Popen(cmd, shell=True)
+
+                readiness.waitForPort(serverPorts[implementation], timeout=10, label="server ready")
 
             # just to enable 0-RTT, not for performance measurements
             if implementation == Implementation.PICOQUIC and False:
@@ -98,138 +129,418 @@ def runImplementation(implementation: Implementation, iterations: int):
 
             print(f"\n\n\nRunning measurements with varying object sizes")
 
-            for objsize in objsizeList:
-                if (objsize == int(100e6) and iteration > 5) or (objsize == int(300e6) and iteration > 2):
-                    print(f"Skipping very large objects in iteration {iteration}")
-                else:
-                    for operator in operators:
-                        sshRemoteLogin = operators[operator]['sshRemoteLogin']
-                        destIp = operators[operator]['destIp']
-
-                        if implementation == Implementation.PICOQUIC:
-                            currentSetup = f"picoquic_{operator}_{ccAlgorithm}_objsize{objsize}_iter{iteration}"
-                            print(f"\n\n\nRunning {currentSetup}\n\n\n")
-                            runPicoquicClient(sshRemoteLogin=sshRemoteLogin, ccAlgorithm=ccAlgorithm, destIp=destIp, destPort=4431, objsize=objsize)
-                            waitForQlogFile(temp_qlog_dir)
-                            subprocess.run(f"mv {temp_qlog_dir}/*.qlog {results_dir}/{currentSetup}.qlog", shell=True)
-
-                        if implementation == Implementation.QUICHE:
-                            currentSetup = f"quiche_{operator}_{ccAlgorithm}_objsize{objsize}_iter{iteration}"
-                            print(f"\n\n\nRunning {currentSetup}")
-                            runQuicheClient(sshRemoteLogin=sshRemoteLogin, ccAlgorithm=ccAlgorithm, destIp=destIp, destPort=4432, objsize=objsize)
-                            time.sleep(3)
-                            subprocess.run(f"mv {temp_qlog_dir}/*.sqlog {results_dir}/{currentSetup}.sqlog", shell=True)
+            for cell in ccCells:
+                operator, _, objsize = cell
+                iteration = scheduler.iterations(cell)
+                sshRemoteLogin = operators[operator]['sshRemoteLogin']
+                destIp = operators[operator]['destIp']
+                iterationStart = time.monotonic()
+
+                if implementation == Implementation.PICOQUIC:
+                    currentSetup = f"picoquic_{operator}_{ccAlgorithm}_objsize{objsize}_iter{iteration}"
+                    print(f"\n\n\nRunning {currentSetup}\n\n\n")
+                    with pipeline.transfer() if pipeline else contextlib.nullcontext():
+                        runPicoquicClient(sshRemoteLogin=sshRemoteLogin, ccAlgorithm=ccAlgorithm, destIp=destIp, destPort=4431, objsize=objsize)
+                        transferDuration = time.monotonic() - iterationStart
+                        waitForQlogFile(temp_qlog_dir)
+                    with stageProfiler.overhead(stageProfiler.ARTEFACT_TRANSFER):
+                        subprocess.run(f"mv {temp_qlog_dir}/*.qlog {results_dir}/{currentSetup}.qlog", shell=True)
+                    if pipeline:
+                        pipeline.submit(f"{results_dir}/{currentSetup}.qlog")
+
+                if implementation == Implementation.QUICHE:
+                    currentSetup = f"quiche_{operator}_{ccAlgorithm}_objsize{objsize}_iter{iteration}"
+                    print(f"\n\n\nRunning {currentSetup}")
+                    with pipeline.transfer() if pipeline else contextlib.nullcontext():
+                        runQuicheClient(sshRemoteLogin=sshRemoteLogin, ccAlgorithm=ccAlgorithm, destIp=destIp, destPort=4432, objsize=objsize)
+                        transferDuration = time.monotonic() - iterationStart
+                        waitForQlogFile(temp_qlog_dir, extension="sqlog")
+                    with stageProfiler.overhead(stageProfiler.ARTEFACT_TRANSFER):
+                        subprocess.run(f"mv {temp_qlog_dir}/*.sqlog {results_dir}/{currentSetup}.sqlog", shell=True)
+                    if pipeline:
+                        pipeline.submit(f"{results_dir}/{currentSetup}.sqlog")
+
+                scheduler.record(cell, time.monotonic() - iterationStart, transferDuration)
 
             #kill server
-            if implementation == Implementation.PICOQUIC:
-                subprocess.run("pkill picoquicdemo".split())
-            if implementation == Implementation.QUICHE:
-                subprocess.run("pkill quiche-server".split())
-            time.sleep(1)
+            with stageProfiler.overhead(stageProfiler.SERVER_STOP):
+                if implementation == Implementation.PICOQUIC:
+                    subprocess.run("pkill picoquicdemo".split())
+                if implementation == Implementation.QUICHE:
+                    subprocess.run("pkill quiche-server".split())
+                readiness.waitForPortReleased(serverPorts[implementation], timeout=10, label="server stopped")
+            if pipeline:
+                print(pipeline.status())
+        print(scheduler.report())
 
+    for line in scheduler.summary():
+        print(line)
+    readiness.printWaitTimes()
 
-def evalPicoquicSingleFile(filename):
-    parameters = os.path.basename(filename).replace(".qlog", "").split(sep="_")
+
+quicheRttKeys = ["min_rtt", "smoothed_rtt", "latest_rtt", "rtt_variance"]
+
+
+def parseFilename(filename):
+    # {implementation}_{operator}_{cc}_objsize{objsize}_iter{iteration}.(s)qlog
+    parameters = os.path.basename(filename).replace(".sqlog", "").replace(".qlog", "").split(sep="_")
     print(parameters)
     operator = parameters[1]
     cc = parameters[2]
     objsize = int(parameters[3].replace("objsize", ""))
     iteration = int(parameters[4].replace("iter", ""))
+    return operator, cc, objsize, iteration
+
+def readPicoquicSingleFile(filename):
+    operator, cc, objsize, iteration = parseFilename(filename)
+
+    # Parsing qlog (json) file, only recovery:metrics_updated events are decoded
+    metrics = qlogReader.readKeyValues(filename, ['recovery:metrics_updated'], valueDtype=np.int64)
+    metrics['key'] = pd.Categorical(metrics['key'])
+    return {'operator': operator,
+            'cc': cc,
+            'objsize': objsize,
+            'iteration': iteration,
+            **metrics}
+
+def readQuicheSingleFile(filename):
+    operator, cc, objsize, iteration = parseFilename(filename)
+
+    # Parsing sqlog (JSON-SEQ) file, only recovery:metrics_updated records are decoded
+    metrics = qlogReader.readKeyValues(filename, ['recovery:metrics_updated'])
+    metrics['time'] = metrics['time'].astype(np.float64) * 1000
+    isRtt = np.isin(metrics['key'], quicheRttKeys)
+    metrics['value'] = np.where(isRtt, metrics['value'] * 1000, metrics['value'])
+    metrics['key'] = pd.Categorical(metrics['key'])
+    return {'operator': operator,
+            'cc': cc,
+            'objsize': objsize,
+            'iteration': iteration,
+            **metrics}
+
+def toCompactColumn(values):
+    # Integer columns are stored as int32 if the value range fits and as int64 otherwise,
+    # missing values (NaN) as pandas NA. Non-integral columns are kept as float64
+    present = ~np.isnan(values) if values.dtype.kind == 'f' else np.ones(len(values), dtype=bool)
+    if values.dtype.kind == 'f' and not np.array_equal(values[present], np.round(values[present])):
+        return values
+    fits32 = (not present.any()
+              or (values[present].min() >= np.iinfo(np.int32).min and values[present].max() <= np.iinfo(np.int32).max))
+    if present.all():
+        return values.astype(np.int32 if fits32 else np.int64)
+    return pd.array(values, dtype="Int32" if fits32 else "Int64")
+
+def readPicoquicSingleFileWide(filename):
+    # One row per recovery:metrics_updated event, one column per metric key
+    operator, cc, objsize, iteration = parseFilename(filename)
+    metrics = qlogReader.readColumns(filename, ['recovery:metrics_updated'])
+    return {'operator': operator,
+            'cc': cc,
+            'objsize': objsize,
+            'iteration': np.full(len(metrics['time']), iteration, dtype=np.int32),
+            **{key: toCompactColumn(values) for key, values in metrics.items()}}
+
+def readQuicheSingleFileWide(filename):
+    operator, cc, objsize, iteration = parseFilename(filename)
+    metrics = qlogReader.readColumns(filename, ['recovery:metrics_updated'])
+    metrics['time'] = metrics['time'].astype(np.float64) * 1000
+    for key in quicheRttKeys:
+        if key in metrics:
+            metrics[key] = metrics[key].astype(np.float64) * 1000
+    return {'operator': operator,
+            'cc': cc,
+            'objsize': objsize,
+            'iteration': np.full(len(metrics['time']), iteration, dtype=np.int32),
+            **{key: toCompactColumn(values) for key, values in metrics.items()}}
+
+def sketchMetrics(result):
+    # {(operator, cc, objsize, key): quantileSketch.QuantileSketch} of the samples of one file (result
+    # of read*SingleFile), only the sketches are kept
+    codes = result['key'].codes
+    values = np.asarray(result['value'], dtype=np.float64)
+    return {(result['operator'], result['cc'], result['objsize'], key):
+                quantileSketch.QuantileSketch().update(values[codes == code])
+            for code, key in enumerate(result['key'].categories)}
+
+def sketchPicoquicSingleFile(filename):
+    return sketchMetrics(readPicoquicSingleFile(filename))
+
+def sketchQuicheSingleFile(filename):
+    return sketchMetrics(readQuicheSingleFile(filename))
 
-    metrics_list = []
-
-    with open(filename, 'r') as json_file_read:
-        json_file_load = json.load(json_file_read)
-    # Parsing qlog (json) file
-    events = json_file_load["traces"][0]["events"]
-
-    for event in events:
-        if event[1] == 'recovery' and event[2] == 'metrics_updated':
-            #print(event)
-            for key in event[3]:
-                #print(f"time {event[0]}, key {key}, value {event[3][key]}")
-                metric_dict = {'operator': operator,
-                               'cc': cc,
-                               'objsize': objsize,
-                               'iteration': iteration,
-                               'time': event[0],
-                               'key': key,
-                               'value': int(event[3][key])}
-                metrics_list.append(metric_dict)
-    return metrics_list
+def evalPicoquicSingleFile(filename):
+    return pd.DataFrame(readPicoquicSingleFile(filename))
 
 def evalQuicheSingleFile(filename):
-    parameters = os.path.basename(filename).replace(".sqlog", "").split(sep="_")
-    operator = parameters[1]
-    cc = parameters[2]
-    objsize = int(parameters[3].replace("objsize", ""))
-    iteration = int(parameters[4].replace("iter", ""))
-
-    metrics_list = []
-
-    with open(f'{filename}', 'r') as json_file_read:
-        content = json_file_read.read()
-        # split the input data into individual JSON texts
-        # \u001E is the ASCII Record Separator (RS) character
-        json_objects = content.split('\u001E')
-        for json_object in json_objects:
-            # remove the line feed at the end of the json_text
-            json_object = json_object.strip()
-            if json_object:  # check the string is not empty
-                try:
-                    json_seq = json.loads(json_object)
-
-                    if json_seq.get('name') == 'recovery:metrics_updated':
-                        for key in json_seq['data']:
-                            metric_dict = {'operator': operator,
-                                            'cc': cc,
-                                            'objsize': objsize,
-                                            'iteration': iteration,
-                                            'time': json_seq['time'] * 1000,
-                                           'key': key,
-                                           'value': json_seq['data'][key] * 1000 if key in ["min_rtt", "smoothed_rtt",
-                                                                                            "latest_rtt",
-                                                                                            "rtt_variance"] else
-                                           json_seq['data'][key]}
-                            metrics_list.append(metric_dict)
-
-                except json.JSONDecodeError:
-                    print(f'Skipping malformed JSON object: {json_object}...')
-    return metrics_list
-
-
-def evalPicoquicMeasAndWriteToCsv(path2files):
+    return pd.DataFrame(readQuicheSingleFile(filename))
+
+
+def boundedImap(pool, function, items, window):
+    # like pool.imap, but at most window tasks are submitted and not yet consumed: workers do not
+    # parse ahead of a slow file while the finished results pile up in memory
+    items = iter(items)
+    pending = collections.deque(pool.apply_async(function, (item,)) for item in itertools.islice(items, window))
+    while pending:
+        result = pending.popleft().get()
+        for item in itertools.islice(items, 1):
+            pending.append(pool.apply_async(function, (item,)))
+        yield result
+
+
+def evalQlogFiles(inputFiles, readSingleFile, jobs=1, cache=None):
+    # Files are parsed by jobs worker processes, each returning its metric columns. Results are
+    # yielded in file name order; at most 2 * jobs files are parsed or parsed and not yet consumed at
+    # a time, which bounds the memory to the results of that many files. The output is identical to
+    # the one of a serial run.
+    # With a cache, only new or changed files are parsed, all others are read from the cache.
+    inputFiles = sorted(inputFiles)
+    namespace = readSingleFile.__name__
+    toParse = [inputFile for inputFile in inputFiles if cache is None or not cache.contains(inputFile, namespace)]
+    print(f"evalQlogFiles() parsing {len(toParse)} of {len(inputFiles)} files")
+    toParseSet = set(toParse)
+    with (multiprocessing.Pool(jobs) if jobs > 1 else contextlib.nullcontext()) as pool:
+        results = boundedImap(pool, readSingleFile, toParse, 2 * jobs) if pool else map(readSingleFile, toParse)
+        for inputFile in inputFiles:
+            if inputFile in toParseSet:
+                result = next(results)
+                if cache is not None:
+                    cache.put(inputFile, namespace, result)
+            else:
+                result = cache.get(inputFile, namespace, default=evalCache.MISSING)
+                if result is evalCache.MISSING:
+                    # evicted in the meantime
+                    result = readSingleFile(inputFile)
+            print(f"evalQlogFiles() {inputFile}")
+            yield result
+    if cache is not None:
+        print(cache)
+
+def evalQlogFilesAndWriteToCsv(inputFiles, readSingleFile, csvFilename, jobs=1, cache=None):
+    rows = 0
+    with open(csvFilename, 'w') as csvFile:
+        for idx, result in enumerate(evalQlogFiles(inputFiles, readSingleFile, jobs, cache)):
+            df = pd.DataFrame(result)
+            df.index = pd.RangeIndex(rows, rows + len(df))
+            df.to_csv(csvFile, header=(idx == 0))
+            rows += len(df)
+    print(f"Saved {csvFilename}")
+
+def evalQlogFilesAndWriteToParquet(inputFiles, readSingleFileWide, datasetDir, jobs=1, cache=None):
+    # Parquet dataset partitioned by operator/cc/objsize (directories operator=.../cc=.../objsize=...),
+    # one file per qlog with one column per metric key
+    shutil.rmtree(datasetDir, ignore_errors=True)
+    for result in evalQlogFiles(inputFiles, readSingleFileWide, jobs, cache):
+        df = pd.DataFrame(result)
+        if df.empty:
+            continue
+        df.to_parquet(datasetDir, partition_cols=['operator', 'cc', 'objsize'], index=False)
+    print(f"Saved {datasetDir}")
+
+sketchGroupColumns = ['operator', 'cc', 'objsize', 'key']
+
+def evalQlogFilesAndWriteSketches(inputFiles, sketchSingleFile, sketchFilename, jobs=1, cache=None):
+    # one quantile sketch per (operator, cc, objsize, key), merged over all files, the raw samples of
+    # a file are dropped once its sketches are filled (in the worker process with jobs > 1)
+    sketches = {}
+    for result in evalQlogFiles(inputFiles, sketchSingleFile, jobs, cache):
+        quantileSketch.mergeSketches(sketches, result)
+    quantileSketch.saveSketches(sketchFilename, sketches, sketchGroupColumns)
+    print(f"Saved {sketchFilename}")
+
+def openParquetDataset(datasetDir):
+    # optional dependency, only needed for parquet output
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    # metric columns may differ between files (missing keys, int32/int64), so use the unified schema
+    dataset = ds.dataset(datasetDir, format="parquet", partitioning="hive")
+    schema = pa.unify_schemas([dataset.schema] + [fragment.physical_schema for fragment in dataset.get_fragments()],
+                              promote_options="permissive")
+    return ds.dataset(datasetDir, schema=schema, format="parquet", partitioning="hive")
+
+def readParquetMetrics(dataset, operator, cc, keys):
+    # Reads only the operator/cc partitions and the requested metric columns,
+    # returns the long format (objsize, key, value) of the csv file
+    import pyarrow.dataset as ds
+
+    keys = [key for key in keys if key in dataset.schema.names]
+    table = dataset.to_table(columns=['objsize'] + keys,
+                             filter=(ds.field('operator') == operator) & (ds.field('cc') == cc))
+    return (table.to_pandas()
+            .melt(id_vars='objsize', value_vars=keys, var_name='key', value_name='value')
+            .dropna(subset=['value']))
+
+def evalPicoquicMeasAndWriteToCsv(path2files, jobs=1, outputFormat="csv", cache=None):
     inputFiles = glob.glob(f"{path2files}/*.qlog")
 
     if not inputFiles:
         return
 
-    metrics_list = []
-    for inputFile in inputFiles:
-        print(f"evalPicoquicMeasAndWriteToCsv() {inputFile}")
-        metrics_list.extend(evalPicoquicSingleFile(inputFile))
-    df = pd.DataFrame(metrics_list)
-    df.to_csv("data_picoquic.csv")
-    print("Saved data_picoquic.csv")
+    if outputFormat == "parquet":
+        evalQlogFilesAndWriteToParquet(inputFiles, readPicoquicSingleFileWide, "data_picoquic.parquet", jobs, cache)
+    elif outputFormat == "sketch":
+        evalQlogFilesAndWriteSketches(inputFiles, sketchPicoquicSingleFile, "data_picoquic.sketch.json", jobs, cache)
+    else:
+        evalQlogFilesAndWriteToCsv(inputFiles, readPicoquicSingleFile, "data_picoquic.csv", jobs, cache)
 
-def evalQuicheMeasAndWriteToCsv(path2files):
+def evalQuicheMeasAndWriteToCsv(path2files, jobs=1, outputFormat="csv", cache=None):
     inputFiles = glob.glob(f"{path2files}/*.sqlog")
 
     if not inputFiles:
         return
 
-    metrics_list = []
-    for inputFile in inputFiles:
-        print(f"evalQuicheMeasAndWriteToCsv() {inputFile}")
-        metrics_list.extend(evalQuicheSingleFile(inputFile))
-    df = pd.DataFrame(metrics_list)
-    df.to_csv("data_quiche.csv")
-    print("Saved data_quiche.csv")
-
+    if outputFormat == "parquet":
+        evalQlogFilesAndWriteToParquet(inputFiles, readQuicheSingleFileWide, "data_quiche.parquet", jobs, cache)
+    elif outputFormat == "sketch":
+        evalQlogFilesAndWriteSketches(inputFiles, sketchQuicheSingleFile, "data_quiche.sketch.json", jobs, cache)
+    else:
+        evalQlogFilesAndWriteToCsv(inputFiles, readQuicheSingleFile, "data_quiche.csv", jobs, cache)
+
+
+def pipelineFromArguments(args, implementation, cache=None):
+    # background evaluation of --pipeline, the long format csv file can be plotted at any time with
+    # --readCsvAndPlot data_{picoquic,quiche}_pipeline.csv
+    if not args.pipeline:
+        return None
+    readSingleFile = readPicoquicSingleFile if implementation == Implementation.PICOQUIC else readQuicheSingleFile
+    return evalPipeline.EvalPipeline(readSingleFile, f"data_{implementation.name.lower()}_pipeline.csv",
+                                     jobs=args.pipelineJobs, cache=cache, pauseDuringTransfers=args.pipelinePause)
+
+
+boxStatisticsColumns = ['q1', 'med', 'q3', 'whislo', 'whishi']
+
+def boxStatistics(df, by, whis=1.5):
+    # Box plot statistics of df['value'] per group of the columns by, as computed by matplotlib (and
+    # seaborn) for every box: linearly interpolated quartiles, whiskers at the most extreme samples
+    # within whis*IQR of the box, samples beyond are fliers. All groups are computed at once on the
+    # samples sorted by (group, value). Returns one row per group: by, count, q1, med, q3, whislo,
+    # whishi and fliers (array of the outlier samples)
+    df = df.dropna(subset=['value'])
+    groups = df.groupby(by, sort=True, observed=True)
+    codes = groups.ngroup().to_numpy().astype(np.min_scalar_type(groups.ngroups))
+    values = df['value'].to_numpy(dtype=np.float64)
+    # sorted by value, then stable (radix sort for up to 65536 groups) by group
+    order = np.argsort(values)
+    order = order[np.argsort(codes[order], kind='stable')]
+    values = values[order]
+    codes = codes[order]
+    counts = np.bincount(codes, minlength=groups.ngroups)
+    starts = np.cumsum(counts) - counts
+
+    def quantile(q):
+        position = q * (counts - 1)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, counts - 1)
+        return values[starts + lower] + (position - lower) * (values[starts + upper] - values[starts + lower])
+
+    q1, med, q3 = quantile(0.25), quantile(0.5), quantile(0.75)
+    iqr = q3 - q1
+    # values are sorted within a group: only the smallest samples are below, only the largest above the limits
+    aboveLow = values >= (q1 - whis * iqr)[codes]
+    belowHigh = values <= (q3 + whis * iqr)[codes]
+    whislo = values[starts + np.bincount(codes, weights=~aboveLow, minlength=len(counts)).astype(np.int64)]
+    whishi = values[starts + np.bincount(codes, weights=belowHigh, minlength=len(counts)).astype(np.int64) - 1]
+    # like matplotlib, the whiskers do not reach into the box (interpolated quartiles of small groups
+    # with outliers), samples beyond the clamped whiskers are fliers
+    whislo = np.minimum(whislo, q1)
+    whishi = np.maximum(whishi, q3)
+    isFlier = (values < whislo[codes]) | (values > whishi[codes])
+    fliers = np.split(values[isFlier], np.cumsum(np.bincount(codes[isFlier], minlength=len(counts)))[:-1])
+
+    stats = df[by].iloc[order[starts]].reset_index(drop=True)
+    stats['count'] = counts
+    for column, statistic in zip(boxStatisticsColumns, [q1, med, q3, whislo, whishi]):
+        stats[column] = statistic
+    stats['fliers'] = fliers
+    return stats
+
+def scaleBoxStatistics(stats, divisor):
+    stats = stats.copy()
+    stats[boxStatisticsColumns] /= divisor
+    stats['fliers'] = [fliers / divisor for fliers in stats['fliers']]
+    return stats
+
+def sketchBoxStatistics(sketches, keys, whis=1.5):
+    # box plot statistics (see boxStatistics) from quantile sketches: quartiles within the relative
+    # error of the sketches, whiskers at the most extreme buckets within whis*IQR, one flier per
+    # bucket beyond
+    rows = []
+    for (operator, cc, objsize, key), sketch in sketches.items():
+        if key not in keys or sketch.count == 0:
+            continue
+        q1, med, q3 = sketch.quantiles([0.25, 0.5, 0.75])
+        values, _ = sketch.buckets()
+        inside = (values >= q1 - whis * (q3 - q1)) & (values <= q3 + whis * (q3 - q1))
+        # whiskers clamped to the quartiles as in boxStatistics
+        whislo = min(values[inside].min(), q1)
+        whishi = max(values[inside].max(), q3)
+        rows.append({'operator': operator, 'cc': cc, 'objsize': objsize, 'key': key, 'count': sketch.count,
+                     'q1': q1, 'med': med, 'q3': q3, 'whislo': whislo, 'whishi': whishi,
+                     'fliers': values[(values < whislo) | (values > whishi)]})
+    return pd.DataFrame(rows, columns=sketchGroupColumns + ['count'] + boxStatisticsColumns + ['fliers'])
+
+def sketchSummary(sketches, qs=(0.01, 0.25, 0.5, 0.75, 0.99)):
+    # count, min, quantiles, max and mean per (operator, cc, objsize, key)
+    rows = []
+    for group, sketch in sorted(sketches.items()):
+        rows.append({**dict(zip(sketchGroupColumns, group)), 'count': sketch.count, 'min': sketch.min,
+                     **{f"p{q * 100:g}": value for q, value in zip(qs, sketch.quantiles(qs))},
+                     'max': sketch.max, 'mean': sketch.mean()})
+    return pd.DataFrame(rows)
+
+def readBoxStatistics(data, operators, ccs, keys):
+    # box plot statistics per (operator, cc, objsize, key), the long format csv data is grouped once,
+    # the parquet dataset is read per operator and cc, sketches ({group: QuantileSketch}) are used as is
+    if isinstance(data, dict):
+        return sketchBoxStatistics(data, keys)
+    if isinstance(data, pd.DataFrame):
+        return boxStatistics(data[data['key'].isin(keys)], ['operator', 'cc', 'objsize', 'key'])
+    stats = []
+    for operator in operators:
+        for cc in ccs:
+            metrics = readParquetMetrics(data, operator, cc, keys)
+            if not metrics.empty:
+                stats.append(boxStatistics(metrics.assign(operator=operator, cc=cc),
+                                           ['operator', 'cc', 'objsize', 'key']))
+    return pd.concat(stats, ignore_index=True) if stats else pd.DataFrame(
+        columns=['operator', 'cc', 'objsize', 'key', 'count'] + boxStatisticsColumns + ['fliers'])
+
+def plotBoxStatistics(ax, stats, hueOrder, width=0.8):
+    # like sns.boxplot(x="objsize", y="value", hue="key") but from precomputed statistics (see
+    # boxStatistics), i.e., independent of the number of samples
+    xValues = np.sort(stats['objsize'].unique())
+    hues = [key for key in hueOrder if key in set(stats['key'])]
+    boxWidth = width / max(1, len(hues))
+    handles = []
+    for idxHue, (key, color) in enumerate(zip(hues, sns.color_palette(n_colors=len(hues)))):
+        rows = stats[stats['key'] == key]
+        boxes = [{'label': key, 'fliers': row.fliers, **{column: getattr(row, column) for column in boxStatisticsColumns}}
+                 for row in rows.itertuples()]
+        positions = np.searchsorted(xValues, rows['objsize']) - width / 2 + (idxHue + 0.5) * boxWidth
+        ax.bxp(boxes, positions=positions, widths=boxWidth * 0.8, patch_artist=True, manage_ticks=False,
+               boxprops={'facecolor': color}, medianprops={'color': 'black'},
+               flierprops={'marker': 'o', 'markersize': 5, 'markerfacecolor': 'none', 'markeredgecolor': '0.3'})
+        handles.append(mpatches.Patch(facecolor=color, label=key))
+    ax.set_xticks(range(len(xValues)), [f"{x:g}" for x in xValues])
+    ax.set_xlim(-0.5, len(xValues) - 0.5)
+    if handles:
+        # fixed location, finding the best one checks every flier
+        ax.legend(handles=handles, title="key", loc='upper left')
 
 def readCsvAndPlot(filename):
+    # filename is either the long-format csv file, the partitioned parquet dataset directory or the
+    # quantile sketches (.sketch.json)
     print(f"Reading {filename}")
-    df = pd.read_csv(filename)
+    if os.path.isdir(filename):
+        df = openParquetDataset(filename)
+    elif filename.endswith(".sketch.json"):
+        df, _ = quantileSketch.loadSketches(filename)
+        summary = sketchSummary(df)
+        print(summary.to_string(index=False))
+        summary.to_csv(filename.replace(".sketch.json", "_summary.csv"), index=False)
+    else:
+        df = pd.read_csv(filename, usecols=['operator', 'cc', 'objsize', 'key', 'value'],
+                         dtype={'operator': 'category', 'cc': 'category', 'key': 'category'})
 
     print("Start plotting")
     operators = ["NetEm", "Skydsl", "Konnect", "Starlink"] # FIXME global variable is overwritten just for plotting
@@ -251,16 +562,22 @@ def readCsvAndPlot(filename):
                     print("")
 
 
+    rttKeys = ["latest_rtt", "min_rtt"]
+    bytesKeys = ["bytes_in_flight", "cwnd", "congestion_window"]
+    stats = readBoxStatistics(df, operators, ccs, rttKeys + bytesKeys)
+    stats['objsize'] = stats['objsize'] / 1000000 # byte -> Mbyte
+    print(f"Plotting {len(stats)} boxes of {stats['count'].sum()} samples")
+
+    def cellStatistics(operator, cc, keys):
+        return stats[(stats['operator'] == operator) & (stats['cc'] == cc) & stats['key'].isin(keys)]
+
     # plot RTTs
     fig, axes = plt.subplots(2, 4, figsize=(4*7,2*5))
     for idxColumnOperator, operator in enumerate(operators):
         for idxRowCc, cc in enumerate(ccs):
-            dfTemp = df.query('operator == @operator and cc == @cc and (key == "latest_rtt" or key == "min_rtt")')
-            dfTemp['objsize'] /= 1000000 # byte -> Mbyte
-            dfTemp['value'] /= 1000 # us -> ms
-            (sns.boxplot(ax=axes[idxRowCc][idxColumnOperator],
-                           data=dfTemp, x="objsize", y="value", hue="key")
-             .set(title=f"Operator {operator}, Congestion Control {cc.upper()}", xlabel="Object Size [Mbyte]", ylabel="RTT [ms]"))
+            ax = axes[idxRowCc][idxColumnOperator]
+            plotBoxStatistics(ax, scaleBoxStatistics(cellStatistics(operator, cc, rttKeys), 1000), rttKeys) # us -> ms
+            ax.set(title=f"Operator {operator}, Congestion Control {cc.upper()}", xlabel="Object Size [Mbyte]", ylabel="RTT [ms]")
             if operator == "Starlink":
                 ylim = 2e2
             else:
@@ -275,13 +592,10 @@ def readCsvAndPlot(filename):
     plt.xticks(rotation=45)
     for idxColumnOperator, operator in enumerate(operators):
         for idxRowCc, cc in enumerate(ccs):
-            dfTemp = df.query('operator == @operator and cc == @cc and (key == "bytes_in_flight" or key == "cwnd" or key == "congestion_window")')
-            dfTemp['objsize'] /= 1000000 # byte -> Mbyte
-            dfTemp['value'] /= 1000 # bytes -> kbyte
-            (sns.boxplot(ax=axes[idxRowCc][idxColumnOperator],
-                           data=dfTemp, x="objsize", y="value", hue="key")
-             .set(title=f"Operator {operator}, Congestion Control {cc.upper()}", xlabel="Object Size [Mbyte]", ylabel="[kbyte]"))
-            axes[idxRowCc][idxColumnOperator].set_yscale('log')
+            ax = axes[idxRowCc][idxColumnOperator]
+            plotBoxStatistics(ax, scaleBoxStatistics(cellStatistics(operator, cc, bytesKeys), 1000), bytesKeys) # bytes -> kbyte
+            ax.set(title=f"Operator {operator}, Congestion Control {cc.upper()}", xlabel="Object Size [Mbyte]", ylabel="[kbyte]")
+            ax.set_yscale('log')
     fig.autofmt_xdate(rotation=45)
     fig.tight_layout()
     plt.savefig("boxplot_bytesInFlight_cwnd.png")
@@ -292,23 +606,53 @@ if __name__ == "__main__":
     parser.add_argument("--runPicoquicMeas", action='store_true')
     parser.add_argument("--runQuicheMeas", action='store_true')
     parser.add_argument("--evalQlogFilesAndWriteToCsv", type=str)
-    parser.add_argument("--readCsvAndPlot", action='store_true')
+    parser.add_argument("--readCsvAndPlot", nargs='?', const=True, metavar="FILE",
+                        help="Plot data_picoquic.csv/.parquet/.sketch.json or FILE")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of worker processes for evaluating qlog files")
+    parser.add_argument("--outputFormat", choices=["csv", "parquet", "sketch"], default="csv",
+                        help="csv: long format data_*.csv, parquet: data_*.parquet partitioned by operator/cc/objsize, "
+                             "sketch: quantile sketches per operator/cc/objsize/metric data_*.sketch.json (1%% error)")
+    evalCache.addCacheArguments(parser)
+    evalPipeline.addPipelineArguments(parser)
+    iterationScheduler.addSchedulerArguments(parser, maxIterations=10)
+    stageProfiler.addProfilerArguments(parser)
     args = parser.parse_args()
     print(args)
+    stageProfiler.profilerFromArguments(args)
 
     if args.runPicoquicMeas:
-        runImplementation(Implementation.PICOQUIC, iterations=10)
+        with stageProfiler.stage("runPicoquicMeas"):
+            pipeline = pipelineFromArguments(args, Implementation.PICOQUIC, evalCache.cacheFromArguments(args))
+            scheduler = iterationScheduler.schedulerFromArguments(args, measurementCells(), size=lambda cell: cell[2])
+            runImplementation(Implementation.PICOQUIC, scheduler, pipeline=pipeline)
+            if pipeline:
+                pipeline.close()
 
     if args.runQuicheMeas:
-        runImplementation(Implementation.QUICHE, iterations=10)
+        with stageProfiler.stage("runQuicheMeas"):
+            pipeline = pipelineFromArguments(args, Implementation.QUICHE, evalCache.cacheFromArguments(args))
+            scheduler = iterationScheduler.schedulerFromArguments(args, measurementCells(), size=lambda cell: cell[2])
+            runImplementation(Implementation.QUICHE, scheduler, pipeline=pipeline)
+            if pipeline:
+                pipeline.close()
 
     if args.evalQlogFilesAndWriteToCsv:
-        evalPicoquicMeasAndWriteToCsv(args.evalQlogFilesAndWriteToCsv)
-        evalQuicheMeasAndWriteToCsv(args.evalQlogFilesAndWriteToCsv)
+        cache = evalCache.cacheFromArguments(args)
+        with stageProfiler.stage("evalPicoquic"):
+            evalPicoquicMeasAndWriteToCsv(args.evalQlogFilesAndWriteToCsv, args.jobs, args.outputFormat, cache)
+        with stageProfiler.stage("evalQuiche"):
+            evalQuicheMeasAndWriteToCsv(args.evalQlogFilesAndWriteToCsv, args.jobs, args.outputFormat, cache)
 
     if args.readCsvAndPlot:
-        if os.path.isfile("data_picoquic.csv"):
-            readCsvAndPlot("data_picoquic.csv")
+        with stageProfiler.stage("readCsvAndPlot"):
+            if isinstance(args.readCsvAndPlot, str):
+                readCsvAndPlot(args.readCsvAndPlot)
+            elif os.path.isfile("data_picoquic.csv"):
+                readCsvAndPlot("data_picoquic.csv")
+            elif os.path.isdir("data_picoquic.parquet"):
+                readCsvAndPlot("data_picoquic.parquet")
+            elif os.path.isfile("data_picoquic.sketch.json"):
+                readCsvAndPlot("data_picoquic.sketch.json")
 
 
 
@@ -1,5 +1,6 @@
 import argparse
 import os.path
+import sys
 import time
 import json
 from glob import glob
@@ -10,6 +11,14 @@ import matplotlib.pyplot as plt
 import pandas as pd
 import seaborn as sns
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+import qlogReader
+import evalCache
+import stageProfiler
+
+# one row per qlog/sqlog file, the duration is in us
+RESULT_COLUMNS = ['Provider', 'Type', 'Object size', 'Duration']
+
 
 def process_file_name(file):
     file = os.path.basename(file)
@@ -25,107 +34,148 @@ def size_to_bytes(size):
     num, unit = int(size[:-2]), size[-2:]
     return num * units[unit]
 
-def process_qlog(qlog_file):
-    global df
-    provider, size, algorithm = process_file_name(file)
-
-    with open(qlog_file, 'r') as qlog:
-        try:
-            qlog_loaded = json.load(qlog)
-        except:
-            print(f"Can't load {qlog_file}")
-            return
-
-        # bytesize
-        #bytesize = 0
-        # for packet in qlog_loaded['traces'][0]['events']:
-        #     if packet[1] == 'transport' and packet[2] == 'packet_sent':
-        #         for frame in packet[3]['frames']:
-        #             if frame['frame_type'] == 'stream':
-        #                 bytesize += frame['length']
-        bytesize = size_to_bytes(size)
-
-        # duration
-        connection_start = qlog_loaded['traces'][0]['events'][0][0]
-        connection_end = qlog_loaded['traces'][0]['events'][len(qlog_loaded['traces'][0]['events']) - 2][0]
-
-        df = pd.concat([pd.DataFrame([[provider, algorithm, bytesize, connection_end - connection_start]], columns=df.columns), df],
-                       ignore_index=True)
-
-def process_sqlog(sqlog_file):
-    global df
-    provider, size, algorithm = process_file_name(file)
-
-    with open(sqlog_file, 'r') as qlog:
-        for line in qlog:
-            if line[0] == '\x1e':
-                line = line[1:]
-            try:
-                qlog_loaded = json.loads(line)
-            except:
-                print(f"Can't load {sqlog_file}")
-                return
-
-            # bytesize
-            bytesize = size_to_bytes(size)
-
-            # duration
-            if "name" in qlog_loaded:
-                if qlog_loaded['name'] == "transport:packet_received":
-                    for frames in qlog_loaded['data']['frames']:
-                        if frames['frame_type'] == "connection_close":
-                            connection_end = qlog_loaded['time']
+def process_qlog(qlog_file, fast=False):
+    provider, size, algorithm = process_file_name(qlog_file)
+
+    # fast: read first event from the head and the last two events from the end of the file
+    headTail = qlogReader.readQlogHeadTail(qlog_file, lastEvents=2) if fast else None
+    if headTail is not None:
+        times = [headTail[0]] + headTail[1]
+    else:
+        if fast:
+            print(f"{qlog_file} is truncated or malformed, parsing complete file")
+        # only the event timestamps are needed, event data is not decoded
+        times = qlogReader.readColumns(qlog_file, None, fields=[])['time']
+    if len(times) < 2:
+        print(f"Can't load {qlog_file}")
+        return None
+
+    # bytesize
+    #bytesize = 0
+    # for packet in qlog_loaded['traces'][0]['events']:
+    #     if packet[1] == 'transport' and packet[2] == 'packet_sent':
+    #         for frame in packet[3]['frames']:
+    #             if frame['frame_type'] == 'stream':
+    #                 bytesize += frame['length']
+    bytesize = size_to_bytes(size)
+
+    # duration
+    connection_start = times[0]
+    connection_end = times[-2]
+
+    return [provider, algorithm, bytesize, connection_end - connection_start]
+
+def has_connection_close(data):
+    return any(frames.get('frame_type') == "connection_close" for frames in data.get('frames', []))
+
+def process_sqlog(sqlog_file, fast=False):
+    provider, size, algorithm = process_file_name(sqlog_file)
+
+    # bytesize
+    bytesize = size_to_bytes(size)
+
+    # duration
+    connection_end = None
+    if fast:
+        # search backwards from the end of the file
+        record = qlogReader.findLastSqlogRecord(sqlog_file, ['transport:packet_received'],
+                                                require=b'connection_close', accept=has_connection_close)
+        if record is not None:
+            connection_end = record[0]
+        else:
+            print(f"No connection_close at the end of {sqlog_file}, parsing complete file")
+    if connection_end is None:
+        # only packets containing connection_close are decoded
+        for timestamp, name, data in qlogReader.iterRecords(sqlog_file, ['transport:packet_received'],
+                                                            require=b'connection_close'):
+            if has_connection_close(data):
+                connection_end = timestamp
+
+    if connection_end is None:
+        print(f"Can't load {sqlog_file}")
+        return None
 
     # TODO
     connection_start = 0
 
-    df = pd.concat([pd.DataFrame(
-        [[provider, algorithm, bytesize, int((connection_end - connection_start) * 1000)]], columns=df.columns),
-                    df],
-                   ignore_index=True)
-
-
-# Define pandas dataframe
-df = pd.DataFrame(columns=['Provider', 'Type', 'Object size', 'Duration'])
-
-# Reading files from input
-parser = argparse.ArgumentParser(
-    description='Process qlog files and generate visualizations.')
-parser.add_argument(
-    'file',
-    nargs='+',
-    type=str,
-    help='List of qlog files to process')
-args = parser.parse_args()
-files = []
-
-for arg in args.file:
-    files += glob(arg)
-
-# Process files
-for file in files:
-    ext = os.path.splitext(file)[1]
-    if ext == ".qlog":
-        process_qlog(file)
-    elif ext == ".sqlog":
-        process_sqlog(file)
-
-df = df.sort_values(by='Type', ascending=True)
-df['Duration'] /= 1e6 # us to s
-
-print("Dataframe:")
-print(df)
-
-# Plot
-sns.set()
-ax = sns.lineplot(x='Object size', y='Duration', hue='Type', data=df, errorbar='sd')
-plt.xticks(range(0, 10000001, 1000000), ['0MB', '1MB', '2MB', '3MB', '4MB', '5MB', '6MB', '7MB', '8MB', '9MB', '10MB'])
-plt.ylim(bottom=0)
-plt.ylabel('Duration (s)')
-plt.title(df['Provider'][0])
-plt.show()
-
-df.to_csv("careful_resume_plots.csv")
-
-plt.savefig("results.png")
-
+    return [provider, algorithm, bytesize, int((connection_end - connection_start) * 1000)]
+
+
+QLOG_EXTENSIONS = {".qlog": process_qlog, ".sqlog": process_sqlog}
+
+
+def process_file(file, fast=False):
+    # row of a qlog or sqlog file, None if it can't be loaded
+    return QLOG_EXTENSIONS[os.path.splitext(file)[1]](file, fast)
+
+
+def row_to_frame(row):
+    return pd.DataFrame([row], columns=RESULT_COLUMNS)
+
+
+if __name__ == "__main__":
+    # Reading files from input
+    parser = argparse.ArgumentParser(
+        description='Process qlog files and generate visualizations.')
+    parser.add_argument(
+        'file',
+        nargs='+',
+        type=str,
+        help='List of qlog files to process (or the csv file of vostd_run --pipeline with --from_csv)')
+    parser.add_argument(
+        '--fast',
+        action='store_true',
+        help='Read only head and tail of each file (falls back to parsing the complete file)')
+    parser.add_argument(
+        '--from_csv',
+        action='store_true',
+        help='Plot the rows of csv files written during the measurements instead of processing qlog files')
+    evalCache.addCacheArguments(parser)
+    stageProfiler.addProfilerArguments(parser)
+    args = parser.parse_args()
+    stageProfiler.profilerFromArguments(args)
+    files = []
+
+    for arg in args.file:
+        files += glob(arg)
+
+    cache = evalCache.cacheFromArguments(args)
+
+    # Process files
+    rows = []
+    with stageProfiler.stage("process_files"):
+        if args.from_csv:
+            for file in files:
+                rows += pd.read_csv(file)[RESULT_COLUMNS].values.tolist()
+        else:
+            for file in files:
+                if os.path.splitext(file)[1] not in QLOG_EXTENSIONS:
+                    continue
+                row = cache.cached(process_file, file, file, args.fast) if cache is not None else process_file(file, args.fast)
+                if row is not None:
+                    rows.append(row)
+    if cache is not None:
+        print(cache)
+
+    # Define pandas dataframe, latest file first
+    df = pd.DataFrame(rows[::-1], columns=RESULT_COLUMNS)
+
+    df = df.sort_values(by='Type', ascending=True)
+    df['Duration'] /= 1e6 # us to s
+
+    print("Dataframe:")
+    print(df)
+
+    # Plot
+    with stageProfiler.stage("plot"):
+        sns.set()
+        ax = sns.lineplot(x='Object size', y='Duration', hue='Type', data=df, errorbar='sd')
+        plt.xticks(range(0, 10000001, 1000000), ['0MB', '1MB', '2MB', '3MB', '4MB', '5MB', '6MB', '7MB', '8MB', '9MB', '10MB'])
+        plt.ylim(bottom=0)
+        plt.ylabel('Duration (s)')
+        plt.title(df['Provider'][0])
+        plt.show()
+
+    df.to_csv("careful_resume_plots.csv")
+
+    plt.savefig("results.png")
@@ -0,0 +1,117 @@
+# Append-only journal of completed vostd_run runs
+#
+# One JSON line per completed run (testcase, object size, iteration) with size and SHA-256 of every
+# fetched artefact. Each line is written with a single write() on a file opened with O_APPEND and
+# fsynced. A crash during a write can only leave a partial last line, which has no trailing newline.
+# That line is ignored when loading and cut off before the next append. If a run is journaled more
+# than once, e.g. after it was repeated, the last entry is used.
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+JOURNAL_FILE = "journal.jsonl"
+
+
+def run_name(server, client, cc, obj_size_str, itr):
+    # also the prefix of the local artefact files of the run
+    return f'{server}_{client}_{cc}.{obj_size_str}.itr{itr}'
+
+
+def file_checksum(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def run_artefacts(artefact_dir, name):
+    # local artefact files of a run: {name}.{server,client}.{qlog,sqlog,log,...}
+    if not os.path.isdir(artefact_dir):
+        return []
+    return sorted(file_name for file_name in os.listdir(artefact_dir)
+                  if file_name.startswith(f"{name}.") and not file_name.startswith("."))
+
+
+class RunJournal:
+    def __init__(self, results_dir, artefact_dir):
+        self.path = os.path.join(results_dir, JOURNAL_FILE)
+        self.artefact_dir = artefact_dir
+        self.lock = threading.Lock()
+        self.entries = {}  # run name -> last entry
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        complete = data[:data.rfind(b'\n') + 1]
+        if len(complete) < len(data):
+            logging.warning(f"Journal {self.path}: ignoring incomplete last entry ({len(data) - len(complete)} bytes)")
+            # cut off the partial line, the next entry would otherwise be appended to it
+            with open(self.path, 'r+b') as f:
+                f.truncate(len(complete))
+                os.fsync(f.fileno())
+        for number, line in enumerate(complete.splitlines(), 1):
+            try:
+                entry = json.loads(line)
+                self.entries[entry["name"]] = entry
+            except (ValueError, KeyError, TypeError):
+                logging.warning(f"Journal {self.path}: ignoring invalid entry in line {number}")
+        logging.info(f"Journal {self.path}: {len(self.entries)} runs recorded")
+
+    def append(self, entry):
+        line = (json.dumps(entry, sort_keys=True) + "\n").encode()
+        with self.lock:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.entries[entry["name"]] = entry
+
+    def record(self, testcase, obj_size_str, itr, hosts=('server', 'client'), measurements=None):
+        # journals the run as completed if every host delivered at least one artefact,
+        # returns False otherwise, the run is then repeated by --resume.
+        # measurements: e.g. cost and duration of the run in seconds, stored in the entry
+        name = run_name(testcase["server"], testcase["client"], testcase["cc"], obj_size_str, itr)
+        files = run_artefacts(self.artefact_dir, name)
+        missing = [host for host in hosts if not any(file_name.startswith(f"{name}.{host}.") for file_name in files)]
+        if missing:
+            logging.error(f"Not journaling run {name}, no artefacts from {', '.join(missing)}")
+            return False
+        artefacts = {}
+        for file_name in files:
+            path = os.path.join(self.artefact_dir, file_name)
+            artefacts[file_name] = {"size": os.path.getsize(path), "sha256": file_checksum(path)}
+        self.append({"name": name, "server": testcase["server"], "client": testcase["client"],
+                     "cc": testcase["cc"], "obj_size": obj_size_str, "iteration": itr,
+                     "completed": time.time(), "artefacts": artefacts, **(measurements or {})})
+        return True
+
+    def verify(self, name):
+        # True if the run is journaled and all its artefacts are present and unchanged
+        entry = self.entries.get(name)
+        if entry is None:
+            return False
+        for file_name, expected in entry["artefacts"].items():
+            path = os.path.join(self.artefact_dir, file_name)
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                logging.warning(f"Run {name}: artefact {file_name} is missing, repeating run")
+                return False
+            if size != expected["size"] or file_checksum(path) != expected["sha256"]:
+                logging.warning(f"Run {name}: artefact {file_name} is truncated or modified, repeating run")
+                return False
+        return True
+
+    def completed_runs(self):
+        # names of the journaled runs with intact artefacts
+        return {name for name in self.entries if self.verify(name)}
@@ -9,7 +9,15 @@
 # FIXME script is work in progress
 
 
+import concurrent.futures
+import contextlib
+import hashlib
+import itertools
 import os
+import shutil
+import sys
+import tarfile
+import threading
 import paramiko
 import subprocess
 from datetime import datetime
@@ -20,6 +28,14 @@ import json
 import logging
 import argparse
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+import evalCache
+import evalPipeline
+import iterationScheduler
+import readiness
+import stageProfiler
+from vostd_journal import RunJournal, run_artefacts, run_name
+
 # Configure logging
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s.%(msecs)03d\t%(levelname)s\t%(message)s',
@@ -32,13 +48,30 @@ logging.basicConfig(level=logging.INFO,
 # File size 1KB = 1/1024 MB
 # FILE_SIZE_STR_LIST = ['1KB', '10KB', '100KB', '1MB', '10MB', '1GB'] # EXAMPLE
 FILE_SIZE_STR_LIST = ['0KB', '500KB', '1000KB', '1500KB', '2000KB', '2500KB', '3000KB', '3500KB', '4000KB', '4500KB', '5000KB', '5500KB', '6000KB', '6500KB', '7000KB', '7500KB', '8000KB', '8500KB', '9000KB', '9500KB', '10000KB']
-NUM_ITR = 1               # Number of iterations
 PICOQUIC_DIR = "$HOME/git/private-octopus/picoquic/master"
 PICOQUIC_CR_DIR = "$HOME/git/hfstco/picoquic/careful_resume"
 PICOQUIC_NJ_DIR = "$HOME/git/hfstco/picoquic/no_jump"
 QUICHE_DIR = "$HOME/git/cloudflare/quiche/master"
 QUICHE_CR_DIR = "$HOME/git/ana-cc/quiche/resume-final"
 QLOG_PATH_IN_VM = "$HOME/testcases/qlog"
+SSH_TIMEOUT = 30               # seconds, per host and command
+QLOG_TRANSFER_TIMEOUT = 600    # seconds, per host for fetching all files of a run
+HOUSEKEEPING_SEPARATOR = "---vostd-housekeeping---"
+OBJECT_STORE_DIR = ".objects"  # test objects on the server, relative to file_path of the server
+OBJECT_STORE_TIMEOUT = 600      # seconds, creating and checksumming missing test objects
+# remote compression commands for fetch mode "stream", zstd is used if available on both sides
+COMPRESSORS = {"zstd": "zstd -1 -c", "gzip": "gzip -1 -c"}
+ARTEFACT_HOSTS = ('server', 'client')  # hosts the artefacts of every run are fetched from
+
+# per-host state kept for the whole campaign
+remote_home_dirs = {}
+sftp_sessions = {}
+remote_compressors = {}
+# archives fetched in mode "stream" are extracted in the background while the next run is measured
+extraction_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+# submitted by the transfer threads of run_on_hosts and the main thread
+pending_extractions = []
+pending_extractions_lock = threading.Lock()
 
 
 def main():
@@ -48,16 +81,32 @@ def main():
     parser.add_argument('testcases', type=str, help='The file path of the testcases JSON file.')
     parser.add_argument("--file_size", nargs='*', default=FILE_SIZE_STR_LIST,
                         help="Specify file size(s) as a list of strings (e.g., 10KB, 100MB, 1GB).")
-    parser.add_argument('iterations', type=int, default=1, help="Number of iterations.")
+    parser.add_argument('iterations', type=int, default=1, help="Maximum number of iterations per testcase and file size.")
+    parser.add_argument("--fetch_mode", choices=["sftp", "stream"], default="sftp",
+                        help="sftp: copy files over a persistent SFTP session, "
+                             "stream: fetch all files of a run as one compressed tar stream")
+    parser.add_argument("--verify_objects", action='store_true',
+                        help="Checksum all test objects on the server, not only newly created ones")
+    parser.add_argument("--resume", type=str, default=None, metavar="RESULTS_DIR",
+                        help="Continue the campaign in this results directory (e.g. results/<date>), "
+                             "runs in its journal with intact artefacts are skipped")
+    evalCache.addCacheArguments(parser)
+    evalPipeline.addPipelineArguments(parser)
+    iterationScheduler.addSchedulerArguments(parser, maxIterations=None)
+    stageProfiler.addProfilerArguments(parser)
 
     args = parser.parse_args()
+    stageProfiler.profilerFromArguments(args)
 
-    # datetime object containing current date and time
-    now = datetime.now()
-    dt_string = now.strftime("%Y-%m-%dT%H:%M:%S")
+    if args.resume:
+        path = args.resume.rstrip("/")
+    else:
+        # datetime object containing current date and time
+        now = datetime.now()
+        dt_string = now.strftime("%Y-%m-%dT%H:%M:%S")
 
-    # create directory to save data frame
-    path = f"results/{dt_string}"
+        # create directory to save data frame
+        path = f"results/{dt_string}"
     if not os.path.exists(path):
         os.makedirs(path)
     qlog_path_on_host = f"./{path}/qlog"
@@ -65,6 +114,22 @@ def main():
     # Add FileHandler with this path
     add_file_handler_to_logger(f"{path}/run.log")
 
+    # completed runs survive crashes and lost connections, see --resume
+    journal = RunJournal(path, qlog_path_on_host)
+    completed_runs = journal.completed_runs() if args.resume else set()
+    if args.resume:
+        logging.info(f"Resuming {path}: {len(completed_runs)} completed runs are skipped")
+
+    pipeline = None
+    if args.pipeline:
+        # evaluation dependencies (pandas, matplotlib) are only needed here, partial results can be
+        # plotted at any time with vostd_eval.py --from_csv results/<date>/results_pipeline.csv
+        import vostd_eval
+        pipeline = evalPipeline.EvalPipeline(vostd_eval.process_file, f"{path}/results_pipeline.csv",
+                                             toFrame=vostd_eval.row_to_frame, jobs=args.pipelineJobs,
+                                             cache=evalCache.cacheFromArguments(args),
+                                             pauseDuringTransfers=args.pipelinePause)
+
     # read testcases from json file
     testcases = read_testcases_from_file(args.testcases)
 
@@ -72,18 +137,22 @@ def main():
 
     # Create SSH connections
     ssh_connections = {}
-    for name, endpoint_info in endpoints.items():
-        ssh_client = connect_to_endpoints(
-            endpoint_info['hostname'], endpoint_info['user'], endpoint_info.get('port'))
-        if ssh_client:
-            ssh_connections[name] = ssh_client
+    with stageProfiler.stage("connect"):
+        for name, endpoint_info in endpoints.items():
+            ssh_client = connect_to_endpoints(
+                endpoint_info['hostname'], endpoint_info['user'], endpoint_info.get('port'))
+            if ssh_client:
+                ssh_connections[name] = ssh_client
 
     obj_size_str_list = args.file_size
 
-    for obj_size_str in obj_size_str_list:
-        # Generate file for tests on server in specified path
-        generate_file_on_server(
-            ssh_connections["server"], obj_size_str, endpoints['server']['file_path'])
+    # Generate missing files for tests on server in specified path, before the first run
+    with stageProfiler.stage("generate_objects"):
+        objects_complete = generate_files_on_server(ssh_connections["server"], obj_size_str_list,
+                                                    endpoints['server']['file_path'], verify=args.verify_objects)
+    if not objects_complete:
+        logging.error("Test objects on server are incomplete, not starting measurements")
+        sys.exit(1)
 
     # Determine queuing disciplines and log it
     get_queuing_disciplines(ssh_connections)
@@ -92,108 +161,247 @@ def main():
     # Get commit SHA of repositories to see if they are updated
     #get_commit_version(ssh_connections, testcases)
 
+    # iterations per (testcase, file size) cell: at least --minIterations, then more only while the
+    # confidence interval of the transfer duration is wider than --ciTarget, at most `iterations`
+    cells = [(testcase["server"], testcase["client"], testcase["cc"], obj_size_str)
+             for obj_size_str in obj_size_str_list for testcase in testcases]
+    scheduler = iterationScheduler.schedulerFromArguments(args, list(dict.fromkeys(cells)),
+                                                          size=lambda cell: convert_size_to_bytes(cell[3]),
+                                                          maxIterations=args.iterations)
+    # runs of an earlier session (--resume) count as iterations of their cells
+    for name in completed_runs:
+        entry = journal.entries[name]
+        cell = (entry["server"], entry["client"], entry["cc"], entry["obj_size"])
+        if cell in scheduler.costs and "cost" in entry:
+            scheduler.record(cell, entry["cost"], entry.get("duration"))
+
     run_num = 0
-    run_tot = len(testcases)*NUM_ITR*len(obj_size_str_list)
-
-    for itr in range(NUM_ITR):
-        for obj_size_str in obj_size_str_list:
-            for testcase in testcases:
-                server = testcase["server"]
-                client = testcase["client"]
-                cc = testcase["cc"]
+
+    with stageProfiler.stage("measurements"):
+        while cells := scheduler.nextRound():
+            for cell in cells:
+                server, client, cc, obj_size_str = cell
+                testcase = {"server": server, "client": client, "cc": cc}
+                # first iteration number without completed run of the cell
+                itr = next(itr for itr in itertools.count()
+                           if run_name(server, client, cc, obj_size_str, itr) not in completed_runs)
+                name = run_name(server, client, cc, obj_size_str, itr)
                 run_num += 1
                 server_port = determine_server_port(server, endpoints)
                 logging.info(f"Using server port: {server_port} for quic\n")
 
                 logging.info(
-                    f"(RUN {run_num}/{run_tot}) Running QUIC server: {server}, client: {client}, congestion control: {cc}, file size: {obj_size_str}, iteration: {itr+1}/{NUM_ITR}")
-
-                # log error if more than one person is using machines
-                get_who(ssh_connections)
+                    f"(RUN {run_num}, {len(cells)} in this round) Running QUIC server: {server}, client: {client}, congestion control: {cc}, file size: {obj_size_str}, iteration: {itr+1}/{args.iterations}")
 
-                # Delete qlog files
-                delete_qlog(ssh_connections)
+                run_start = time.monotonic()
 
-                # Run quic server
-                run_quic_server(
-                    ssh_connections["server"], server, cc, server_port, endpoints['server']['file_path'])
+                # log error if more than one person is using machines and delete qlog files,
+                # one round trip to all hosts at the same time
+                with stageProfiler.overhead(stageProfiler.SSH):
+                    prepare_hosts(ssh_connections)
 
-                # avoid 0rtt for picoquic
-                if client == "picoquic":
-                    delete_token_picoquic(ssh_connections["client"])
+                with pipeline.transfer() if pipeline else contextlib.nullcontext():
+                    # Run quic server
+                    with stageProfiler.overhead(stageProfiler.SERVER_START):
+                        run_quic_server(
+                            ssh_connections["server"], server, cc, server_port, endpoints['server']['file_path'])
+                        if server != "http2":
+                            wait_for_remote_udp_port(ssh_connections["server"], server_port)
 
-                # Run QUIC client:
-                run_quic_client(ssh_connections["client"], client, endpoints["server"]["hostname"], server_port, cc, obj_size_str)
+                    # avoid 0rtt for picoquic
+                    if client == "picoquic":
+                        with stageProfiler.overhead(stageProfiler.SSH):
+                            delete_token_picoquic(ssh_connections["client"])
 
-                time.sleep(3)
+                    # Run QUIC client:
+                    client_start = time.monotonic()
+                    with stageProfiler.overhead(stageProfiler.TRANSFER):
+                        run_quic_client(ssh_connections["client"], client, endpoints["server"]["hostname"], server_port, cc, obj_size_str)
+                    transfer_duration = time.monotonic() - client_start
 
-                # Close QUIC server:
-                #close_server(ssh_connections["server"], server)
+                    # Close QUIC server:
+                    #close_server(ssh_connections["server"], server)
 
-                time.sleep(3)
+                    # wait until server and client have closed their qlog files
+                    with stageProfiler.overhead(stageProfiler.SSH):
+                        wait_for_remote_qlogs_closed(ssh_connections)
 
                 # get qlog from VM
-                name = f'{server}_{client}_{cc}.{obj_size_str}.itr{itr}'
-                get_qlog(ssh_connections, server, client,
-                         'testcases/qlog', qlog_path_on_host, name)
+                with stageProfiler.overhead(stageProfiler.ARTEFACT_TRANSFER):
+                    get_qlog(ssh_connections, server, client,
+                             'testcases/qlog', qlog_path_on_host, name, mode=args.fetch_mode)
+                run_cost = time.monotonic() - run_start
+                journal_run(journal, testcase, obj_size_str, itr, ARTEFACT_HOSTS,
+                            {"cost": run_cost, "duration": transfer_duration})
+                completed_runs.add(name)
+                scheduler.record(cell, run_cost, transfer_duration)
+                if pipeline:
+                    queue_evaluation(pipeline, qlog_path_on_host, name)
+            logging.info(scheduler.report())
+
+    for line in scheduler.summary():
+        logging.info(line)
+
+    with stageProfiler.stage("finish"):
+        finish_qlog_retrieval()
+        if pipeline:
+            pipeline.close()
+
+    for line in readiness.waitTimeSummary():
+        logging.info(f"Wait times: {line}")
 
     # Close all SSH connections
     for ssh_client in ssh_connections.values():
         ssh_client.close()
         logging.info(f"SSH connection closed")
 
-def get_who(ssh_connections):
-    for vm_name, ssh_client in ssh_connections.items():
-        if vm_name in ['server', 'client']:
-            ssh_client = ssh_connections[vm_name]
-            cmd = "who -q"
-            stdin, stdout, stderr = ssh_client.exec_command(cmd)
-
-            # Decode stdout
-            output = stdout.read().decode('utf-8')
-
-            # Split the output into lines
-            lines = output.strip().split('\n')
-
-            if len(lines) > 1:
-                # Extract usernames and user count from the output
-                # Split the first line by spaces to get individual usernames
-                user_names = lines[0].split()
-                # Extract the user count string
-                user_count_str = lines[1].split('=')[1].strip()
-
-                # Split on '=' and strip whitespace
-                user_count_str = lines[1].split('=')[1].strip()
-                try:
-                    # Convert the count to an integer
-                    user_count = int(user_count_str)
-                except ValueError:
+def log_who(vm_name, output):
+    # Split the output into lines
+    lines = output.strip().split('\n')
+
+    if len(lines) > 1:
+        # Extract usernames and user count from the output
+        # Split the first line by spaces to get individual usernames
+        user_names = lines[0].split()
+        # Extract the user count string
+        user_count_str = lines[1].split('=')[1].strip()
+
+        # Split on '=' and strip whitespace
+        user_count_str = lines[1].split('=')[1].strip()
+        try:
+            # Convert the count to an integer
+            user_count = int(user_count_str)
+        except ValueError:
+            logging.error(
+                f"Failed to parse user count from: '{lines[1]}'")
+            return
+
+        if user_count > 1:
+            # Check if all usernames are the same (by converting the list to a set and checking its length)
+            if len(set(user_names)) != 1:
+                # If there are different usernames, log as an error/warnning
+                if vm_name == 'client':  # client is bottleneck
                     logging.error(
-                        f"Failed to parse user count from: '{lines[1]}'")
-                    return
-
-                if user_count > 1:
-                    # Check if all usernames are the same (by converting the list to a set and checking its length)
-                    if len(set(user_names)) != 1:
-                        # If there are different usernames, log as an error/warnning
-                        if vm_name == 'client':  # client is bottleneck
-                            logging.error(
-                                f"{vm_name}: More than one user is logged in: {', '.join(user_names)}; Total users: {user_count}")
-                        else:
-                            logging.warning(
-                                f"{vm_name}: More than one user is logged in: {', '.join(user_names)}; Total users: {user_count}")
-                    else:
-                        # If all usernames are the same, log as info
-                        logging.info(
-                            f"{vm_name}: Multiple sessions by the same user: {user_names[0]}; Total sessions: {user_count}")
+                        f"{vm_name}: More than one user is logged in: {', '.join(user_names)}; Total users: {user_count}")
                 else:
-                    # For a single user, simply log the information
-                    logging.info(
-                        f"{vm_name}: A user logged in: {user_names[0]}; Total users: {user_count}")
-
+                    logging.warning(
+                        f"{vm_name}: More than one user is logged in: {', '.join(user_names)}; Total users: {user_count}")
             else:
+                # If all usernames are the same, log as info
                 logging.info(
-                    "Unexpected output format from 'who -q': {output}")
+                    f"{vm_name}: Multiple sessions by the same user: {user_names[0]}; Total sessions: {user_count}")
+        else:
+            # For a single user, simply log the information
+            logging.info(
+                f"{vm_name}: A user logged in: {user_names[0]}; Total users: {user_count}")
+
+    else:
+        logging.info(
+            "Unexpected output format from 'who -q': {output}")
+
+
+def remote_command(ssh_client, cmd, timeout=SSH_TIMEOUT):
+    # returns (exit status, stdout, stderr), raises socket.timeout if the host does not answer
+    stdin, stdout, stderr = ssh_client.exec_command(cmd, timeout=timeout)
+    output = stdout.read().decode('utf-8')
+    error = stderr.read().decode('utf-8')
+    return stdout.channel.recv_exit_status(), output, error
+
+
+def remote_output(ssh_client, cmd):
+    return remote_command(ssh_client, cmd)[1]
+
+
+def run_on_hosts(ssh_connections, function, vm_names=('server', 'client'), timeout=SSH_TIMEOUT):
+    # Calls function(vm_name, ssh_client) for all hosts at the same time over the existing connections.
+    # Returns {vm_name: result}, result is None for hosts which failed or did not finish within timeout
+    hosts = {vm_name: ssh_client for vm_name, ssh_client in ssh_connections.items() if vm_name in vm_names}
+    results = {}
+    if not hosts:
+        return results
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(hosts))
+    futures = {executor.submit(function, vm_name, ssh_client): vm_name for vm_name, ssh_client in hosts.items()}
+    done, notDone = concurrent.futures.wait(futures, timeout=timeout)
+    for future, vm_name in futures.items():
+        results[vm_name] = None
+        if future in notDone:
+            logging.error(f"{vm_name}: no answer within {timeout} s")
+            continue
+        try:
+            results[vm_name] = future.result()
+        except Exception as e:
+            logging.error(f"{vm_name}: {type(e).__name__}: {e}")
+    # do not wait for hosts that timed out, their channel timeout ends the threads
+    executor.shutdown(wait=False, cancel_futures=True)
+    return results
+
+
+def delete_qlog_cmd():
+    # Define the list of file extensions to remove
+    file_extensions = ["qlog", "sqlog", "log", "txt", "key", "csv"]
+
+    # Create a pattern to match all specified file extensions
+    extensions_pattern = " -o ".join(
+        [f"-name '*.{ext}'" for ext in file_extensions])
+
+    # Define the command to remove files with the specified extensions
+    return f'find {QLOG_PATH_IN_VM} -type f \\( {extensions_pattern} \\) -delete'
+
+
+def prepare_hosts(ssh_connections):
+    # who -q and deleting the qlog/log files of the previous run in a single command per host
+    cmd = f"who -q; echo {HOUSEKEEPING_SEPARATOR}; {delete_qlog_cmd()}"
+    results = run_on_hosts(ssh_connections, lambda vm_name, ssh_client: remote_command(ssh_client, cmd))
+    for vm_name, result in results.items():
+        if result is None:
+            continue
+        exit_status, output, error = result
+        log_who(vm_name, output.split(HOUSEKEEPING_SEPARATOR)[0])
+        if exit_status == 0:
+            logging.info(f"qlog/log files successfully deleted in {vm_name}.")
+        else:
+            logging.error(f"Failed to delete qlog/log files in {vm_name}. Error: {error.strip()}")
+
+
+def wait_for_remote_udp_port(ssh_client, port, timeout=10):
+    # server is ready as soon as its UDP socket is bound
+    cmd = readiness.SOCKET_TABLE_CMD.format(proto="udp")
+    if not readiness.waitFor(lambda: port in readiness.boundPorts(remote_output(ssh_client, cmd)),
+                             timeout=timeout, interval=0.1, label="server ready"):
+        logging.error(f"Server port {port} not bound after {timeout} s")
+
+
+def wait_for_remote_qlogs_closed(ssh_connections, timeout=30, settle=0.5):
+    # qlog/sqlog files in QLOG_PATH_IN_VM are closed when no process of the ssh user has them open and
+    # each is either a complete qlog (end marker, see readiness.qlogComplete) or unchanged for settle
+    # seconds, as /proc does not show the fds of writers started with sudo or as another user (e.g. in
+    # docker). One round trip per check, all hosts are checked at the same time
+    cmd = (f'find /proc/[0-9]*/fd \\( -lname "{QLOG_PATH_IN_VM}/*.qlog" -o -lname "{QLOG_PATH_IN_VM}/*.sqlog" \\) '
+           f'2>/dev/null; echo SEP; '
+           f'for f in {QLOG_PATH_IN_VM}/*.qlog {QLOG_PATH_IN_VM}/*.sqlog; do [ -f "$f" ] || continue; '
+           f'echo "$(stat -c %s.%Y "$f") $(tail -c 64 "$f" | tr -d " \\t\\r\\n" | tail -c 4) $f"; done')
+
+    def wait_for_host(vm_name, ssh_client):
+        last_change = {}
+
+        def closed():
+            open_files, _, files = remote_output(ssh_client, cmd).partition("SEP\n")
+            if open_files.strip():
+                return False
+            now = time.monotonic()
+            for line in files.splitlines():
+                # size.mtime, last non-whitespace characters, path
+                state, end, path = line.split(' ', 2)
+                if last_change.get(path, (None,))[0] != state:
+                    last_change[path] = (state, now)
+                if not (path.endswith('.qlog') and end == ']}]}') and now - last_change[path][1] < settle:
+                    return False
+            return True
+
+        if not readiness.waitFor(closed, timeout=timeout, interval=0.1, label=f"{vm_name} qlog closed"):
+            logging.error(f"{vm_name}: qlog files still open or growing after {timeout} s")
+
+    run_on_hosts(ssh_connections, wait_for_host, timeout=timeout + SSH_TIMEOUT)
 
 
 def get_queuing_disciplines(ssh_connections):
@@ -271,59 +479,175 @@ def find_file(directory: str, prefix: str, suffix: str) -> Optional[str]:
     return None
 
 
-def get_qlog(ssh_connections, server, client, remote_subdir, dst_directory, new_name):
+def get_qlog(ssh_connections, server, client, remote_subdir, dst_directory, new_name, mode="sftp"):
     # Check if the local directory exists; create it if it doesn't
     if not os.path.exists(dst_directory):
         os.makedirs(dst_directory)
         logging.info(f"Created directory {dst_directory}")
 
-    for vm_name, ssh_client in ssh_connections.items():
-        if vm_name in ['server', 'client']:
-            logging.info(f"Running command on {vm_name} machine:")
-
-            # Determine the remote directory path
-            stdin, stdout, stderr = ssh_client.exec_command('echo $HOME')
-            home_dir = stdout.read().decode('utf-8').strip()
-            remote_directory = os.path.join(home_dir, remote_subdir)
-            logging.info(f"Remote directory: {remote_directory}")
-
-            try:
-                # Open an SFTP session on the existing SSH connection
-                sftp = ssh_client.open_sftp()
-                qlog_files = []
-                log_files = []
-                plog_files = []  # Performance log file for picoquic
-                # Wait for the qlog files to be created
-
-
-                # Now, also add any txt files that might be present, without waiting for them
-                remote_files = sftp.listdir(remote_directory)
-
-                # Copy the file(s) from the remote VM to the local machine with the new name
-                for file_name in remote_files:
-                    remote_file_path = os.path.join(remote_directory, file_name)
-
-                    if file_name.endswith('.txt'):
-                        extension = 'server.log' if vm_name == 'server' else 'client.log'
-                    elif file_name.endswith('.sqlog'):
-                        extension = 'server.sqlog' if vm_name == 'server' else 'client.sqlog'
-                    elif file_name.endswith('.qlog'):
-                        extension = 'server.qlog' if vm_name == 'server' else 'client.qlog'
-                    elif file_name.endswith('.key'):
-                        extension = 'server.key' if vm_name == 'server' else 'client.key'
-                    elif file_name.endswith('.csv'):
-                        extension = 'server.csv' if vm_name == 'server' else 'client.csv'
+    get_from_host = get_qlog_from_host if mode == "sftp" else get_qlog_stream_from_host
+
+    # all hosts at the same time
+    run_on_hosts(ssh_connections,
+                 lambda vm_name, ssh_client: get_from_host(vm_name, ssh_client, remote_subdir, dst_directory, new_name),
+                 vm_names=ARTEFACT_HOSTS, timeout=QLOG_TRANSFER_TIMEOUT)
+
+
+def get_home_dir(vm_name, ssh_client):
+    if vm_name not in remote_home_dirs:
+        remote_home_dirs[vm_name] = remote_output(ssh_client, 'echo $HOME').strip()
+    return remote_home_dirs[vm_name]
+
+
+def get_sftp(vm_name, ssh_client):
+    # one SFTP session per host for the whole campaign, reopened if it was closed
+    sftp = sftp_sessions.get(vm_name)
+    if sftp is None or sftp.get_channel().closed:
+        sftp = ssh_client.open_sftp()
+        sftp.get_channel().settimeout(SSH_TIMEOUT)
+        sftp_sessions[vm_name] = sftp
+    return sftp
+
+
+def artefact_extension(file_name, vm_name):
+    # local file extension of a remote artefact, None for unknown files
+    side = 'server' if vm_name == 'server' else 'client'
+    for remote_extension, local_extension in [('.txt', 'log'), ('.sqlog', 'sqlog'), ('.qlog', 'qlog'),
+                                              ('.key', 'key'), ('.csv', 'csv')]:
+        if file_name.endswith(remote_extension):
+            return f"{side}.{local_extension}"
+    return None
+
+
+def get_qlog_from_host(vm_name, ssh_client, remote_subdir, dst_directory, new_name):
+    logging.info(f"Running command on {vm_name} machine:")
+
+    # Determine the remote directory path
+    remote_directory = os.path.join(get_home_dir(vm_name, ssh_client), remote_subdir)
+    logging.info(f"Remote directory: {remote_directory}")
+
+    try:
+        sftp = get_sftp(vm_name, ssh_client)
+
+        remote_files = sftp.listdir(remote_directory)
+
+        # Copy the file(s) from the remote VM to the local machine with the new name
+        for file_name in remote_files:
+            remote_file_path = os.path.join(remote_directory, file_name)
 
+            extension = artefact_extension(file_name, vm_name)
+            if extension is None:
+                logging.warning(f"Not copying unknown file {remote_file_path} in {vm_name}")
+                continue
+
+            local_file_path = os.path.join(dst_directory, f"{new_name}.{extension}")
+            # paramiko pipelines the read requests of a get (prefetch)
+            sftp.get(remote_file_path, local_file_path)
+            logging.info(
+                f"Successfully copied {remote_file_path} to {local_file_path} in {vm_name}")
+
+    except Exception as e:
+        logging.exception(f"Failed to copy file from {vm_name}: {e}")
+        sftp_sessions.pop(vm_name, None)
+
+
+def get_remote_compressor(vm_name, ssh_client):
+    if vm_name not in remote_compressors:
+        try:
+            import zstandard  # noqa: F401
+            local_zstd = True
+        except ImportError:
+            local_zstd = False
+        remote_zstd = remote_command(ssh_client, "command -v zstd")[0] == 0
+        remote_compressors[vm_name] = "zstd" if local_zstd and remote_zstd else "gzip"
+        logging.info(f"{vm_name}: fetching artefacts as tar.{remote_compressors[vm_name]}")
+    return remote_compressors[vm_name]
+
+
+def get_qlog_stream_from_host(vm_name, ssh_client, remote_subdir, dst_directory, new_name):
+    # all files of the run as one compressed tar stream in a single round trip, the archive is
+    # extracted in the background
+    remote_directory = os.path.join(get_home_dir(vm_name, ssh_client), remote_subdir)
+    compressor = get_remote_compressor(vm_name, ssh_client)
+    archive = os.path.join(dst_directory, f".{new_name}.{vm_name}.tar.{compressor}")
+    cmd = (f"cd {remote_directory} && find . -maxdepth 1 -type f -print0 | "
+           f"tar --null -T - -cf - | {COMPRESSORS[compressor]}")
+
+    try:
+        stdin, stdout, stderr = ssh_client.exec_command(cmd, timeout=SSH_TIMEOUT)
+        with open(archive, 'wb') as f:
+            shutil.copyfileobj(stdout, f, 1 << 20)
+        exit_status = stdout.channel.recv_exit_status()
+        if exit_status != 0:
+            logging.error(f"Failed to fetch artefacts from {vm_name}: {stderr.read().decode().strip()}")
+            return
+        logging.info(f"Fetched {os.path.getsize(archive)} bytes of compressed artefacts from {vm_name}")
+    except Exception as e:
+        logging.exception(f"Failed to fetch artefacts from {vm_name}: {e}")
+        return
+
+    queue_background(extract_artefacts, archive, compressor, vm_name, dst_directory, new_name)
+
+
+def queue_background(fn, *args):
+    # runs fn on the extraction thread after everything queued before
+    with pending_extractions_lock:
+        pending_extractions[:] = [future for future in pending_extractions if not future.done()]
+        pending_extractions.append(extraction_executor.submit(fn, *args))
+
+
+def extract_artefacts(archive, compressor, vm_name, dst_directory, new_name):
+    try:
+        with open(archive, 'rb') as f:
+            if compressor == "zstd":
+                import zstandard
+                stream = zstandard.ZstdDecompressor().stream_reader(f)
+            else:
+                stream = f
+            with tarfile.open(fileobj=stream, mode='r|gz' if compressor == "gzip" else 'r|') as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    file_name = os.path.basename(member.name)
+                    extension = artefact_extension(file_name, vm_name)
+                    if extension is None:
+                        logging.warning(f"Not extracting unknown file {file_name} from {vm_name}")
+                        continue
                     local_file_path = os.path.join(dst_directory, f"{new_name}.{extension}")
-                    sftp.get(remote_file_path, local_file_path)
-                    logging.info(
-                        f"Successfully copied {remote_file_path} to {local_file_path} in {vm_name}")
+                    with open(local_file_path, 'wb') as out:
+                        shutil.copyfileobj(tar.extractfile(member), out, 1 << 20)
+                    logging.info(f"Successfully extracted {file_name} to {local_file_path} from {vm_name}")
+        os.remove(archive)
+    except Exception as e:
+        logging.exception(f"Failed to extract {archive}, keeping it: {e}")
+
 
-                # Close the SFTP session
-                sftp.close()
+def journal_run(journal, testcase, obj_size_str, itr, hosts, measurements=None):
+    # queued behind the background extractions of the run, so the checksums cover the final files
+    queue_background(journal.record, testcase, obj_size_str, itr, hosts, measurements)
 
-            except Exception as e:
-                logging.exception(f"Failed to copy file from {vm_name}: {e}")
+
+def queue_evaluation(pipeline, dst_directory, name):
+    # like the journal entry, the qlog/sqlog files of the run are evaluated once they are extracted
+    def submit():
+        for file_name in run_artefacts(dst_directory, name):
+            if file_name.endswith(('.qlog', '.sqlog')):
+                pipeline.submit(os.path.join(dst_directory, file_name))
+        logging.info(pipeline.status())
+
+    queue_background(submit)
+
+
+def finish_qlog_retrieval():
+    # waits for background extractions and closes the SFTP sessions
+    with pending_extractions_lock:
+        futures = list(pending_extractions)
+        pending_extractions.clear()
+    for future in futures:
+        future.result()
+    for sftp in sftp_sessions.values():
+        sftp.close()
+    sftp_sessions.clear()
 
 
 def delete_token_picoquic(ssh_client):
@@ -427,34 +751,6 @@ def run_quic_server(ssh_client, server_name, cc, server_port, file_path):
             "Server name is not correct. Please check the server_name argument.")
 
 
-def delete_qlog(ssh_connections):
-    # Define the list of file extensions to remove
-    file_extensions = ["qlog", "sqlog", "log", "txt", "key", "csv"]
-
-    # Create a pattern to match all specified file extensions
-    extensions_pattern = " -o ".join(
-        [f"-name '*.{ext}'" for ext in file_extensions])
-
-    # Define the command to remove files with the specified extensions
-    cmd = f'find {QLOG_PATH_IN_VM} -type f \\( {extensions_pattern} \\) -delete'
-
-    for vm_name, ssh_client in ssh_connections.items():
-        if vm_name in ['server', 'client']:
-            logging.info(
-                f"Running command on {vm_name} machine to delete qlog/log files.")
-            ssh_client = ssh_connections[vm_name]
-            stdin, stdout, stderr = ssh_client.exec_command(cmd)
-
-            exit_status = stdout.channel.recv_exit_status()
-            if exit_status == 0:
-                logging.info(
-                    f"qlog/log files successfully deleted in {vm_name}.")
-            else:
-                error_msg = stderr.read().decode().strip()
-                logging.error(
-                    f"Failed to delete qlog/log files in {vm_name}. Error: {error_msg}")
-
-
 def convert_size_to_bytes(size_str):
     """Convert size string to bytes, handling KB, MB, and GB."""
     if 'KB' in size_str:
@@ -467,26 +763,91 @@ def convert_size_to_bytes(size_str):
         raise ValueError("Unsupported size unit")
 
 
-# Function to generate file on server
-def generate_file_on_server(ssh_client, file_size_str, base_path):
-    # Determine file size in bytes and create a filename based on the size string
-    file_size_bytes = convert_size_to_bytes(file_size_str)
-    file_name = f"{file_size_str}.txt"
+def zero_object_checksum(size, chunk_size=1 << 20):
+    # SHA-256 of size zero bytes, the content address of a test object
+    digest = hashlib.sha256()
+    chunk = bytes(min(size, chunk_size))
+    for offset in range(0, size, chunk_size):
+        digest.update(chunk[:size - offset])
+    return digest.hexdigest()
 
-    # Construct the complete file path
-    file_path = f"{base_path}/{file_name}"
 
-    try:
-        # Execute the 'dd' command to generate the file
-        cmd = f"mkdir -p $(dirname {file_path}) && dd if=/dev/zero of={file_path} bs={file_size_bytes} count=1"
-        stdin, stdout, stderr = ssh_client.exec_command(cmd)
+# Test objects on the server are zero-filled files {file_size_str}.txt in base_path. They are stored once
+# in the content-addressed store {base_path}/.objects/<sha256>, allocated with fallocate (sparse with
+# truncate if the file system does not support it), and hard linked to their names. The manifest
+# {base_path}/.objects/manifest.json records name -> checksum and checksum -> size, objects are only
+# created if they are missing, have the wrong size or are not linked to the store.
+def generate_files_on_server(ssh_client, file_size_strs, base_path, verify=False):
+    # returns True once all objects exist and are verified
+    store = f"{base_path}/{OBJECT_STORE_DIR}"
+    expected = {f"{file_size_str}.txt": convert_size_to_bytes(file_size_str) for file_size_str in file_size_strs}
+    checksums = {name: zero_object_checksum(size) for name, size in expected.items()}
 
-        logging.info(
-            f"File {file_name} generated successfully at {file_path} on server")
+    try:
+        status, output, error = remote_command(
+            ssh_client, f'cat "{store}/manifest.json" 2>/dev/null; echo "{HOUSEKEEPING_SEPARATOR}"; '
+                        f'cd "{base_path}" 2>/dev/null && stat -c "%n %s %h" -- {" ".join(expected)} 2>/dev/null')
+        manifest_text, stat_text = output.split(HOUSEKEEPING_SEPARATOR + "\n", 1)
+        try:
+            manifest = json.loads(manifest_text)
+        except ValueError:
+            manifest = {}
+        manifest.setdefault("files", {})
+        manifest.setdefault("objects", {})
+        present = {}
+        for line in stat_text.splitlines():
+            name, size, links = line.rsplit(" ", 2)
+            present[name] = (int(size), int(links))
+
+        # objects linked to the store (at least 2 links) with the recorded checksum and size
+        missing = [name for name, size in expected.items()
+                   if manifest["files"].get(name) != checksums[name] or present.get(name, (None, 0))[0] != size
+                   or present[name][1] < 2]
+        to_verify = list(expected) if verify else missing
+        if not missing and not to_verify:
+            logging.info(f"All {len(expected)} test objects present on server in {base_path}")
+            return True
+        logging.info(f"Creating {len(missing)} of {len(expected)} test objects on server in {store}")
+
+        # one command for all objects: allocate, move into the store, link, then checksum
+        commands = [f'mkdir -p "{store}"', f'cd "{base_path}"']
+        for checksum in dict.fromkeys(checksums[name] for name in missing):
+            size = next(expected[name] for name in missing if checksums[name] == checksum)
+            tmp = f"{OBJECT_STORE_DIR}/.{checksum}.tmp"
+            commands.append(f'rm -f {tmp} && (fallocate -l {size} {tmp} 2>/dev/null || truncate -s {size} {tmp}) '
+                            f'&& mv -f {tmp} {OBJECT_STORE_DIR}/{checksum}')
+        for name in missing:
+            commands.append(f'ln -f {OBJECT_STORE_DIR}/{checksums[name]} {name}')
+        if to_verify:
+            commands.append(f'sha256sum -- {" ".join(to_verify)}')
+        status, output, error = remote_command(ssh_client, " && ".join(commands), timeout=OBJECT_STORE_TIMEOUT)
+        if status != 0:
+            logging.error(f"Failed to create test objects on server: {error.strip()}")
+            return False
+
+        computed = dict(reversed(line.split(maxsplit=1)) for line in output.splitlines())
+        wrong = [name for name in to_verify if computed.get(name) != checksums[name]]
+        if wrong:
+            logging.error(f"Test objects with wrong checksum on server: {', '.join(wrong)}")
+            return False
+
+        for name in expected:
+            manifest["files"][name] = checksums[name]
+            manifest["objects"][checksums[name]] = expected[name]
+        manifest_json = json.dumps(manifest, indent=1, sort_keys=True)
+        status, output, error = remote_command(
+            ssh_client, f"cat > \"{store}/manifest.json.tmp\" <<'EOF'\n{manifest_json}\nEOF\n"
+                        f'mv -f "{store}/manifest.json.tmp" "{store}/manifest.json"')
+        if status != 0:
+            logging.error(f"Failed to write test object manifest on server: {error.strip()}")
+            return False
+        logging.info(f"Test objects {', '.join(missing)} created and {len(to_verify)} verified on server")
+        return True
 
     except Exception as e:
         logging.exception(
-            f"Exception occurred while generating file on server: {e}")
+            f"Exception occurred while generating files on server: {e}")
+        return False
 
 
 def connect_to_endpoints(server_ip, username, port=None):